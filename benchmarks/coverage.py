@@ -0,0 +1,41 @@
+# Coverage of a synthetic point cloud by synthetic station isochrones, reporting
+# points per second. Run from the repository root with: python -m benchmarks.coverage
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from shapely.geometry import Point
+
+from scripts.coverage import BANDS, CoverageEngine, chunk_points, coverage_report
+from benchmarks.synthetic import KL_BOUNDS, cleansed_stations
+
+
+def station_isochrones(stations):
+    # Buffered circles at roughly walking pace stand in for ORS isochrones
+    rows = []
+    for station in stations.itertuples():
+        for value in BANDS:
+            rows.append({'station_id': station.station_id, 'value': value,
+                         'geometry': Point(station.longitude, station.latitude).buffer(value * 1.2 / 111_320, 16)})
+    return pd.DataFrame(rows)
+
+
+def main(points=1_000_000, stations=500):
+    stations = cleansed_stations(stations)
+    engine = CoverageEngine(station_isochrones(stations), stations)
+    rng = np.random.default_rng(0)
+    min_lon, min_lat, max_lon, max_lat = KL_BOUNDS
+    longitudes = rng.uniform(min_lon, max_lon, points)
+    latitudes = rng.uniform(min_lat, max_lat, points)
+
+    for max_workers in [1, None]:
+        start = time.perf_counter()
+        report = coverage_report(engine, chunk_points(longitudes, latitudes), max_workers)
+        elapsed = time.perf_counter() - start
+        print(f"workers={max_workers}: {points / elapsed:,.0f} points/s")
+    print(report['region'])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,39 @@
+# Times the Overpass ingest in scripts/entrances_query against synthetic payloads.
+# Run from the repository root with: python -m benchmarks.entrances_ingest
+import sys
+import time
+
+from scripts.entrances_query import build_entrances, build_station_entrances
+from benchmarks.synthetic import overpass_entrance_nodes, overpass_station_relations
+
+
+SIZES = [1_000, 10_000, 100_000]
+
+
+def time_ingest(n):
+    nodes = overpass_entrance_nodes(n)
+    relations = overpass_station_relations(n)
+
+    start = time.perf_counter()
+    entrances = build_entrances(nodes)
+    build_station_entrances(relations, entrances['Entrance ID'])
+    return time.perf_counter() - start
+
+
+def main(sizes=SIZES):
+    print(f"{'entrances':>10} {'seconds':>10} {'us/entrance':>12}")
+    per_row = []
+    for n in sizes:
+        elapsed = time_ingest(n)
+        per_row.append(elapsed / n)
+        print(f"{n:>10} {elapsed:>10.4f} {elapsed / n * 1e6:>12.3f}")
+
+    # With linear scaling the per-entrance cost stays roughly flat as n grows
+    growth = per_row[-1] / per_row[0]
+    print(f"per-entrance cost growth from {sizes[0]} to {sizes[-1]}: {growth:.2f}x")
+    return growth
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    main(sizes)
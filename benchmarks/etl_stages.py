@@ -0,0 +1,136 @@
+# Times the ETL stages on the raw csv files scaled to each size, records their peak
+# traced memory and fails when either regresses past benchmarks/baselines.json.
+# Run from the repository root with: python -m benchmarks.etl_stages [--sizes 1000 1000000]
+# and refresh the stored baselines with --update-baselines. Timings depend on the
+# machine, so baselines are only comparable when recorded where the check runs.
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from supabase import create_client
+
+from scripts import entrances_data_cleanse, load_sql, station_data_cleanse, storage
+from scripts.load_supabase import sync_table
+from scripts.table_diff import to_records
+from benchmarks.postgrest_stub import PostgrestStub
+from benchmarks.supabase_writes import FAKE_KEY
+from benchmarks.synthetic import perturb, write_raw_data
+
+
+SIZES = [1_000, 10_000, 100_000]
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+# A result regresses when it exceeds its baseline by both the ratio and the absolute
+# slack; the slack keeps millisecond timings from failing on scheduler noise
+TIME_TOLERANCE = 1.5
+TIME_SLACK = 0.1
+MEMORY_TOLERANCE = 1.2
+MEMORY_SLACK_MB = 5
+
+
+@contextlib.contextmanager
+def working_directory(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def supabase_diff():
+    # The stations sync against a stub already holding a perturbed copy of the table
+    local = storage.read_table('stations')
+    remote = perturb(local, 'station_id')
+    with PostgrestStub({'stations': 'station_id'}, {'stations': to_records(remote)}) as stub:
+        sync_table(create_client(stub.url, FAKE_KEY), 'stations', local, 'station_id')
+
+
+# Run in order; every stage reads what the ones before it wrote. The station cleanse
+# runs in process so its work is timed and traced rather than the pool's.
+STAGES = {
+    'station_data_cleanse': lambda: station_data_cleanse.run(max_workers=1),
+    'entrances_data_cleanse': entrances_data_cleanse.run,
+    'load_sql': lambda: load_sql.run('transit_database.db'),
+    'load_supabase_diff': supabase_diff,
+}
+
+
+def measure(n, source_directory):
+    # Seconds of an untraced run, then peak MB of a second run under tracemalloc, whose
+    # overhead would distort the timing
+    results = {}
+    for traced in [False, True]:
+        with tempfile.TemporaryDirectory() as directory:
+            write_raw_data(directory, n, source_directory)
+            with working_directory(directory):
+                os.makedirs('data_cleansed')
+                for name, stage in STAGES.items():
+                    if traced:
+                        tracemalloc.start()
+                        stage()
+                        results[name]['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+                        tracemalloc.stop()
+                    else:
+                        start = time.perf_counter()
+                        stage()
+                        results[name] = {'seconds': time.perf_counter() - start}
+    return results
+
+
+def regressions(results, baselines):
+    failures = []
+    for key, result in results.items():
+        baseline = baselines.get(key)
+        if baseline is None:
+            continue
+        if result['seconds'] > max(baseline['seconds'] * TIME_TOLERANCE, baseline['seconds'] + TIME_SLACK):
+            failures.append(f"{key}: {result['seconds']:.3f}s against a {baseline['seconds']:.3f}s baseline")
+        if result['peak_mb'] > max(baseline['peak_mb'] * MEMORY_TOLERANCE, baseline['peak_mb'] + MEMORY_SLACK_MB):
+            failures.append(f"{key}: {result['peak_mb']:.1f} MB against a {baseline['peak_mb']:.1f} MB baseline")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='rows per raw csv file')
+    parser.add_argument('--baselines', default=BASELINES)
+    parser.add_argument('--update-baselines', action='store_true',
+                        help='store these results as the baselines instead of comparing against them')
+    args = parser.parse_args(argv)
+
+    source_directory = os.path.abspath('data')
+    results = {}
+    print(f"{'stage':>24} {'rows':>9} {'seconds':>9} {'peak MB':>9}")
+    for n in args.sizes:
+        for name, result in measure(n, source_directory).items():
+            results[f'{name}/{n}'] = result
+            print(f"{name:>24} {n:>9} {result['seconds']:>9.3f} {result['peak_mb']:>9.1f}")
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            baselines = json.load(f)
+    if args.update_baselines:
+        baselines.update({key: {name: round(value, 4) for name, value in result.items()}
+                          for key, result in results.items()})
+        with open(args.baselines, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"Stored {len(results)} baselines in {args.baselines}")
+        return 0
+
+    failures = regressions(results, baselines)
+    for failure in failures:
+        print(f"REGRESSION {failure}")
+    missing = [key for key in results if key not in baselines]
+    if missing:
+        print(f"No baseline for {', '.join(missing)}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
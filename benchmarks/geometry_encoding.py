@@ -0,0 +1,45 @@
+# Compares the size of one isochrone polygon as GeoJSON, WKT, WKB and the compact
+# encoding in scripts/geometry_store, and the cost of decoding it back.
+# Run from the repository root with: python -m benchmarks.geometry_encoding
+import json
+import time
+
+import numpy as np
+from shapely import wkb
+from shapely.geometry import Polygon, mapping
+
+from scripts.geometry_store import compact_geometry, decode_geometry, encode_geometry
+
+
+def isochrone_like(vertices=800, seed=0):
+    # A ragged ring around a KL station, similar in vertex count to an ORS 15 minute walk
+    rng = np.random.default_rng(seed)
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    radius = 0.01 * (1 + 0.3 * np.sin(angles * 7) + 0.05 * rng.random(vertices))
+    return Polygon(np.column_stack([101.7 + radius * np.cos(angles), 3.1 + radius * np.sin(angles)]))
+
+
+def main(repeat=1000):
+    polygon = isochrone_like()
+    compact = compact_geometry(polygon)
+    encoded = encode_geometry(compact)
+    sizes = {
+        'geojson': len(json.dumps(mapping(polygon))),
+        'wkt': len(polygon.wkt),
+        'wkb': len(wkb.dumps(polygon)),
+        'compact geojson': len(json.dumps(mapping(compact))),
+        'compact varint': len(encoded),
+    }
+    for name, size in sizes.items():
+        print(f"{name:>16} {size:>8} bytes")
+
+    polygon_wkb = wkb.dumps(polygon)
+    for name, decode in [('wkb', lambda: wkb.loads(polygon_wkb)), ('varint', lambda: decode_geometry(encoded))]:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            decode()
+        print(f"{name:>16} decode {(time.perf_counter() - start) / repeat * 1e6:>8.1f} us")
+
+
+if __name__ == '__main__':
+    main()
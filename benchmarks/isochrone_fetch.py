@@ -0,0 +1,40 @@
+# Fetches isochrones for synthetic entrances from a local ORS stub, then again to show
+# that cached locations are never re-requested. Run from the repository root with:
+# python -m benchmarks.isochrone_fetch
+import sys
+import tempfile
+import time
+
+from openrouteservice import client
+
+from scripts.isochrones import IsochroneCache, fetch_isochrones
+from benchmarks.ors_stub import OrsStub
+from benchmarks.synthetic import overpass_entrance_nodes
+
+
+PARAMETERS = {
+    'profile': 'foot-walking',
+    'range': [900],
+    'interval': 300,
+    'attributes': ['area', 'reachfactor', 'total_pop'],
+}
+
+
+def main(n=300, latency=0.05):
+    locations = [[float(node.lon), float(node.lat)] for node in overpass_entrance_nodes(n)]
+    with tempfile.TemporaryDirectory() as directory, OrsStub(latency=latency) as stub:
+        ors_client = client.Client(key='stub', base_url=stub.url, retry_over_query_limit=False)
+        cache = IsochroneCache(directory)
+        print(f"{'run':>6} {'requests':>9} {'seconds':>8} {'failed':>7}")
+        for run in ['cold', 'warm']:
+            before = stub.requests
+            start = time.perf_counter()
+            results = fetch_isochrones(ors_client, locations, PARAMETERS, cache=cache,
+                                       max_workers=4, requests_per_minute=6000)
+            elapsed = time.perf_counter() - start
+            failed = sum(result is None for result in results)
+            print(f"{run:>6} {stub.requests - before:>9} {elapsed:>8.2f} {failed:>7}")
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,103 @@
+# A local stand-in for the openrouteservice isochrones endpoint. It answers
+# POST /v2/isochrones/<profile>/geojson with one circular polygon per location and
+# range band, enforces the per-request location limit and an optional requests per
+# second limit (429 when exceeded), and counts requests and locations served.
+import json
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def circle(longitude, latitude, meters, points=16):
+    d_lat = meters / 111_320
+    d_lon = meters / (111_320 * math.cos(math.radians(latitude)))
+    ring = [[longitude + d_lon * math.cos(2 * math.pi * i / points),
+             latitude + d_lat * math.sin(2 * math.pi * i / points)] for i in range(points)]
+    return ring + [ring[0]]
+
+
+def isochrone_response(body):
+    ranges = body['range']
+    interval = body.get('interval')
+    values = list(range(interval, ranges[-1] + 1, interval)) if interval else ranges
+    features = []
+    for group_index, (longitude, latitude) in enumerate(body['locations']):
+        for value in values:
+            # roughly walking pace, 1.2 m/s
+            features.append({
+                'type': 'Feature',
+                'properties': {'group_index': group_index, 'value': float(value),
+                               'center': [longitude, latitude], 'area': float(value) * 1000,
+                               'reachfactor': 0.5, 'total_pop': float(value) * 10},
+                'geometry': {'type': 'Polygon', 'coordinates': [circle(longitude, latitude, value * 1.2)]},
+            })
+    return {'type': 'FeatureCollection', 'features': features,
+            'metadata': {'service': 'isochrones', 'query': body}}
+
+
+class OrsStub:
+
+    def __init__(self, max_locations=5, max_per_second=None, latency=0.0):
+        self.max_locations = max_locations
+        self.max_per_second = max_per_second
+        self.latency = latency
+        self.requests = 0
+        self.rejected = 0
+        self.locations = 0
+        self.lock = threading.Lock()
+        self.window = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _over_limit(self):
+        if self.max_per_second is None:
+            return False
+        now = time.monotonic()
+        self.window = [t for t in self.window if now - t < 1]
+        if len(self.window) >= self.max_per_second:
+            return True
+        self.window.append(now)
+        return False
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def _respond(self, status, payload):
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with stub.lock:
+                    if stub._over_limit():
+                        stub.rejected += 1
+                        return self._respond(429, {'error': 'Rate limit exceeded'})
+                    if len(body['locations']) > stub.max_locations:
+                        stub.rejected += 1
+                        return self._respond(400, {'error': {'code': 3004, 'message': 'too many locations'}})
+                    stub.requests += 1
+                    stub.locations += len(body['locations'])
+                if stub.latency:
+                    time.sleep(stub.latency)
+                self._respond(200, isochrone_response(body))
+
+        return Handler
@@ -0,0 +1,151 @@
+# A small in-memory stand-in for the PostgREST endpoints that supabase-py talks to.
+# It understands enough of the REST dialect for load_supabase: select with column
+# lists, eq/in/gt filters, order and limit, upserts, updates and deletes. Every
+# request is counted so benchmarks can report round-trips without the live service.
+import json
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+
+def _parse_value(text):
+    try:
+        return int(text)
+    except ValueError:
+        try:
+            return float(text)
+        except ValueError:
+            return text
+
+
+def _filter(column, expression):
+    # Compile a PostgREST filter such as id=in.(1,2) into a row predicate
+    operator, _, operand = expression.partition('.')
+    if operator == 'eq':
+        value = _parse_value(operand)
+        return lambda row: row.get(column) == value
+    if operator == 'in':
+        values = {_parse_value(item) for item in operand.strip('()').split(',')}
+        return lambda row: row.get(column) in values
+    if operator == 'gt':
+        value = _parse_value(operand)
+        return lambda row: row.get(column) is not None and row.get(column) > value
+    raise ValueError(f'Unsupported filter {expression}')
+
+
+class PostgrestStub:
+
+    def __init__(self, keys, tables=None, latency=0.0, max_rows=None):
+        # keys maps table name to its primary key column, max_rows caps every
+        # select like PostgREST's db-max-rows setting
+        self.keys = keys
+        self.tables = {table: {} for table in keys}
+        for table, rows in (tables or {}).items():
+            self.load(table, rows)
+        self.latency = latency
+        self.max_rows = max_rows
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def load(self, table, rows):
+        key = self.keys[table]
+        self.tables[table] = {row[key]: dict(row) for row in rows}
+
+    def rows(self, table):
+        return list(self.tables[table].values())
+
+    def _select(self, table, params):
+        rows = self.rows(table)
+        for column, expression in params:
+            if column not in ('select', 'order', 'limit', 'offset', 'on_conflict', 'columns'):
+                predicate = _filter(column, expression)
+                rows = [row for row in rows if predicate(row)]
+        order = dict(params).get('order')
+        if order:
+            column = order.split('.')[0]
+            rows.sort(key=lambda row: row[column], reverse=order.endswith('.desc'))
+        offset = int(dict(params).get('offset', 0))
+        limit = dict(params).get('limit')
+        rows = rows[offset:offset + int(limit)] if limit else rows[offset:]
+        select = dict(params).get('select', '*')
+        if select != '*':
+            columns = select.split(',')
+            rows = [{column: row.get(column) for column in columns} for row in rows]
+        return rows
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def _route(self):
+                parts = urlsplit(self.path)
+                table = parts.path.rstrip('/').split('/')[-1]
+                return table, parse_qsl(parts.query, keep_blank_values=True)
+
+            def _body(self):
+                length = int(self.headers.get('Content-Length', 0))
+                return json.loads(self.rfile.read(length) or b'null')
+
+            def _respond(self, rows, status=200):
+                payload = json.dumps(rows).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.send_header('Content-Range', f'0-{max(len(rows) - 1, 0)}/*')
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _handle(self, method):
+                if stub.latency:
+                    threading.Event().wait(stub.latency)
+                table, params = self._route()
+                with stub.lock:
+                    stub.requests[method] += 1
+                    key = stub.keys[table]
+                    if method == 'GET':
+                        rows = stub._select(table, params)[:stub.max_rows]
+                    elif method == 'POST':
+                        body = self._body()
+                        rows = body if isinstance(body, list) else [body]
+                        for row in rows:
+                            stub.tables[table].setdefault(row[key], {}).update(row)
+                    elif method == 'PATCH':
+                        changes = self._body()
+                        rows = stub._select(table, params)
+                        for row in rows:
+                            stub.tables[table][row[key]].update(changes)
+                    elif method == 'DELETE':
+                        rows = stub._select(table, params)
+                        for row in rows:
+                            del stub.tables[table][row[key]]
+                self._respond(rows, 201 if method == 'POST' else 200)
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+            def do_PATCH(self):
+                self._handle('PATCH')
+
+            def do_DELETE(self):
+                self._handle('DELETE')
+
+        return Handler
@@ -0,0 +1,109 @@
+# Load test for scripts/query_service: serves a synthetic database and drives it with
+# concurrent keep-alive clients, reporting throughput and latency percentiles.
+# Run from the repository root with: python -m benchmarks.query_service
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from scripts.query_service import QueryService
+from benchmarks.synthetic import KL_BOUNDS, cleansed_stations
+
+
+def synthetic_database(path, n_stations, entrances_per_station=3, seed=0):
+    rng = np.random.default_rng(seed)
+    stations = cleansed_stations(n_stations, seed)
+    n = n_stations * entrances_per_station
+    owners = stations.iloc[np.repeat(np.arange(n_stations), entrances_per_station)]
+    entrances = pd.DataFrame({
+        'entrance_id': np.arange(n),
+        'longitude': owners['longitude'].to_numpy() + rng.normal(0, 0.001, n),
+        'latitude': owners['latitude'].to_numpy() + rng.normal(0, 0.001, n),
+        'entrance_name': None,
+        'entrance_destination': None,
+    })
+    station_entrances = pd.DataFrame({
+        'entrance_id': entrances['entrance_id'],
+        'station_name': owners['name'].to_numpy(),
+        'station_code': owners['station_code'].to_numpy(),
+    })
+    conn = sqlite3.connect(path)
+    with conn:
+        stations.to_sql('stations', conn, index=False)
+        entrances.to_sql('entrances', conn, index=False)
+        station_entrances.to_sql('station_entrances', conn, index=False)
+    conn.close()
+    return stations
+
+
+def targets(stations, count, rng):
+    min_lon, min_lat, max_lon, max_lat = KL_BOUNDS
+    codes = stations['station_code'].to_numpy()
+    lines = stations['route_id'].unique()
+    paths = []
+    for i in range(count):
+        kind = i % 3
+        if kind == 0:
+            paths.append(f'/stations/{codes[rng.integers(len(codes))]}/entrances')
+        elif kind == 1:
+            paths.append(f'/nearest?lat={rng.uniform(min_lat, max_lat):.4f}&lon={rng.uniform(min_lon, max_lon):.4f}&k=5')
+        else:
+            paths.append(f'/stations?region=Klang%20Valley&route={lines[rng.integers(len(lines))]}')
+    return paths
+
+
+async def client(port, paths, latencies):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    for path in paths:
+        start = time.perf_counter()
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode('latin-1'))
+        await writer.drain()
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line == b'\r\n':
+                break
+            if line.lower().startswith(b'content-length:'):
+                length = int(line.split(b':')[1])
+        await reader.readexactly(length)
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+
+async def load(service, paths, connections):
+    started = asyncio.get_running_loop().create_future()
+    server = asyncio.ensure_future(service.serve(port=0, ready=started.set_result))
+    port = await started
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(port, paths[i::connections], latencies) for i in range(connections)])
+    elapsed = time.perf_counter() - start
+    server.cancel()
+    return np.array(latencies), elapsed
+
+
+def main(n_stations=20_000, requests=20_000, connections=32, distinct=2_000):
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'transit_database.db')
+        stations = synthetic_database(database, n_stations)
+        # Draw the requests from a fixed pool so repeated URLs exercise the response cache
+        pool = targets(stations, distinct, rng)
+        paths = [pool[i] for i in rng.integers(len(pool), size=requests)]
+
+        print(f"{'cache':>8} {'rps':>10} {'p50 ms':>8} {'p99 ms':>8} {'hit rate':>9}")
+        for cache_size in [0, len(pool)]:
+            service = QueryService(database, cache_size=cache_size)
+            latencies, elapsed = asyncio.run(load(service, paths, connections))
+            lookups = service.cache.hits + service.cache.misses
+            print(f"{cache_size:>8} {len(latencies) / elapsed:>10.0f} {np.percentile(latencies, 50) * 1e3:>8.2f} "
+                  f"{np.percentile(latencies, 99) * 1e3:>8.2f} {service.cache.hits / lookups:>9.1%}")
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,56 @@
+# Reports queries per second and latency percentiles of scripts/spatial_query on a
+# synthetic point set. Run from the repository root with: python -m benchmarks.spatial_query
+import sys
+import time
+
+import numpy as np
+
+from scripts.spatial_query import SpatialIndex
+from benchmarks.synthetic import KL_BOUNDS
+
+
+def random_points(n, rng):
+    min_lon, min_lat, max_lon, max_lat = KL_BOUNDS
+    return rng.uniform(min_lat, max_lat, n), rng.uniform(min_lon, max_lon, n)
+
+
+def single_query_latencies(index, latitudes, longitudes, query):
+    latencies = np.empty(len(latitudes))
+    for i, (latitude, longitude) in enumerate(zip(latitudes, longitudes)):
+        start = time.perf_counter()
+        query(index, latitude, longitude)
+        latencies[i] = time.perf_counter() - start
+    return latencies
+
+
+def main(n=100_000, queries=2_000, batch=10_000):
+    rng = np.random.default_rng(0)
+    start = time.perf_counter()
+    index = SpatialIndex(np.arange(n), *random_points(n, rng))
+    print(f"built index over {n} points in {time.perf_counter() - start:.3f}s")
+
+    print(f"{'query':>18} {'qps':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    latitudes, longitudes = random_points(queries, rng)
+    single = {
+        'nearest k=5': lambda index, lat, lon: index.batch_nearest([lat], [lon], 5),
+        'within 500 m': lambda index, lat, lon: index.batch_within([lat], [lon], 500),
+    }
+    for name, query in single.items():
+        latencies = single_query_latencies(index, latitudes, longitudes, query)
+        print(f"{name:>18} {len(latencies) / latencies.sum():>10.0f} "
+              f"{np.percentile(latencies, 50) * 1e3:>8.3f} {np.percentile(latencies, 99) * 1e3:>8.3f}")
+
+    latitudes, longitudes = random_points(batch, rng)
+    batched = {
+        'batch nearest k=5': lambda: index.batch_nearest(latitudes, longitudes, 5),
+        'batch within 500 m': lambda: index.batch_within(latitudes, longitudes, 500),
+    }
+    for name, query in batched.items():
+        start = time.perf_counter()
+        query()
+        elapsed = time.perf_counter() - start
+        print(f"{name:>18} {batch / elapsed:>10.0f} {'':>8} {'':>8}")
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
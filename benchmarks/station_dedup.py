@@ -0,0 +1,49 @@
+# Reports the time of each step of scripts/station_dedup, the candidate pairs the grid
+# blocking leaves and how well the canonical ids recover the planted duplicates, on
+# synthetic stations of growing size. Run from the repository root with:
+# python -m benchmarks.station_dedup
+import sys
+import time
+
+import numpy as np
+
+from scripts import station_dedup
+from benchmarks.synthetic import duplicated_stations
+
+
+SIZES = [1_000, 10_000, 100_000]
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def report(n):
+    stations, truth = duplicated_stations(n)
+    names, normalize = timed(station_dedup.normalized_names, stations['name'])
+    signatures, minhash = timed(station_dedup.minhash_signatures, names.tolist())
+    (first, _, _), blocking = timed(station_dedup.candidate_pairs, stations['latitude'].to_numpy(),
+                                    stations['longitude'].to_numpy())
+    (mapping, pairs), total = timed(station_dedup.canonical_ids, stations)
+
+    canonical = mapping['canonical_id'].to_numpy()
+    merged = canonical != mapping['station_id'].to_numpy()
+    planted = truth != np.arange(n)
+    precision = (canonical[merged] == truth[merged]).mean() if merged.any() else 1.0
+    recall = (canonical[planted] == truth[planted]).mean() if planted.any() else 1.0
+    print(f"{n:>8} {normalize:>9.3f} {minhash:>9.3f} {blocking:>9.3f} {total:>9.3f} "
+          f"{len(first):>11} {n * (n - 1) // 2:>14} {len(pairs):>8} {precision:>9.4f} {recall:>7.4f}")
+
+
+def main(*sizes):
+    print(f"{'stations':>8} {'normalize':>9} {'minhash':>9} {'blocking':>9} {'total s':>9} "
+          f"{'candidates':>11} {'all pairs':>14} {'matched':>8} {'precision':>9} {'recall':>7}")
+    for n in sizes or SIZES:
+        report(n)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*[int(arg) for arg in sys.argv[1:]]))
@@ -0,0 +1,30 @@
+# Compares file size and load time of the csv and parquet intermediates written by
+# scripts/storage. Run from the repository root with: python -m benchmarks.storage_formats
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+from scripts import storage
+from benchmarks.synthetic import cleansed_stations
+
+
+def main(n=200_000):
+    with tempfile.TemporaryDirectory() as directory:
+        storage.write_table(cleansed_stations(n), 'stations', directory)
+        print(f"{'format':>8} {'MB':>8} {'read s':>8}")
+        for extension in ['csv', 'parquet']:
+            path = storage.table_path('stations', extension, directory)
+            start = time.perf_counter()
+            if extension == 'csv':
+                pd.read_csv(path, dtype=storage.SCHEMAS['stations'])
+            else:
+                pd.read_parquet(path)
+            elapsed = time.perf_counter() - start
+            print(f"{extension:>8} {os.path.getsize(path) / 2**20:>8.2f} {elapsed:>8.3f}")
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,43 @@
+# Checks that the paged Supabase diff keeps peak memory flat as the remote table
+# grows, and that a PostgREST max-rows cap does not truncate the scan.
+# Run from the repository root with: python -m benchmarks.supabase_reads
+import time
+import tracemalloc
+
+from supabase import create_client
+
+from scripts.load_supabase import fetch_pages, to_records
+from scripts.table_diff import diff_table_pages
+from benchmarks.postgrest_stub import PostgrestStub
+from benchmarks.supabase_writes import FAKE_KEY
+from benchmarks.synthetic import cleansed_stations, perturb
+
+
+def measure(n, page_size, max_rows):
+    local = cleansed_stations(n)
+    remote = to_records(perturb(local, 'station_id'))
+    columns = [column for column in local.columns if column != 'station_id']
+    with PostgrestStub({'stations': 'station_id'}, {'stations': remote}, max_rows=max_rows) as stub:
+        supabase = create_client(stub.url, FAKE_KEY)
+        tracemalloc.start()
+        start = time.perf_counter()
+        diff = diff_table_pages(local, fetch_pages(supabase, 'stations', 'station_id', columns, page_size),
+                                'station_id', columns)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        expected_deleted = len(remote) - (len(local) - len(diff.inserted))
+        assert len(diff.deleted) == expected_deleted, 'remote scan was truncated'
+        return elapsed, peak, stub.requests['GET']
+
+
+def main():
+    print(f"{'rows':>8} {'page':>6} {'max_rows':>9} {'requests':>9} {'seconds':>8} {'peak MB':>8}")
+    for n in [10_000, 50_000]:
+        for page_size, max_rows in [(1000, None), (5000, 1000)]:
+            elapsed, peak, requests = measure(n, page_size, max_rows)
+            print(f"{n:>8} {page_size:>6} {str(max_rows):>9} {requests:>9} {elapsed:>8.2f} {peak / 2**20:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+# Measures round-trips and rows/sec of load_supabase.sync_table against a local
+# PostgREST stub. Run from the repository root with: python -m benchmarks.supabase_writes
+import sys
+
+from supabase import create_client
+
+from scripts.load_supabase import sync_table, to_records
+from benchmarks.postgrest_stub import PostgrestStub
+from benchmarks.synthetic import cleansed_stations, perturb
+
+
+# supabase-py only checks the key's shape, the stub ignores it
+FAKE_KEY = 'eyJhbGciOiJIUzI1NiJ9.e30.c3R1Yg'
+
+
+def run_sync(n, chunk_size, max_workers, latency):
+    local = cleansed_stations(n)
+    remote = perturb(local, 'station_id')
+    with PostgrestStub({'stations': 'station_id'}, {'stations': to_records(remote)}, latency=latency) as stub:
+        supabase = create_client(stub.url, FAKE_KEY)
+        stats = sync_table(supabase, 'stations', local, 'station_id', chunk_size, max_workers)
+        assert len(stub.rows('stations')) == len(local)
+        return stats, sum(stub.requests.values())
+
+
+def main(n=20_000, latency=0.02):
+    print(f"{'chunk':>6} {'workers':>8} {'round-trips':>12} {'seconds':>9} {'rows/s':>10}")
+    for chunk_size, max_workers in [(1, 1), (100, 1), (500, 1), (500, 4), (500, 8)]:
+        stats, round_trips = run_sync(n, chunk_size, max_workers, latency)
+        print(f"{chunk_size:>6} {max_workers:>8} {round_trips:>12} "
+              f"{stats['seconds']:>9.3f} {stats['rows_per_second']:>10.0f}")
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,221 @@
+import random
+from types import SimpleNamespace
+
+
+# Bounding box around the Klang Valley, used to scatter synthetic coordinates
+KL_BOUNDS = (101.4, 2.8, 101.9, 3.4)
+
+
+def overpass_entrance_nodes(n, seed=0):
+    # Stand-ins for overpy.Node objects returned by the entrance query
+    rng = random.Random(seed)
+    min_lon, min_lat, max_lon, max_lat = KL_BOUNDS
+    nodes = []
+    for i in range(n):
+        tags = {'railway': 'subway_entrance'}
+        if rng.random() < 0.5:
+            tags['ref'] = rng.choice('ABCDEFGH')
+        if rng.random() < 0.2:
+            tags['destination'] = f'Destination {i}'
+        nodes.append(SimpleNamespace(
+            id=1_000_000_000 + i,
+            lon=rng.uniform(min_lon, max_lon),
+            lat=rng.uniform(min_lat, max_lat),
+            tags=tags,
+        ))
+    return nodes
+
+
+def overpass_station_relations(n_entrances, members_per_relation=6, seed=0):
+    # Stand-ins for overpy.Relation objects returned by the public_transport query.
+    # Roughly half the members of each relation are entrances, the rest are
+    # platforms and stop positions that must be filtered out.
+    rng = random.Random(seed)
+    relations = []
+    n_relations = max(1, n_entrances // (members_per_relation // 2))
+    for i in range(n_relations):
+        members = []
+        for _ in range(members_per_relation):
+            if rng.random() < 0.5:
+                ref = 1_000_000_000 + rng.randrange(n_entrances)
+            else:
+                ref = 5_000_000_000 + rng.randrange(n_entrances * 10)
+            members.append(SimpleNamespace(ref=ref))
+        relations.append(SimpleNamespace(
+            tags={'ref': f'ST{i}', 'name': f'Station {i}'},
+            members=members,
+        ))
+    return relations
+
+
+def cleansed_stations(n, seed=0):
+    # Rows shaped like data_cleansed/combined_stations_cleansed.csv
+    import pandas as pd
+
+    rng = random.Random(seed)
+    min_lon, min_lat, max_lon, max_lat = KL_BOUNDS
+    lines = [('KJ', 'Kelana Jaya Line', 'Red', '#E0115F'), ('SP', 'Sri Petaling Line', 'Brown', '#8B4513'),
+             ('AG', 'Ampang Line', 'Orange', '#FF8E10'), ('KG', 'Kajang Line', 'Green', '#047940')]
+    rows = []
+    for i in range(n):
+        route_id, route_name, colour, hex_code = lines[i % len(lines)]
+        rows.append({
+            'station_id': i,
+            'name': f'Station {i}',
+            'station_code': f'{route_id}{i}',
+            'service_provider_name': 'Rapid Rail',
+            'latitude': round(rng.uniform(min_lat, max_lat), 7),
+            'longitude': round(rng.uniform(min_lon, max_lon), 7),
+            'route_id': route_id,
+            'route_name': route_name,
+            'line_number': str(i % len(lines) + 1),
+            'line_colour': colour,
+            'colour_hex_code': hex_code,
+            'region': 'Klang Valley',
+        })
+    return pd.DataFrame(rows)
+
+
+def transit_network(lines, stations_per_line, interchanges=0.1, seed=0):
+    # Stations, entrances and their relations for lines that wander across the Klang
+    # Valley a kilometre or so per stop. A share of the stations take the name of a
+    # station on another line, making them interchanges, and every station has one
+    # entrance next to it.
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    min_lon, min_lat, max_lon, max_lat = KL_BOUNDS
+    n = lines * stations_per_line
+    line = np.repeat(np.arange(lines), stations_per_line)
+    starts = np.column_stack([rng.uniform(min_lat, max_lat, lines), rng.uniform(min_lon, max_lon, lines)])
+    steps = rng.normal(0, 0.008, (lines, stations_per_line, 2))
+    steps[:, 0] = starts
+    positions = steps.cumsum(axis=1).reshape(n, 2)
+    # Three letter code prefixes: AAA, AAB, ...
+    prefixes = np.array([''.join(chr(65 + i // 26 ** power % 26) for power in (2, 1, 0)) for i in range(lines)])
+    names = np.array([f'Station {i}' for i in range(n)], dtype=object)
+    shared = rng.random(n) < interchanges
+    names[shared] = names[rng.integers(0, n, shared.sum())]
+    stations = pd.DataFrame({
+        'station_id': np.arange(n),
+        'name': pd.array(names, dtype='string'),
+        'station_code': pd.array(prefixes[line] + (np.arange(n) % stations_per_line + 1).astype(str), dtype='string'),
+        'route_name': pd.array([f'Line {i}' for i in line], dtype='string'),
+        'region': 'Klang Valley',
+        'latitude': positions[:, 0],
+        'longitude': positions[:, 1],
+    })
+    entrances = pd.DataFrame({'entrance_id': np.arange(n), 'latitude': positions[:, 0] + rng.normal(0, 2e-4, n),
+                              'longitude': positions[:, 1] + rng.normal(0, 2e-4, n)})
+    station_entrances = pd.DataFrame({'relationship_id': np.arange(n), 'entrance_id': np.arange(n),
+                                      'station_code': stations['station_code']})
+    return stations, entrances, station_entrances
+
+
+# Bounding boxes of the other cities, for data spread across all three
+SINGAPORE_BOUNDS = (103.6, 1.25, 104.0, 1.45)
+MONTREAL_BOUNDS = (-73.75, 45.42, -73.5, 45.6)
+SYLLABLES = ['ba', 'da', 'ja', 'ka', 'la', 'ma', 'na', 'pa', 'ra', 'sa', 'ta', 'wa', 'ban', 'dar', 'kam',
+             'lem', 'pun', 'sen', 'tul', 'mont', 'ville', 'jean', 'ang', 'kit', 'pong', 'ser', 'gai', 'bu']
+
+
+def duplicated_stations(n, duplicates=0.2, seed=0):
+    # n stations of made-up names across the three cities, of which a share are filed
+    # again under another id the way a second line or source files them: a few dozen
+    # metres away, with a station-type suffix, a hyphen or other case. Returns the
+    # stations and, per station_id, the station_id it duplicates or its own.
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    unique = n - int(n * duplicates)
+    words = np.array([''.join(rng.choice(SYLLABLES, rng.integers(2, 4))).capitalize() for _ in range(unique * 2)])
+    names = pd.Series(words[:unique]) + np.where(rng.random(unique) < 0.5, ' ' + pd.Series(words[unique:]), '')
+    cities = rng.integers(0, 3, unique)
+    latitudes, longitudes = np.empty(unique), np.empty(unique)
+    for city, (min_lon, min_lat, max_lon, max_lat) in enumerate([KL_BOUNDS, SINGAPORE_BOUNDS, MONTREAL_BOUNDS]):
+        in_city = cities == city
+        latitudes[in_city] = rng.uniform(min_lat, max_lat, in_city.sum())
+        longitudes[in_city] = rng.uniform(min_lon, max_lon, in_city.sum())
+
+    original = rng.integers(0, unique, n - unique)
+    variants = names[original].reset_index(drop=True)
+    kind = rng.integers(0, 3, len(original))
+    variants[kind == 0] = variants[kind == 0] + ' MRT Station'
+    variants[kind == 1] = variants[kind == 1].str.replace(' ', '-')
+    variants[kind == 2] = variants[kind == 2].str.upper()
+    # Roughly 50 m apart, as platforms of different lines
+    jitter = rng.normal(0, 3e-4, (len(original), 2))
+    stations = pd.DataFrame({
+        'station_id': np.arange(n),
+        'name': pd.array(pd.concat([names, variants], ignore_index=True), dtype='string'),
+        'latitude': np.concatenate([latitudes, latitudes[original] + jitter[:, 0]]),
+        'longitude': np.concatenate([longitudes, longitudes[original] + jitter[:, 1]]),
+    })
+    return stations, np.concatenate([np.arange(unique), original])
+
+
+def perturb(df, key, changed=0.05, removed=0.02, added=0.02, seed=0):
+    # Derive a "remote" copy of df that differs by a share of updated, missing and extra rows
+    import pandas as pd
+
+    rng = random.Random(seed)
+    remote = df.copy()
+    n = len(df)
+    updated = rng.sample(range(n), int(n * changed))
+    remote.loc[remote.index[updated], 'name'] = remote.loc[remote.index[updated], 'name'] + ' (old)'
+    remote = remote.drop(index=remote.index[rng.sample(range(n), int(n * removed))])
+    extra = df.sample(n=int(n * added), random_state=seed).copy()
+    extra[key] = extra[key] + df[key].max() + 1
+    return pd.concat([remote, extra], ignore_index=True)
+
+
+# How to make copies of each raw csv under data/ distinct: id columns are offset by a
+# power of ten, code columns (';' separated lists included) and name columns get a
+# copy suffix, and coordinates are jittered by a few metres
+RAW_FILES = {
+    'klang_valley_stations.csv': dict(codes=['Stop ID'], names=['Name']),
+    'montreal_metro.csv': dict(ids=['Index'], codes=[' Stop ID'], names=['Name']),
+    'mrtsg.csv': dict(ids=['OBJECTID'], codes=['STN_NO'], names=['Name']),
+    'klang_valley_entrances.csv': dict(ids=['Entrance ID']),
+    'klang_valley_stations_entrances_relation.csv': dict(ids=['Relationship ID', 'Entrance ID'],
+                                                         codes=['Station Code'], names=['Station Name']),
+}
+
+
+def scaled_raw_csv(path, n, ids=(), codes=(), names=(), seed=0):
+    # Whole copies of the raw csv at path, at least n rows. Copy 0 is the original data,
+    # and copy k of the relations file refers to copy k of the entrances; whole copies
+    # keep every such reference present, the relations file being the longer of the two.
+    import numpy as np
+    import pandas as pd
+
+    original = pd.read_csv(path)
+    copies = -(-n // len(original))
+    df = pd.concat([original] * copies, ignore_index=True)
+    copy = np.repeat(np.arange(copies), len(original))
+    suffix = pd.Series(np.where(copy > 0, '.' + copy.astype(str), ''), index=df.index)
+    for column in ids:
+        # A power of ten past the largest id, so the entrance ids of the entrances and
+        # relations files are offset alike
+        df[column] = df[column] + copy * 10 ** len(str(original[column].max()))
+    for column in codes:
+        df[column] = (df[column].astype(str).str.split(';').explode() + suffix).groupby(level=0).agg(';'.join)
+    for column in names:
+        df[column] = df[column] + suffix.str.replace('.', ' ', regex=False)
+    rng = np.random.default_rng(seed)
+    for column in ['Latitude', 'Longitude']:
+        if column in df.columns:
+            df[column] = df[column] + np.where(copy > 0, rng.normal(0, 0.0005, len(df)), 0.0)
+    return df
+
+
+def write_raw_data(directory, n, source_directory='data', seed=0):
+    # Every raw input of the pipeline scaled to about n rows, written to directory/data
+    import os
+
+    os.makedirs(os.path.join(directory, 'data'), exist_ok=True)
+    for file, columns in RAW_FILES.items():
+        df = scaled_raw_csv(os.path.join(source_directory, file), n, seed=seed, **columns)
+        df.to_csv(os.path.join(directory, 'data', file), index=False)
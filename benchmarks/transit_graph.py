@@ -0,0 +1,76 @@
+# Reports build time, saved size and query latency percentiles of scripts/transit_graph
+# on the cleansed network and on synthetic networks of growing size. Run from the
+# repository root with: python -m benchmarks.transit_graph
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from scripts import storage
+from scripts.transit_graph import TransitGraph
+from benchmarks.synthetic import transit_network
+
+
+# (lines, stations per line) of the synthetic networks
+NETWORKS = [(20, 50), (100, 100), (200, 250)]
+
+
+def latencies(query, arguments):
+    times = np.empty(len(arguments))
+    for i, argument in enumerate(arguments):
+        start = time.perf_counter()
+        query(*argument)
+        times[i] = time.perf_counter() - start
+    return times
+
+
+def report(name, graph, queries, rng):
+    station_ids = graph.nodes['station_id'].to_numpy()
+    pairs = [tuple(int(station_id) for station_id in rng.choice(station_ids, 2)) for _ in range(queries)]
+    sources = [(int(station_id),) for station_id in rng.choice(station_ids, queries)]
+    single = {
+        'fastest path': lambda source, target: graph.shortest_path(source, target),
+        'fewest transfers path': lambda source, target: graph.shortest_path(source, target, True),
+        'transfers between': graph.transfers_between,
+    }
+    for query, run in single.items():
+        times = latencies(run, pairs)
+        print(f"{name:>18} {query:>24} {np.percentile(times, 50) * 1e3:>9.3f} {np.percentile(times, 99) * 1e3:>9.3f}")
+    times = latencies(lambda source: graph.reachable(source, max_minutes=30, max_transfers=1), sources)
+    print(f"{name:>18} {'reachable 30 min 1 xfer':>24} "
+          f"{np.percentile(times, 50) * 1e3:>9.3f} {np.percentile(times, 99) * 1e3:>9.3f}")
+
+
+def build(name, tables, directory):
+    start = time.perf_counter()
+    graph = TransitGraph.build(*tables)
+    built = time.perf_counter() - start
+    path = os.path.join(directory, f'{name}.npz')
+    graph.save(path)
+    start = time.perf_counter()
+    graph = TransitGraph.load(path)
+    print(f"{name}: {graph.size} nodes, {len(graph.indices)} directed edges, built in {built:.3f}s, "
+          f"{os.path.getsize(path) / 2**20:.2f} MB saved, loaded in {time.perf_counter() - start:.3f}s, "
+          f"transfer matrix {'precomputed' if graph.transfers is not None else 'per query'}")
+    return graph
+
+
+def main(queries=100):
+    rng = np.random.default_rng(0)
+    networks = {'cleansed': [storage.read_table(table) for table in ['stations', 'entrances', 'station_entrances']]}
+    networks.update({f'{lines}x{stations}': transit_network(lines, stations) for lines, stations in NETWORKS})
+    graphs = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, tables in networks.items():
+            graphs[name] = build(name, tables, directory)
+
+    print(f"{'network':>18} {'query':>24} {'p50 ms':>9} {'p99 ms':>9}")
+    for name, graph in graphs.items():
+        report(name, graph, queries, rng)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+import argparse
+import json
+import logging
+import os
+import sys
+
+import pandas as pd
+from supabase import create_client
+
+from scripts import batch_jobs
+from scripts import metrics
+from scripts import storage
+from scripts.isochrones import DEFAULT_REQUESTS_PER_MINUTE
+from scripts.load_sql import DATABASE
+from scripts.load_supabase import fetch_pages
+from scripts.station_isochrones import ENTRANCE_ISOCHRONE_COLUMNS
+
+
+# Batch jobs that used to live in notebooks, resumable through a journal per job:
+#   python jobs.py entrances    walking isochrones of every entrance (6_entrance-isochrone-generation)
+#   python jobs.py stations     station isochrones from their entrances (7_station-isochrone-generation)
+#   python jobs.py map          a folium map per region (0_mapping-stations)
+# The ORS key comes from ORS_KEY and Supabase from SUPABASE_URL and SUPABASE_SERVICE_KEY.
+# With --output the isochrones go to a JSON Lines file instead of Supabase, and with
+# --replay every ORS response comes from recorded fixtures, which is how CI runs them.
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('job', choices=batch_jobs.JOBS)
+    parser.add_argument('--region', help='region of the stations or map job')
+    parser.add_argument('--limit', type=int, help='only the first LIMIT items, by id')
+    parser.add_argument('--workers', type=int, default=batch_jobs.DEFAULT_WORKERS)
+    parser.add_argument('--shard-size', type=int, default=batch_jobs.DEFAULT_SHARD_SIZE)
+    parser.add_argument('--requests-per-minute', type=float, default=DEFAULT_REQUESTS_PER_MINUTE,
+                        help='ORS request budget shared by all workers')
+    parser.add_argument('--ors-url', help='ORS base url, for a self-hosted instance')
+    fixtures = parser.add_mutually_exclusive_group()
+    fixtures.add_argument('--replay', metavar='DIRECTORY', nargs='?', const=batch_jobs.FIXTURES_DIRECTORY,
+                          help='answer every ORS request from recorded fixtures')
+    fixtures.add_argument('--record', metavar='DIRECTORY', nargs='?', const=batch_jobs.FIXTURES_DIRECTORY,
+                          help='record the ORS responses as fixtures')
+    parser.add_argument('--output', help='JSON Lines file to append the isochrones to instead of Supabase')
+    parser.add_argument('--entrance-isochrones',
+                        help='entrances job --output to build station isochrones from instead of Supabase')
+    parser.add_argument('--database', default=DATABASE)
+    parser.add_argument('--data-directory', default=storage.cleansed_data_directory,
+                        help=f'directory of the cleansed tables, {batch_jobs.FIXTURE_DATA_DIRECTORY} for the CI replay')
+    parser.add_argument('--map-directory', default=batch_jobs.DEFAULT_MAP_DIRECTORY)
+    parser.add_argument('--journal-directory', default=batch_jobs.DEFAULT_JOURNAL_DIRECTORY)
+    parser.add_argument('--restart', action='store_true', help='forget the journal and run every item')
+    parser.add_argument('--report', default=batch_jobs.DEFAULT_REPORT, help='path of the json run report')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    options = batch_jobs.job_options(os.environ.get('ORS_KEY'), args.ors_url, args.replay, args.record,
+                                     args.requests_per_minute, args.database, args.map_directory)
+    if args.job != 'map' and not (args.replay or options['ors_key'] or args.ors_url):
+        parser.error('set ORS_KEY, or pass --replay or --ors-url')
+
+    supabase = None
+    if args.job != 'map' and not (args.output and (args.job == 'entrances' or args.entrance_isochrones)):
+        try:
+            supabase = create_client(os.environ['SUPABASE_URL'], os.environ['SUPABASE_SERVICE_KEY'])
+        except KeyError:
+            parser.error('set SUPABASE_URL and SUPABASE_SERVICE_KEY, or pass --output '
+                         '(and --entrance-isochrones for the stations job)')
+
+    items = batch_jobs.job_items(args.job, args.region, args.database, args.data_directory)
+    key = batch_jobs.SHARDS[args.job][0]
+    if args.limit:
+        items = items.sort_values(key).head(args.limit)
+
+    sink = None
+    if args.job == 'stations':
+        options['station_entrances'] = storage.read_table('station_entrances', args.data_directory)
+        if args.entrance_isochrones:
+            entrance_isochrones = batch_jobs.read_records(args.entrance_isochrones)
+        else:
+            entrance_isochrones = pd.concat(list(fetch_pages(supabase, 'entrances_isochrones', 'isochrone_id',
+                                                             ENTRANCE_ISOCHRONE_COLUMNS)), ignore_index=True)
+        entrance_isochrones['entrance_id'] = entrance_isochrones['entrance_id'].astype(int)
+        options['entrance_isochrones'] = entrance_isochrones
+    if args.job != 'map':
+        table = 'entrances_isochrones' if args.job == 'entrances' else 'station_isochrones'
+        sink = (batch_jobs.FileSink(args.output) if args.output
+                else batch_jobs.SupabaseSink(supabase, table, 'isochrone_id'))
+
+    journal = batch_jobs.Journal(os.path.join(args.journal_directory, f'{args.job}.jsonl'),
+                                 batch_jobs.fingerprint(args.job, options, args.region))
+    if args.restart:
+        journal.clear()
+    try:
+        summary = batch_jobs.run_job(args.job, items, options, journal, sink, args.shard_size, args.workers)
+    finally:
+        metrics.write_report(args.report, None)
+    print(json.dumps(summary))
+    sys.exit(1 if summary['failed'] else 0)
@@ -1,3 +1,4 @@
+import argparse
 import logging
 import logging.handlers
 import os
@@ -5,10 +6,20 @@ import supabase
 
 import requests
 from scripts import station_data_cleanse
+from scripts import data_context
 from scripts import entrances_query
 from scripts import entrances_data_cleanse
 from scripts import load_sql
 from scripts import load_supabase
+from scripts import metrics
+from scripts import validation
+from scripts import transit_graph
+from scripts import station_dedup
+from scripts import station_isochrones
+from scripts import vector_tiles
+from scripts import pipeline
+from scripts.pipeline import Stage
+from scripts.city_sources import CITY_SOURCES
 
 
 
@@ -24,6 +35,11 @@ formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(messag
 logger_file_handler.setFormatter(formatter)
 logger.addHandler(logger_file_handler)
 
+# Stage timings and progress from the scripts package go to the same log
+scripts_logger = logging.getLogger('scripts')
+scripts_logger.setLevel(logging.INFO)
+scripts_logger.addHandler(logger_file_handler)
+
 try:
     #SOME_SECRET = os.environ["SOME_SECRET"]
     url: str = os.environ["SUPABASE_URL"]
@@ -36,24 +52,80 @@ except KeyError:
     #raise
 
 
+CLEANSED_STATIONS = 'data_cleansed/combined_stations_cleansed.csv'
+
+RAW_ENTRANCES = [
+    'data/klang_valley_entrances.csv',
+    'data/klang_valley_stations_entrances_relation.csv',
+]
+CLEANSED_ENTRANCES = [
+    'data_cleansed/klang_valley_entrances_cleansed.csv',
+    'data_cleansed/klang_valley_stations_entrances_relation_cleansed.csv',
+]
+STATION_CANONICAL_IDS = 'data_cleansed/station_canonical_ids.csv'
+
+
+def build_stages(url, key, context):
+    # The validation, graph and load stages share context: each cleansed table is parsed
+    # once for all of them, and the loads reuse one sqlite connection and HTTP session
+    return [
+        # Every registered city is cleansed in parallel inside this stage
+        Stage('station_data_cleanse', station_data_cleanse.run,
+              inputs=[os.path.join('data', source.file) for source in CITY_SOURCES],
+              outputs=[os.path.join('data_cleansed', source.cleansed_file) for source in CITY_SOURCES]
+              + [CLEANSED_STATIONS]),
+        # The Overpass query reads from the network, so it runs every time
+        Stage('entrances_query', entrances_query.run, outputs=RAW_ENTRANCES, always=True),
+        Stage('entrances_data_cleanse', entrances_data_cleanse.run,
+              inputs=RAW_ENTRANCES, outputs=CLEANSED_ENTRANCES),
+        # Critical validation failures fail this stage, so neither load starts
+        Stage('validate', lambda: validation.run(context=context),
+              inputs=[CLEANSED_STATIONS] + CLEANSED_ENTRANCES, outputs=[validation.VALIDATION_REPORT]),
+        Stage('load_sql', lambda: load_sql.run(context=context),
+              inputs=[CLEANSED_STATIONS] + CLEANSED_ENTRANCES, outputs=['transit_database.db'], after=['validate']),
+        # The network graph with its all-pairs transfer counts, saved next to the database
+        Stage('transit_graph', lambda: transit_graph.run(context=context),
+              inputs=[CLEANSED_STATIONS] + CLEANSED_ENTRANCES, outputs=[transit_graph.GRAPH], after=['validate']),
+        # One canonical station_id per physical station, for stations filed once per line
+        Stage('station_dedup', lambda: station_dedup.run(context=context),
+              inputs=[CLEANSED_STATIONS], outputs=[STATION_CANONICAL_IDS], after=['validate']),
+        # Station isochrones are built by the batch jobs into Supabase, so they are copied
+        # into their own sqlite file every run, for the query service and the isochrone tiles
+        Stage('isochrones_sql', lambda: station_isochrones.run_sql(url, key, context=context),
+              outputs=[load_sql.ISOCHRONE_DATABASE], always=True),
+        # Map tiles replace the inlined folium html; only tiles whose features changed are rendered
+        Stage('vector_tiles', vector_tiles.run, inputs=['transit_database.db', load_sql.ISOCHRONE_DATABASE],
+              outputs=[vector_tiles.MBTILES]),
+        # Supabase is brought up to the sqlite changelog, so it follows load_sql
+        Stage('load_supabase', lambda: load_supabase.run(url, key, context=context),
+              inputs=[CLEANSED_STATIONS] + CLEANSED_ENTRANCES, after=['validate', 'load_sql']),
+    ]
+
 
 if __name__ == "__main__":
-    
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--force', action='store_true', help='run every stage even if its inputs are unchanged')
+    parser.add_argument('--workers', type=int, default=4, help='number of stages that may run at once')
+    parser.add_argument('--profile', choices=metrics.PROFILE_MODES,
+                        help='keep a cProfile dump (cpu) or tracemalloc peak (memory) of every stage')
+    parser.add_argument('--report', default=metrics.DEFAULT_REPORT, help='path of the json run report')
+    parser.add_argument('--textfile', default=metrics.DEFAULT_TEXTFILE,
+                        help='path of the Prometheus textfile written next to the report')
+    args = parser.parse_args()
+    metrics.enable_profiling(args.profile)
+
     #logger.info(f"Token value: {SOME_SECRET}")
-    logger.info("Running station data cleansing process")
-    station_data_cleanse.run()    
-    logger.info("Running entrance data query process")
-    entrances_query.run()
-    logger.info("Running entrance data cleansing process")
-    entrances_data_cleanse.run()
-    logger.info("Loading CSV data into SQLite")
-    load_sql.run()
-    logger.info("Loading CSV data into Supabase")
-    load_supabase.run(url,key)
+    logger.info("Running transit database pipeline")
+    try:
+        with data_context.DataContext() as context:
+            pipeline.run(build_stages(url, key, context), max_workers=args.workers, force=args.force)
+    finally:
+        # Written for failed runs too, so nightly trends show where a run stopped
+        metrics.write_report(args.report, args.textfile)
 
 
     ##r = requests.get('https://weather.talkpython.fm/api/weather/?city=Berlin&country=DE')
     ##if r.status_code == 200:
     #    data = r.json()
      #   temperature = data["forecast"]["temp"]
-     #   logger.info(f'Weather in Berlin: {temperature}')
\ No newline at end of file
+     #   logger.info(f'Weather in Berlin: {temperature}')
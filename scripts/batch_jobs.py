@@ -0,0 +1,348 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import html
+import json
+import logging
+import os
+import sqlite3
+import time
+
+import folium
+from openrouteservice import client as ors
+import pandas as pd
+import shapely
+from shapely.geometry import shape
+
+from scripts import metrics
+from scripts import station_isochrones
+from scripts import storage
+from scripts.geometry_store import compact_geometry
+from scripts.isochrones import (DEFAULT_CACHE_DIRECTORY, DEFAULT_REQUESTS_PER_MINUTE, WALKING_PARAMETERS,
+                                IsochroneCache, fetch_isochrones)
+from scripts.load_sql import DATABASE
+from scripts.pipeline import process_context
+from scripts.supabase_writer import write_changes
+
+
+logger = logging.getLogger(__name__)
+
+JOBS = ('entrances', 'stations', 'map')
+DEFAULT_JOURNAL_DIRECTORY = '.jobs'
+DEFAULT_MAP_DIRECTORY = 'maps'
+DEFAULT_REPORT = 'job_report.json'
+DEFAULT_SHARD_SIZE = 20
+DEFAULT_WORKERS = 4
+# ORS responses recorded for the CI replay, stored as an isochrone cache directory
+FIXTURES_DIRECTORY = 'fixtures/ors'
+# The cleansed tables the fixtures were recorded for. The nightly run rewrites
+# data_cleansed/, so replays read these instead and stay independent of it.
+FIXTURE_DATA_DIRECTORY = 'fixtures/ors_inputs'
+DEFAULT_REGION = 'Klang Valley'
+
+
+def _digest(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class Journal:
+    # Append-only JSON Lines checkpoint of one job: a line per finished shard with the
+    # items it completed and those that failed. A rerun skips the completed items and
+    # retries the failed ones. Lines written under another fingerprint (other
+    # parameters or inputs) are ignored, so changing those starts the job over.
+
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+
+    def completed(self):
+        done = set()
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line of a run killed while writing it
+                    continue
+                if entry['fingerprint'] == self.fingerprint:
+                    done.update(entry['done'])
+        return done
+
+    def record(self, shard, done, failed):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        entry = {'fingerprint': self.fingerprint, 'shard': shard, 'done': done, 'failed': failed,
+                 'finished': time.time()}
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class MissingFixture(Exception):
+    pass
+
+
+class ReplayClient:
+    # Stands in for the ORS client when every response has to come from the recorded
+    # fixtures: a request only reaches it for a location that was never recorded
+
+    def isochrones(self, locations, **parameters):
+        raise MissingFixture(f"No recorded ORS response for {len(locations)} locations; "
+                             f"record them with --record")
+
+
+class FileSink:
+    # Appends records as JSON Lines; a reader keeps the last record of each key
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, records):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record, default=str) + '\n')
+
+
+class SupabaseSink:
+
+    def __init__(self, supabase, table, key):
+        self.supabase = supabase
+        self.table = table
+        self.key = key
+
+    def write(self, records):
+        write_changes(self.supabase, self.table, self.key, records, [])
+
+
+def read_records(path, key='isochrone_id'):
+    # Records written by FileSink, last one per key, with WKT geometries parsed
+    with open(path) as f:
+        records = pd.DataFrame([json.loads(line) for line in f if line.strip()])
+    records = records.drop_duplicates(key, keep='last').reset_index(drop=True)
+    records['geometry'] = shapely.from_wkt(records['geometry'].to_numpy())
+    return records
+
+
+def ors_client(options):
+    if options['replay']:
+        return ReplayClient()
+    kwargs = {'key': options['ors_key'], 'retry_over_query_limit': False}
+    if options['ors_url']:
+        kwargs['base_url'] = options['ors_url']
+    return ors.Client(**kwargs)
+
+
+def entrance_records(entrance_id, isochrone):
+    # Rows of the entrances_isochrones table, one per band
+    records = []
+    for feature in isochrone['features']:
+        geometry = compact_geometry(shape(feature['geometry']))
+        properties = feature['properties']
+        records.append({
+            'value': properties['value'],
+            'center': properties.get('center'),
+            'area': float(properties.get('area', 0)),
+            'reachfactor': float(properties.get('reachfactor', 0)),
+            'total_pop': float(properties.get('total_pop', 0)),
+            'geometry': geometry.wkt,
+            'entrance_id': entrance_id,
+            'isochrone_id': f'{entrance_id}{int(properties["value"])}',
+        })
+    return records
+
+
+def entrance_shard(options, rows):
+    locations = [[float(longitude), float(latitude)] for longitude, latitude in zip(rows['longitude'], rows['latitude'])]
+    isochrones = fetch_isochrones(ors_client(options), locations, WALKING_PARAMETERS,
+                                  cache=IsochroneCache(options['cache_directory']), max_workers=1,
+                                  requests_per_minute=options['requests_per_minute'])
+    records, done, failed = [], [], []
+    for entrance_id, isochrone in zip(rows['entrance_id'].tolist(), isochrones):
+        if isochrone is None:
+            failed.append(entrance_id)
+        else:
+            records += entrance_records(entrance_id, isochrone)
+            done.append(entrance_id)
+    return records, done, failed
+
+
+def station_shard(options, rows):
+    # Stations with entrance isochrones are their union, the rest come from ORS
+    records, index = station_isochrones.build(
+        rows, options['station_entrances'], options['entrance_isochrones'], ors_client(options), {},
+        max_workers=1, cache=IsochroneCache(options['cache_directory']),
+        requests_per_minute=options['requests_per_minute'])
+    built = {int(station_id) for station_id in index}
+    station_ids = rows['station_id'].tolist()
+    return records, [s for s in station_ids if s in built], [s for s in station_ids if s not in built]
+
+
+def render_map(database, region, path):
+    # The stations of a region coloured by line, with their entrances, as a folium page
+    conn = sqlite3.connect(f'file:{database}?mode=ro', uri=True)
+    try:
+        stations = pd.read_sql('SELECT name, station_code, route_name, colour_hex_code, latitude, longitude '
+                               'FROM stations WHERE region = ?', conn, params=[region])
+        entrances = pd.read_sql('SELECT DISTINCT entrances.entrance_id, entrances.latitude, entrances.longitude, '
+                                'station_entrances.station_name FROM entrances '
+                                'JOIN station_entrances ON station_entrances.entrance_id = entrances.entrance_id '
+                                'JOIN stations ON stations.station_code = station_entrances.station_code '
+                                'WHERE stations.region = ?', conn, params=[region])
+    finally:
+        conn.close()
+
+    station_map = folium.Map(location=[stations['latitude'].mean(), stations['longitude'].mean()], zoom_start=11)
+    station_layer = folium.FeatureGroup(name='Stations').add_to(station_map)
+    for station in stations.itertuples():
+        folium.CircleMarker(
+            location=[station.latitude, station.longitude], radius=5,
+            color=station.colour_hex_code or '#555555', fill=True, fill_opacity=0.8,
+            popup=html.escape(f'{station.name} ({station.station_code}), {station.route_name}'),
+        ).add_to(station_layer)
+    if len(entrances):
+        entrance_layer = folium.FeatureGroup(name='Entrances').add_to(station_map)
+        for entrance in entrances.itertuples():
+            folium.CircleMarker(
+                location=[entrance.latitude, entrance.longitude], radius=2, color='red', fill=True,
+                popup=html.escape(f'{entrance.station_name} entrance {entrance.entrance_id}'),
+            ).add_to(entrance_layer)
+    folium.LayerControl().add_to(station_map)
+    station_map.save(path)
+
+
+def map_shard(options, rows):
+    os.makedirs(options['map_directory'], exist_ok=True)
+    done = []
+    for region in rows['region']:
+        slug = region.lower().replace(' ', '_')
+        render_map(options['database'], region, os.path.join(options['map_directory'], f'{slug}.html'))
+        done.append(region)
+    return [], done, []
+
+
+# job -> (item key, function turning a shard of item rows into (records, done, failed))
+SHARDS = {
+    'entrances': ('entrance_id', entrance_shard),
+    'stations': ('station_id', station_shard),
+    'map': ('region', map_shard),
+}
+
+
+def run_shard(payload):
+    # Runs in a worker process
+    job, options, number, rows = payload
+    start = time.perf_counter()
+    records, done, failed = SHARDS[job][1](options, rows)
+    return number, records, done, failed, time.perf_counter() - start
+
+
+def job_items(job, region=None, database=DATABASE, directory=storage.cleansed_data_directory):
+    # The entrances and stations jobs read the cleansed tables in directory
+    if job == 'entrances':
+        return storage.read_table('entrances', directory)[['entrance_id', 'longitude', 'latitude']]
+    if job == 'stations':
+        stations = storage.read_table('stations', directory)
+        return stations[stations['region'] == (region or DEFAULT_REGION)]
+    conn = sqlite3.connect(f'file:{database}?mode=ro', uri=True)
+    try:
+        regions = pd.read_sql('SELECT DISTINCT region FROM stations ORDER BY region', conn)
+    finally:
+        conn.close()
+    return regions[regions['region'] == region] if region else regions
+
+
+def fingerprint(job, options, region=None):
+    # What a job's results depend on besides the items themselves
+    payload = {'job': job, 'region': region}
+    if job == 'map':
+        stat = os.stat(options['database'])
+        payload['database'] = [stat.st_mtime_ns, stat.st_size]
+    else:
+        payload['parameters'] = WALKING_PARAMETERS
+    if job == 'stations':
+        payload['entrance_isochrones'] = station_isochrones.entrance_isochrone_hashes(options['entrance_isochrones'])
+    return _digest(payload)
+
+
+def run_job(job, items, options, journal, sink=None, shard_size=DEFAULT_SHARD_SIZE, max_workers=DEFAULT_WORKERS):
+    # Splits the items the journal has not seen completed into shards, runs them on a
+    # process pool and, as each shard finishes, writes its records to sink and then
+    # journals it; a shard is only ever journaled once its records are stored. ORS
+    # allows requests_per_minute for the whole job, so each worker gets its share.
+    key = SHARDS[job][0]
+    completed = journal.completed()
+    pending = items[~items[key].isin(completed)].sort_values(key)
+    skipped = len(items) - len(pending)
+    shards = [pending.iloc[start:start + shard_size] for start in range(0, len(pending), shard_size)]
+    max_workers = max(1, min(max_workers, len(shards)))
+    options = dict(options, requests_per_minute=options['requests_per_minute'] / max_workers)
+    logger.info(f"{job}: {len(items)} items, {skipped} already done, {len(pending)} in {len(shards)} shards "
+                f"on {max_workers} workers")
+    metrics.count('job_items', skipped, job=job, status='skipped')
+
+    start = time.perf_counter()
+    done = failed = 0
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=process_context()) as executor:
+        futures = {executor.submit(metrics.Pooled(run_shard), (job, options, number, shard)): (number, shard)
+                   for number, shard in enumerate(shards)}
+        try:
+            for future in as_completed(futures):
+                number, shard = futures[future]
+                try:
+                    (number, records, shard_done, shard_failed, seconds), report = future.result()
+                except Exception as e:
+                    # Left out of the journal, so the next run retries the whole shard
+                    logger.error(f"{job}: shard {number} failed: {e}")
+                    metrics.record('job_shard', 0.0, error=True, job=job)
+                    failed += len(shard)
+                    continue
+                metrics.merge(report)
+                if sink is not None and records:
+                    sink.write(records)
+                journal.record(number, shard_done, shard_failed)
+                metrics.record('job_shard', seconds, job=job)
+                metrics.count('job_items', len(shard_done), job=job, status='done')
+                metrics.count('job_items', len(shard_failed), job=job, status='failed')
+                done += len(shard_done)
+                failed += len(shard_failed)
+                elapsed = time.perf_counter() - start
+                rate = (done + failed) / elapsed
+                remaining = len(pending) - done - failed
+                logger.info(f"{job}: shard {number} finished in {seconds:.1f}s, {done + failed}/{len(pending)} "
+                            f"items, {rate:.2f} items/s, about {remaining / rate if rate else 0:.0f}s left")
+        except KeyboardInterrupt:
+            # Finished shards are journaled, so the next run picks up from here
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    elapsed = time.perf_counter() - start
+    metrics.gauge('job_items_per_second', (done + failed) / elapsed if elapsed else 0.0, job=job)
+    summary = {'job': job, 'items': len(items), 'skipped': skipped, 'done': done, 'failed': failed,
+               'seconds': round(elapsed, 3)}
+    logger.info(f"{job}: {done} done, {failed} failed, {skipped} skipped in {elapsed:.1f}s")
+    return summary
+
+
+def job_options(ors_key=None, ors_url=None, replay=None, record=None, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE,
+                database=DATABASE, map_directory=DEFAULT_MAP_DIRECTORY):
+    # Settings every shard of a job receives. Recorded fixtures are an isochrone cache
+    # directory: record fills it from ORS, replay answers only from it.
+    return {
+        'ors_key': ors_key,
+        'ors_url': ors_url,
+        'replay': bool(replay),
+        'cache_directory': replay or record or DEFAULT_CACHE_DIRECTORY,
+        'requests_per_minute': requests_per_minute,
+        'database': database,
+        'map_directory': map_directory,
+    }
@@ -0,0 +1,88 @@
+import argparse
+import json
+import logging
+import sqlite3
+
+import pandas as pd
+
+from scripts.load_sql import DATABASE, PRIMARY_KEYS
+
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('jsonl', 'parquet')
+
+
+def current_version(conn):
+    # The newest changelog version, 0 for a database that has not logged anything yet
+    return conn.execute('SELECT COALESCE(MAX(version), 0) FROM changelog').fetchone()[0]
+
+
+def database_id(conn):
+    # The id of the database the changelog versions belong to, None before ensure_schema
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if 'metadata' not in tables:
+        return None
+    row = conn.execute("SELECT value FROM metadata WHERE name = 'database_id'").fetchone()
+    return row[0] if row else None
+
+
+def changes_since(conn, version, tables=None):
+    # Changelog entries after version, oldest first, with key and data decoded
+    sql = 'SELECT version, table_name, operation, key, data, changed_at FROM changelog WHERE version > ?'
+    params = [version]
+    if tables:
+        sql += f' AND table_name IN ({", ".join("?" for _ in tables)})'
+        params += list(tables)
+    changes = pd.read_sql(sql + ' ORDER BY version', conn, params=params)
+    changes['key'] = [json.loads(key) for key in changes['key']]
+    changes['data'] = [json.loads(data) if data is not None else None for data in changes['data']]
+    return changes
+
+
+def collapse(changes):
+    # Reduce changes to the net effect per row: the last entry of each key wins, so a
+    # row inserted then updated becomes one upsert and one deleted at the end one delete
+    last = changes.drop_duplicates(['table_name', 'key'], keep='last')
+    deltas = {}
+    for table in PRIMARY_KEYS:
+        rows = last[last['table_name'] == table]
+        deletes = rows['operation'] == 'delete'
+        deltas[table] = (rows.loc[~deletes, 'data'].tolist(), rows.loc[deletes, 'key'].tolist())
+    return deltas
+
+
+def export(since, path, database=DATABASE, tables=None, output_format=None):
+    # Write the changes after version since as JSON Lines, one entry per line, or as a
+    # Parquet file with the row data kept as json text. Returns the newest version
+    # written, which a consumer passes as since next time.
+    output_format = output_format or ('parquet' if path.endswith('.parquet') else 'jsonl')
+    conn = sqlite3.connect(f'file:{database}?mode=ro', uri=True)
+    try:
+        changes = changes_since(conn, since, tables)
+        version = int(changes['version'].max()) if len(changes) else since
+    finally:
+        conn.close()
+
+    if output_format == 'parquet':
+        changes.assign(key=changes['key'].map(json.dumps),
+                       data=[json.dumps(data) if data is not None else None for data in changes['data']]
+                       ).to_parquet(path, index=False)
+    else:
+        with open(path, 'w') as f:
+            for entry in changes.to_dict('records'):
+                f.write(json.dumps(entry, default=str) + '\n')
+    logger.info(f"Exported {len(changes)} changes after version {since} up to version {version} to {path}")
+    return version
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the sqlite changelog after a version')
+    parser.add_argument('--since', type=int, default=0, help='last version the consumer already applied')
+    parser.add_argument('--output', default='changes.jsonl', help='.jsonl or .parquet file to write')
+    parser.add_argument('--database', default=DATABASE)
+    parser.add_argument('--table', action='append', choices=list(PRIMARY_KEYS), help='limit to these tables')
+    parser.add_argument('--format', choices=FORMATS, help='defaults to the output file extension')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    print(export(args.since, args.output, args.database, args.table, args.format))
@@ -0,0 +1,66 @@
+from collections import namedtuple
+
+
+# Declarative description of one city's raw station file and how to cleanse it.
+# Column names in rename, drop and title_case refer to the normalized (lower case,
+# underscored) headers of the raw file.
+CitySource = namedtuple('CitySource', [
+    'name',            # short identifier, also used in logs
+    'region',          # value written to the region column
+    'file',            # raw csv under data/
+    'cleansed_file',   # per-city csv under data_cleansed/
+    'rename',          # mapping of raw column names to the shared schema
+    'drop',            # raw columns that are not part of the shared schema
+    'title_case',      # columns to convert to title case
+    'name_overrides',  # exact station name replacements applied after title casing
+], defaults=({}, [], [], {}))
+
+
+CITY_SOURCES = [
+    CitySource(
+        name='klang_valley',
+        region='Klang Valley',
+        file='klang_valley_stations.csv',
+        cleansed_file='klang_valley_stations_cleansed.csv',
+        rename={'city': 'region', 'stop_id': 'station_code'},
+        title_case=['name'],
+        name_overrides={
+            "Kl Sentral": "KL Sentral",
+            "Ukm": "UKM",
+            "Pwtc": "PWTC",
+            "Taman Perindustrian Puchong (Tpp)": "Taman Perindustrian Puchong (TPP)",
+            "Klcc": "KLCC",
+            "Ss15": "SS15",
+            "Ss18": "SS18",
+            "Usj7": "USJ7",
+            "Usj21": "USJ21",
+            "Klia2": "KLIA2",
+            "Ttdi": "TTDI",
+            "Sunu Monash": "SunU Monash",
+            "South Quay-Usj1": "South Quay-USJ1",
+            "Persiaran Klcc": "Persiaran KLCC",
+            "Upm": "UPM",
+            "Bu11": "BU11",
+            "Ss7": "SS7",
+            "Uitm": "UiTM",
+        },
+    ),
+    CitySource(
+        name='montreal',
+        region='Montreal',
+        file='montreal_metro.csv',
+        cleansed_file='montreal_stations_cleansed.csv',
+        rename={'_stop_id': 'station_code', 'city': 'region'},
+        drop=['index'],
+        title_case=['name'],
+    ),
+    CitySource(
+        name='singapore',
+        region='Singapore',
+        file='mrtsg.csv',
+        cleansed_file='singapore_stations_cleansed.csv',
+        rename={'stn_no': 'station_code', 'route_code': 'route_id', 'city': 'region'},
+        drop=['objectid', 'x', 'y'],
+        title_case=['line_colour'],
+    ),
+]
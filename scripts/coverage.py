@@ -0,0 +1,169 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import shapely
+from shapely import STRtree
+from shapely.geometry import shape
+
+from scripts import metrics
+from scripts import storage
+from scripts.load_supabase import fetch_pages
+
+
+logger = logging.getLogger(__name__)
+
+# 5, 10 and 15 minute walks, the interval used when generating station isochrones
+BANDS = [300, 600, 900]
+DEFAULT_CHUNK_SIZE = 250_000
+DEFAULT_GROUPS = ['region', 'route_name']
+# Chunks submitted to the pool per worker before waiting for results, which bounds the
+# points held in memory however many chunks the input yields
+CHUNKS_IN_FLIGHT = 2
+
+
+def load_station_isochrones(supabase):
+    pages = fetch_pages(supabase, 'station_isochrones', 'isochrone_id', ['station_id', 'value', 'geometry'])
+    isochrones = pd.concat(list(pages), ignore_index=True)
+    isochrones['geometry'] = [shape(geometry) for geometry in isochrones['geometry']]
+    return isochrones
+
+
+class CoverageEngine:
+    # Answers which station isochrones contain a set of points. Isochrone polygons go
+    # into an STRtree; each batch of points is matched against the tree's bounding
+    # boxes in one bulk query and the candidate pairs are confirmed with a vectorized
+    # point-in-polygon test.
+
+    def __init__(self, isochrones, stations, groups=DEFAULT_GROUPS):
+        stations = stations.set_index('station_id')
+        isochrones = isochrones[isochrones['station_id'].isin(stations.index)]
+        self.geometries = np.asarray(list(isochrones['geometry']))
+        self.station_ids = isochrones['station_id'].to_numpy()
+        self.values = isochrones['value'].to_numpy(dtype='float64')
+        self.groups = groups
+        self.labels = {group: stations.loc[self.station_ids, group].astype(str).to_numpy() for group in groups}
+        self.tree = STRtree(self.geometries)
+
+    def __getstate__(self):
+        # STRtree can not be pickled, worker processes rebuild it from the geometries
+        state = dict(self.__dict__)
+        del state['tree']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.tree = STRtree(self.geometries)
+
+    def _pairs(self, longitudes, latitudes):
+        points = shapely.points(longitudes, latitudes)
+        point_positions, polygon_positions = self.tree.query(points)
+        inside = shapely.contains_xy(self.geometries[polygon_positions],
+                                     longitudes[point_positions], latitudes[point_positions])
+        return point_positions[inside], polygon_positions[inside]
+
+    def assign(self, longitudes, latitudes):
+        # One row per point and reachable station with the smallest band that reaches it
+        longitudes = np.asarray(longitudes, dtype='float64')
+        latitudes = np.asarray(latitudes, dtype='float64')
+        points, polygons = self._pairs(longitudes, latitudes)
+        pairs = pd.DataFrame({'point': points, 'station_id': self.station_ids[polygons],
+                              'value': self.values[polygons]})
+        return pairs.groupby(['point', 'station_id'], as_index=False)['value'].min()
+
+    def chunk_coverage(self, longitudes, latitudes, weights=None):
+        # Weight reached within each band per group label for one chunk of points. A
+        # point counts once per label, in the smallest band of any station with that label.
+        longitudes = np.asarray(longitudes, dtype='float64')
+        latitudes = np.asarray(latitudes, dtype='float64')
+        weights = np.ones(len(longitudes)) if weights is None else np.asarray(weights, dtype='float64')
+        points, polygons = self._pairs(longitudes, latitudes)
+
+        coverage = {}
+        for group in self.groups:
+            pairs = pd.DataFrame({'point': points, 'label': self.labels[group][polygons],
+                                  'value': self.values[polygons]})
+            best = pairs.groupby(['label', 'point'])['value'].min().reset_index()
+            best['weight'] = weights[best['point'].to_numpy()]
+            coverage[group] = best.groupby(['label', 'value'])['weight'].sum()
+        return coverage, weights.sum()
+
+
+_worker_engine = None
+
+
+def _init_worker(engine):
+    global _worker_engine
+    _worker_engine = engine
+
+
+def _chunk_coverage(chunk):
+    return _worker_engine.chunk_coverage(*chunk)
+
+
+def chunk_points(longitudes, latitudes, weights=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    for start in range(0, len(longitudes), chunk_size):
+        end = start + chunk_size
+        yield longitudes[start:end], latitudes[start:end], None if weights is None else weights[start:end]
+
+
+def bounded_map(executor, function, items, in_flight):
+    # executor.map that submits the next item only once fewer than in_flight are
+    # pending, so a long stream of items is never read ahead in full. Results come back
+    # in completion order.
+    pending = set()
+    for item in items:
+        if len(pending) >= in_flight:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                yield future.result()
+        pending.add(executor.submit(function, item))
+    for future in as_completed(pending):
+        yield future.result()
+
+
+def coverage_report(engine, chunks, max_workers=None):
+    # Streams chunks of (longitudes, latitudes, weights) through a process pool and
+    # returns one table per group with the covered weight and share of all points
+    # reachable within each band. Bands are cumulative: the 600 s share includes
+    # points reached within 300 s.
+    start = time.perf_counter()
+    totals = {group: [] for group in engine.groups}
+    total_weight = 0.0
+    if max_workers == 1:
+        results = (engine.chunk_coverage(*chunk) for chunk in chunks)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(engine,))
+        in_flight = CHUNKS_IN_FLIGHT * (max_workers or os.cpu_count() or 1)
+        results = metrics.merged(bounded_map(executor, metrics.Pooled(_chunk_coverage), chunks, in_flight))
+    try:
+        for coverage, weight in results:
+            total_weight += weight
+            for group, counts in coverage.items():
+                totals[group].append(counts)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    report = {}
+    empty = pd.Series(dtype='float64', index=pd.MultiIndex.from_arrays([[], []], names=['label', 'value']))
+    for group, parts in totals.items():
+        counts = pd.concat(parts).groupby(level=['label', 'value']).sum() if parts else empty
+        table = counts.unstack('value', fill_value=0)
+        # Every band gets a column, including those no point was first reached in
+        bands = sorted(set(table.columns) | {float(band) for band in BANDS})
+        table = table.reindex(columns=bands, fill_value=0).cumsum(axis=1)
+        table = table.stack().rename('covered_weight').reset_index().rename(columns={'label': group})
+        table['share'] = table['covered_weight'] / total_weight if total_weight else 0.0
+        report[group] = table
+    logger.info(f"Coverage of {total_weight:.0f} point weight computed in {time.perf_counter() - start:.2f}s")
+    return report
+
+
+def run(supabase, longitudes, latitudes, weights=None, max_workers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    engine = CoverageEngine(load_station_isochrones(supabase), storage.read_table('stations'))
+    return coverage_report(engine, chunk_points(longitudes, latitudes, weights, chunk_size), max_workers)
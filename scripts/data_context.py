@@ -0,0 +1,115 @@
+from contextlib import contextmanager
+import logging
+import os
+import sqlite3
+import threading
+
+import httpx
+from supabase import ClientOptions, create_client
+
+from scripts import metrics
+from scripts import storage
+
+
+logger = logging.getLogger(__name__)
+
+# One keep-alive HTTP session is shared by every Supabase request of a run. Its pool
+# is larger than supabase_writer's default worker count, so concurrent chunk writes
+# never wait for a connection, and idle connections outlive the gap between stages.
+HTTP_MAX_CONNECTIONS = 16
+HTTP_KEEPALIVE_EXPIRY = 60
+HTTP_TIMEOUT = 120
+
+
+class DataContext:
+    # What the stages of one pipeline run share: each cleansed table parsed once, one
+    # sqlite connection per database and one Supabase client per project.
+    #
+    # table() hands out shallow copies of the cached frames, which share their column
+    # data without copying it; a stage that needs to modify values in place copies
+    # first. A table is parsed again only if its file changed since it was cached, so a
+    # context can be opened before the stages that write the files have run.
+
+    def __init__(self, directory=storage.cleansed_data_directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._table_locks = {}
+        self._tables = {}
+        self._connections = {}
+        self._clients = {}
+        self._http = None
+
+    def table(self, name):
+        with self._lock:
+            lock = self._table_locks.setdefault(name, threading.Lock())
+        # Stages reading the same table at once wait for one parse rather than each parsing it
+        with lock:
+            path = storage.source_path(name, self.directory)
+            stat = os.stat(path)
+            signature = (path, stat.st_mtime_ns, stat.st_size)
+            cached = self._tables.get(name)
+            if cached is not None and cached[0] == signature:
+                metrics.count('cache_hits', service='data_context', table=name)
+                df = cached[1]
+            else:
+                df = storage.read_table(name, self.directory)
+                self._tables[name] = (signature, df)
+        return df.copy(deep=False)
+
+    @contextmanager
+    def sqlite(self, database, connect=sqlite3.connect):
+        # The run's connection to database, opened with connect on first use and held by
+        # one caller at a time; stages run on different threads, so it is not tied to
+        # the thread that opened it. When the caller is done its writes are checkpointed
+        # out of the WAL, so the database file is final when the stage's outputs are
+        # hashed rather than rewritten once the connection closes.
+        with self._lock:
+            if database not in self._connections:
+                self._connections[database] = (connect(database, check_same_thread=False), threading.Lock())
+            conn, lock = self._connections[database]
+        with lock:
+            try:
+                yield conn
+            finally:
+                if not conn.in_transaction:
+                    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def supabase(self, url, key):
+        with self._lock:
+            if self._http is None:
+                self._http = httpx.Client(
+                    timeout=HTTP_TIMEOUT,
+                    limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                                        max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+                                        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+                )
+            if (url, key) not in self._clients:
+                self._clients[url, key] = create_client(url, key, options=ClientOptions(httpx_client=self._http))
+            return self._clients[url, key]
+
+    def close(self):
+        with self._lock:
+            for conn, _ in self._connections.values():
+                conn.close()
+            if self._http is not None:
+                self._http.close()
+            self._connections.clear()
+            self._clients.clear()
+            self._tables.clear()
+            self._http = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+@contextmanager
+def borrowed(context=None):
+    # The given context, or a fresh one closed on exit for a loader run on its own
+    if context is not None:
+        yield context
+        return
+    with DataContext() as context:
+        yield context
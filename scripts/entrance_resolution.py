@@ -0,0 +1,57 @@
+import hashlib
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Keys stay below 2^53 so they survive JSON clients that read numbers as doubles
+KEY_MASK = (1 << 53) - 1
+
+
+def relationship_key(entrance_id, station_code):
+    digest = hashlib.blake2b(f'{int(entrance_id)}:{station_code}'.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') & KEY_MASK
+
+
+def resolve(station_entrances):
+    # One row per (entrance, station code) from relations whose Station Code holds
+    # several ;-joined codes. The Relationship ID is derived from the pair itself, so
+    # the same relation keeps the same key from run to run.
+    resolved = (station_entrances
+                .assign(**{'Station Code': station_entrances['Station Code'].str.split(';')})
+                .explode('Station Code', ignore_index=True))
+    resolved['Station Code'] = resolved['Station Code'].str.strip()
+    resolved = resolved.drop_duplicates(['Entrance ID', 'Station Code'], ignore_index=True)
+
+    resolved['Relationship ID'] = [relationship_key(entrance_id, station_code) for entrance_id, station_code
+                                   in zip(resolved['Entrance ID'], resolved['Station Code'])]
+    if resolved['Relationship ID'].duplicated().any():
+        raise ValueError("Relationship key collision between different (entrance, station) pairs")
+    columns = ['Relationship ID', 'Entrance ID', 'Station Name', 'Station Code']
+    return resolved[columns].sort_values('Relationship ID', ignore_index=True)
+
+
+class StationEntranceIndex:
+    # Two-way lookup between station codes and the entrances that serve them. Consumers
+    # look up the entrances of the stations they work on here instead of joining or
+    # filtering the whole relation table for each one.
+
+    def __init__(self, entrances_by_station):
+        self.entrances_by_station = {code: sorted(ids) for code, ids in entrances_by_station.items()}
+        self.stations_by_entrance = {}
+        for code, entrance_ids in self.entrances_by_station.items():
+            for entrance_id in entrance_ids:
+                self.stations_by_entrance.setdefault(entrance_id, []).append(code)
+        for codes in self.stations_by_entrance.values():
+            codes.sort()
+
+    @classmethod
+    def from_relations(cls, station_entrances):
+        grouped = station_entrances.groupby('station_code')['entrance_id'].unique()
+        return cls({code: [int(entrance_id) for entrance_id in ids] for code, ids in grouped.items()})
+
+    def entrances_for(self, station_code):
+        return self.entrances_by_station.get(station_code, [])
+
+    def stations_for(self, entrance_id):
+        return self.stations_by_entrance.get(int(entrance_id), [])
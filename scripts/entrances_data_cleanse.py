@@ -2,6 +2,9 @@ import pandas as pd
 import os
 import logging
 
+from scripts import storage
+from scripts.entrance_resolution import resolve
+
 
 logger = logging.getLogger(__name__)
 
@@ -16,13 +19,8 @@ def run():
     entrances_data = pd.read_csv(os.path.join(data_directory, entrances_file))
     station_entrances_data  = pd.read_csv(os.path.join(data_directory, station_entrances_file))
 
-    # split the Station ID column into multiple rows
-    station_entrances_data = (station_entrances_data.set_index(['Relationship ID', 'Entrance ID', 'Station Name'])
-        .apply(lambda x: x.str.split(';').explode())
-        .reset_index())
-
-    # reset the Relationship ID
-    station_entrances_data['Relationship ID'] = range(len(station_entrances_data))
+    # split the Station Code column into one row per station, with stable Relationship IDs
+    station_entrances_data = resolve(station_entrances_data)
 
 
     # Rename columns
@@ -39,14 +37,6 @@ def run():
     entrances_data.columns = entrances_data.columns.str.lower().str.replace(' ', '_')
     station_entrances_data.columns = station_entrances_data.columns.str.lower().str.replace(' ', '_')
 
-    # Define the directory where you want to save the cleaned data
-    cleansed_data_directory = 'data_cleansed'
-    cleansed_entrances_file= 'klang_valley_entrances_cleansed.csv'
-    cleansed_station_entrances_file = 'klang_valley_stations_entrances_relation_cleansed.csv'
-
     # Save the cleaned dataframes
-    entrances_data.to_csv(os.path.join(cleansed_data_directory, cleansed_entrances_file), index=False)
-    station_entrances_data.to_csv(os.path.join(cleansed_data_directory, cleansed_station_entrances_file), index=False)
-
-
-
+    storage.write_table(entrances_data, 'entrances')
+    storage.write_table(station_entrances_data, 'station_entrances')
@@ -5,70 +5,89 @@ import os
 from datetime import date
 import logging
 
+from scripts.overpass_cache import OverpassCache
+
 
 logger = logging.getLogger(__name__)
 
-def run():
-    logger.info("Querying entrance and station data in OSM")
+ENTRANCE_COLUMNS = ['Entrance ID', 'Longitude', 'Latitude', 'Entrance Destination', 'Entrance Name']
+STATION_ENTRANCE_COLUMNS = ['Relationship ID', 'Entrance ID', 'Station Code', 'Station Name']
 
-    # initialize Overpass API
-    api = overpy.Overpass()
+AREA = 'Malaysia'
 
-    # DataFrames for entrances and station-entrance relationships
-    entrances = pd.DataFrame(columns=['Entrance ID', 'Longitude','Latitude','Entrance Destination'])
-    station_entrances = pd.DataFrame(columns=['Relationship ID', 'Entrance ID', 'Station Code','Station Name'])
-
-    # Query all subway entrances in Malaysia
-    result_entrances = api.query("""
-    [out:json][timeout:25];
-    area["name"="Malaysia"]["boundary"="administrative"]->.searchArea;
-    node["railway"~"subway_entrance|train_station_entrance"](area.searchArea);
-    out body;
-    """)
-    print(f'Entrance query completed {date.today()}')
+# Query all subway entrances in the area
+ENTRANCES_QUERY = """
+[out:json][timeout:25];
+area["name"="{area}"]["boundary"="administrative"]->.searchArea;
+node["railway"~"subway_entrance|train_station_entrance"](area.searchArea);
+out body;
+"""
 
+# Query all station relations in the area
+RELATIONS_QUERY = """
+[out:json];
+area["name"="{area}"]["boundary"="administrative"]->.searchArea;
+relation["type"="public_transport"](area.searchArea);
+out body;
+> ;
+out skel qt;
+"""
 
-    # Store the subway_entrance object IDs and coordinates in df_entrances
-    for node in result_entrances.nodes:
-        entrances = pd.concat(
-            [entrances, 
-            pd.DataFrame([{'Entrance ID': node.id, 
-                            'Entrance Name':node.tags.get('ref'),
-                            'Entrance Destination':node.tags.get('destination'),
-                            'Longitude':node.lon,
-                            'Latitude':node.lat}])], 
-            ignore_index=True
-        )
-
-    #  Query all station relations in Malaysia
-    result_relations = api.query("""
-    [out:json];
-    area["name"="Malaysia"]["boundary"="administrative"]->.searchArea;
-    relation["type"="public_transport"](area.searchArea);
-    out body;
-    > ;
-    out skel qt;
-    """)
-    print(f'Station relation query completed {date.today()}')
 
+def build_entrances(nodes):
+    # Collect node attributes into one list per column and build the DataFrame once,
+    # instead of growing it with a pd.concat per node
+    columns = {column: [] for column in ENTRANCE_COLUMNS}
+    for node in nodes:
+        columns['Entrance ID'].append(node.id)
+        columns['Longitude'].append(node.lon)
+        columns['Latitude'].append(node.lat)
+        columns['Entrance Destination'].append(node.tags.get('destination'))
+        columns['Entrance Name'].append(node.tags.get('ref'))
 
-    # For each relation, check if it contains any of our entrances
+    return pd.DataFrame(columns, columns=ENTRANCE_COLUMNS)
+
+
+def build_station_entrances(relations, entrance_ids):
+    # Membership is checked against a set so each lookup is O(1) rather than a scan
+    # over the entrance ID column
+    entrance_ids = set(entrance_ids)
+    columns = {column: [] for column in STATION_ENTRANCE_COLUMNS}
     relationship_id = 0
-    for relation in result_relations.relations:
+    for relation in relations:
         station_id = relation.tags.get('ref', 'Unnamed')
         station_name = relation.tags.get('name', 'Unnamed')
         for member in relation.members:
-            if member.ref in entrances['Entrance ID'].values:
-                station_entrances = pd.concat(
-                    [station_entrances,
-                    pd.DataFrame([{'Relationship ID': relationship_id, 
-                                    'Entrance ID': member.ref,
-                                    'Station Name': station_name, 
-                                    'Station Code': station_id}])], 
-                    ignore_index=True
-                )
+            if member.ref in entrance_ids:
+                columns['Relationship ID'].append(relationship_id)
+                columns['Entrance ID'].append(member.ref)
+                columns['Station Code'].append(station_id)
+                columns['Station Name'].append(station_name)
                 relationship_id += 1
 
+    return pd.DataFrame(columns, columns=STATION_ENTRANCE_COLUMNS)
+
+
+def run(cache=None):
+    logger.info("Querying entrance and station data in OSM")
+
+    # initialize Overpass API, responses are served from the on-disk cache when fresh
+    api = overpy.Overpass()
+    if cache is None:
+        cache = OverpassCache.from_environment()
+
+    result_entrances = cache.query(api, ENTRANCES_QUERY.format(area=AREA), AREA)
+    print(f'Entrance query completed {date.today()}')
+
+    # Store the subway_entrance object IDs and coordinates in entrances
+    entrances = build_entrances(result_entrances.nodes)
+
+    result_relations = cache.query(api, RELATIONS_QUERY.format(area=AREA), AREA)
+    print(f'Station relation query completed {date.today()}')
+
+    # For each relation, check if it contains any of our entrances
+    station_entrances = build_station_entrances(result_relations.relations, entrances['Entrance ID'])
+
     # Define the directory where you want to save the cleaned data
     data_directory = 'data'
     kl_entrances_file = 'klang_valley_entrances.csv'
@@ -0,0 +1,194 @@
+import logging
+
+import numpy as np
+from shapely import wkb
+from shapely.geometry import MultiPolygon, Polygon, mapping, shape
+from shapely.ops import transform
+
+
+logger = logging.getLogger(__name__)
+
+# 5 decimal places of a degree is about a metre, far finer than a walking isochrone
+DEFAULT_PRECISION = 5
+
+# Geometry kinds follow the WKB type numbers; anything else is stored as plain WKB
+_WKB = 0
+_POLYGON = 3
+_MULTIPOLYGON = 6
+_VERSION = 1
+
+
+def compact_geometry(geometry, precision=DEFAULT_PRECISION, tolerance=None):
+    # Simplify without changing topology, then snap coordinates to a 10^-precision grid.
+    # The default tolerance is one grid step, so simplification only drops vertices
+    # that quantization would make redundant anyway.
+    if tolerance is None:
+        tolerance = 10 ** -precision
+    if tolerance:
+        geometry = geometry.simplify(tolerance, preserve_topology=True)
+    geometry = transform(lambda x, y, z=None: (np.round(x, precision), np.round(y, precision)), geometry)
+    if not geometry.is_valid:
+        geometry = geometry.buffer(0)
+    return geometry
+
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, position):
+    result = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+
+
+def _read_varints(data, position, count):
+    # Vectorized read of count consecutive varints: every byte below 0x80 ends a value
+    if count == 0:
+        return np.zeros(0, dtype='uint64')
+    buffer = np.frombuffer(data, dtype='uint8', offset=position)
+    ends = np.flatnonzero(buffer < 0x80)[:count]
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    lengths = ends - starts + 1
+    groups = np.repeat(np.arange(count), lengths)
+    shifts = (7 * (np.arange(ends[-1] + 1) - np.repeat(starts, lengths))).astype('uint64')
+    values = np.zeros(count, dtype='uint64')
+    np.add.at(values, groups, (buffer[:ends[-1] + 1] & 0x7F).astype('uint64') << shifts)
+    return values
+
+
+def _zigzag(values):
+    return ((values << 1) ^ (values >> 63)).astype('uint64')
+
+
+def _unzigzag(values):
+    return (values >> 1).astype('int64') ^ -(values & 1).astype('int64')
+
+
+def _polygons(geometry):
+    return list(geometry.geoms) if isinstance(geometry, MultiPolygon) else [geometry]
+
+
+def encode_geometry(geometry, precision=DEFAULT_PRECISION):
+    # Polygons are written as varint counts followed by zigzag varint deltas between
+    # consecutive integer coordinates, which takes one to three bytes per value where
+    # WKB takes eight. Other geometry types fall back to WKB.
+    out = bytearray([_VERSION])
+    if not isinstance(geometry, (Polygon, MultiPolygon)):
+        out.append(_WKB)
+        return bytes(out) + wkb.dumps(geometry)
+
+    out.append(_MULTIPOLYGON if isinstance(geometry, MultiPolygon) else _POLYGON)
+    _write_varint(out, precision)
+    scale = 10 ** precision
+    polygons = _polygons(geometry)
+    if isinstance(geometry, MultiPolygon):
+        _write_varint(out, len(polygons))
+
+    rings = []
+    for polygon in polygons:
+        polygon_rings = [polygon.exterior] + list(polygon.interiors)
+        _write_varint(out, len(polygon_rings))
+        for ring in polygon_rings:
+            coordinates = np.asarray(ring.coords)[:, :2]
+            _write_varint(out, len(coordinates))
+            rings.append(coordinates)
+
+    if rings:
+        integers = np.round(np.concatenate(rings) * scale).astype('int64').ravel()
+        for value in _zigzag(np.diff(integers, prepend=0)).tolist():
+            _write_varint(out, value)
+    return bytes(out)
+
+
+def decode_geometry(data):
+    if data[1] == _WKB:
+        return wkb.loads(bytes(data[2:]))
+
+    kind = data[1]
+    precision, position = _read_varint(data, 2)
+    polygon_count = 1
+    if kind == _MULTIPOLYGON:
+        polygon_count, position = _read_varint(data, position)
+
+    layout = []
+    for _ in range(polygon_count):
+        ring_count, position = _read_varint(data, position)
+        ring_lengths = []
+        for _ in range(ring_count):
+            length, position = _read_varint(data, position)
+            ring_lengths.append(length)
+        layout.append(ring_lengths)
+
+    total = 2 * sum(sum(ring_lengths) for ring_lengths in layout)
+    values = _read_varints(data, position, total)
+    coordinates = (np.cumsum(_unzigzag(values)) / 10 ** precision).reshape(-1, 2)
+
+    polygons = []
+    offset = 0
+    for ring_lengths in layout:
+        rings = []
+        for length in ring_lengths:
+            rings.append(coordinates[offset:offset + length])
+            offset += length
+        polygons.append(Polygon(rings[0], rings[1:]))
+    return MultiPolygon(polygons) if kind == _MULTIPOLYGON else polygons[0]
+
+
+class LazyGeometry:
+    # A stored geometry that is only turned into a shapely object when it is used. The
+    # bounding box and area are kept alongside so filtering and sorting never need the
+    # full geometry.
+
+    __slots__ = ('_encoded', '_geometry', 'bbox', 'area')
+
+    def __init__(self, encoded, bbox=None, area=None):
+        self._encoded = encoded
+        self._geometry = None
+        self.bbox = bbox
+        self.area = area
+
+    @classmethod
+    def from_geometry(cls, geometry, precision=DEFAULT_PRECISION, tolerance=None):
+        geometry = compact_geometry(geometry, precision, tolerance)
+        lazy = cls(encode_geometry(geometry, precision), bbox=list(geometry.bounds), area=geometry.area)
+        lazy._geometry = geometry
+        return lazy
+
+    @property
+    def geometry(self):
+        if self._geometry is None:
+            self._geometry = decode_geometry(self._encoded)
+            if self.bbox is None:
+                self.bbox = list(self._geometry.bounds)
+            if self.area is None:
+                self.area = self._geometry.area
+        return self._geometry
+
+    @property
+    def encoded(self):
+        return self._encoded
+
+    @property
+    def __geo_interface__(self):
+        return mapping(self.geometry)
+
+    def intersects_bbox(self, bbox):
+        own = self.bbox if self.bbox is not None else self.geometry.bounds
+        return not (own[2] < bbox[0] or own[0] > bbox[2] or own[3] < bbox[1] or own[1] > bbox[3])
+
+
+def compact_isochrone(isochrone, precision=DEFAULT_PRECISION, tolerance=None):
+    # Copy of an ORS GeoJSON response with every feature geometry compacted
+    features = [dict(feature, geometry=mapping(compact_geometry(shape(feature['geometry']), precision, tolerance)))
+                for feature in isochrone['features']]
+    return dict(isochrone, features=features)
+
@@ -1,22 +1,167 @@
-def isoGeoJsonRetriever(parameters,stations,client):
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
 
-    #ORS isochrones API takes input list of coordinates in field called location. This line creates that column
-    stations['locations']  = stations.apply(lambda row: list([row.loc["longitude"],row.loc["latitude"]]) , axis = 1)
-    iso_list = []
+from scripts import metrics
+from scripts.geometry_store import DEFAULT_PRECISION, compact_isochrone
+from scripts.retry import DEFAULT_RETRIES, with_retry
+
+
+logger = logging.getLogger(__name__)
+
+# The public ORS isochrones endpoint accepts at most 5 locations per request and
+# 20 requests per minute
+MAX_LOCATIONS = 5
+DEFAULT_REQUESTS_PER_MINUTE = 20
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_CACHE_DIRECTORY = '.isochrone_cache'
+# 15 minute walk in 5 minute bands, as used for entrance and station isochrones
+WALKING_PARAMETERS = {
+    'profile': 'foot-walking',
+    'range': [900],
+    'interval': 300,
+    'attributes': ['area', 'reachfactor', 'total_pop'],
+}
+# 5 decimal places is about a metre, well inside the accuracy of an isochrone
+COORDINATE_PRECISION = 5
+
+
+class TokenBucket:
+    # Allows bursts of up to capacity requests, refilled at rate requests per second
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
 
-    for index, row in stations.iterrows():
-        print("Retrieving Isochrone of {} station".format(stations.loc[index,'name']))
-        parameters['locations'] = [row.loc['locations']]
-    
+
+class IsochroneCache:
+    # Content-addressed store of per-location isochrone responses, gzip-compressed on disk
+
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY):
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}.json.gz')
+
+    def get(self, key):
         try:
-            temp_iso = client.isochrones(**parameters)
-            temp_iso = json.dumps(temp_iso)
-            iso_list.append(temp_iso)
-            print("Success")
+            with gzip.open(self.path(key), 'rt', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, isochrone):
+        os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+        temporary_path = self.path(key) + '.tmp'
+        with gzip.open(temporary_path, 'wt', encoding='utf-8') as f:
+            json.dump(isochrone, f)
+        os.replace(temporary_path, self.path(key))
+
+
+def isochrone_key(location, parameters):
+    # Rounded coordinate plus every other request option (profile, range, interval,
+    # attributes, ...), so a change to any of them is a different entry
+    longitude, latitude = (round(float(value), COORDINATE_PRECISION) for value in location)
+    options = {name: value for name, value in parameters.items() if name != 'locations'}
+    payload = json.dumps({'location': [longitude, latitude], 'options': options}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def split_response(response, count):
+    # Break a multi-location response into one single-location response per location,
+    # using the group_index ORS puts on every feature
+    features = [[] for _ in range(count)]
+    for feature in response['features']:
+        group_index = feature['properties']['group_index']
+        feature = dict(feature, properties=dict(feature['properties'], group_index=0))
+        features[group_index].append(feature)
+    return [
+        {'type': response.get('type', 'FeatureCollection'), 'features': location_features,
+         'metadata': response.get('metadata')}
+        for location_features in features
+    ]
+
+
+def fetch_isochrones(client, locations, parameters, cache=None, max_workers=DEFAULT_MAX_WORKERS,
+                     requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, batch_size=MAX_LOCATIONS, retries=DEFAULT_RETRIES):
+    # Returns one isochrone response per [longitude, latitude] in locations, None where
+    # ORS kept failing. Cached locations are never requested; the rest are packed
+    # batch_size to a request and sent from a bounded worker pool behind a shared
+    # token bucket.
+    if cache is None:
+        cache = IsochroneCache()
+    parameters = {name: value for name, value in parameters.items() if name != 'locations'}
+    keys = [isochrone_key(location, parameters) for location in locations]
+    results = [cache.get(key) for key in keys]
+
+    # Identical locations share one request
+    missing = {}
+    for position, key in enumerate(keys):
+        if results[position] is None:
+            missing.setdefault(key, []).append(position)
+    missing_keys = list(missing)
+    batches = [missing_keys[start:start + batch_size] for start in range(0, len(missing_keys), batch_size)]
+    bucket = TokenBucket(requests_per_minute / 60)
+
+    def fetch(batch):
+        batch_locations = [locations[missing[key][0]] for key in batch]
+
+        def request():
+            bucket.acquire()
+            with metrics.span('request', service='ors'):
+                return client.isochrones(locations=batch_locations, **parameters)
+
+        try:
+            response = with_retry(request, retries)
         except Exception as e:
-            print(f"Failed to retrieve isochrone for station {stations.loc[index,'name']}: {e}")
-            iso_list.append(None)  # or some other default value
-    
-    stations['iso'] = iso_list
+            logger.error(f"Failed to retrieve isochrones for {len(batch)} locations: {e}")
+            return
+        for key, isochrone in zip(batch, split_response(response, len(batch))):
+            cache.put(key, isochrone)
+            for position in missing[key]:
+                results[position] = isochrone
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(fetch, batches))
+    elapsed = time.perf_counter() - start
+
+    failed = sum(result is None for result in results)
+    metrics.count('cache_hits', len(locations) - sum(map(len, missing.values())), service='ors')
+    metrics.count('isochrones_failed', failed, service='ors')
+    logger.info(f"Isochrones for {len(locations)} locations: {len(locations) - sum(map(len, missing.values()))} "
+                f"cached, {len(batches)} requests, {failed} failed, {elapsed:.2f}s")
+    return results
+
+
+def isoGeoJsonRetriever(parameters,stations,client,cache=None,max_workers=DEFAULT_MAX_WORKERS,precision=DEFAULT_PRECISION):
+
+    #ORS isochrones API takes input list of coordinates in field called location. This line creates that column
+    stations['locations'] = [[longitude, latitude] for longitude, latitude in zip(stations['longitude'], stations['latitude'])]
+
+    isochrones = fetch_isochrones(client, list(stations['locations']), parameters, cache=cache, max_workers=max_workers)
+    # Polygons are simplified and quantized to precision decimal places before being serialized
+    stations['iso'] = [None if isochrone is None else json.dumps(compact_isochrone(isochrone, precision))
+                       for isochrone in isochrones]
 
     return
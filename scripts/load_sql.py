@@ -1,53 +1,198 @@
 import pandas as pd
+import json
 import sqlite3
 import os
 import logging
+import uuid
 
+from scripts import metrics
+from scripts import storage
+from scripts.data_context import borrowed
+from scripts.table_diff import diff_tables, to_records
 
-logger = logging.getLogger(__name__)
-
-def run():
-    logger.info("Load csv data into sqlite")
-
-    # Define the directory of cleansed data to transfer to sql
-    cleansed_data_directory = 'data_cleansed'
-    cleansed_kl_file = 'klang_valley_stations_cleansed.csv'
-    cleansed_montreal_file = 'montreal_stations_cleansed.csv'
-    cleansed_singapore_file = 'singapore_stations_cleansed.csv'
-    cleansed_combined_file = 'combined_stations_cleansed.csv'
-
-    # read cleaned dataframes
-    kl_data = pd.read_csv(os.path.join(cleansed_data_directory, cleansed_kl_file))
-    montreal_data = pd.read_csv(os.path.join(cleansed_data_directory, cleansed_montreal_file))
-    singapore_data = pd.read_csv(os.path.join(cleansed_data_directory, cleansed_singapore_file))
-
-
-    # Combine all the dataframes
-    combined_df = pd.concat([kl_data, montreal_data, singapore_data], axis=0, ignore_index=True)
-
-    combined_df.index.name = 'station_id'
-    combined_df.to_csv(os.path.join(cleansed_data_directory, cleansed_combined_file), index=True)
 
+logger = logging.getLogger(__name__)
 
-    # Create a connection to the SQLite database
+DATABASE = 'transit_database.db'
+
+# Bump when the DDL below changes. Version 1 gave the tables keys, so databases older
+# than that are rebuilt once; version 2 added the changelog, version 3 the station
+# isochrones, version 4 the database id and version 5 moved the station isochrones out
+# to ISOCHRONE_DATABASE.
+SCHEMA_VERSION = 5
+
+PRIMARY_KEYS = {
+    'stations': 'station_id',
+    'entrances': 'entrance_id',
+    'station_entrances': 'relationship_id',
+}
+
+FOREIGN_KEYS = {
+    'station_entrances': ['FOREIGN KEY (entrance_id) REFERENCES entrances (entrance_id)'],
+}
+
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS ix_stations_station_code ON stations (station_code)',
+    'CREATE INDEX IF NOT EXISTS ix_stations_region ON stations (region)',
+    'CREATE INDEX IF NOT EXISTS ix_station_entrances_station_code ON station_entrances (station_code)',
+    'CREATE INDEX IF NOT EXISTS ix_station_entrances_entrance_id ON station_entrances (entrance_id)',
+    'CREATE INDEX IF NOT EXISTS ix_changelog_table_name ON changelog (table_name, version)',
+]
+
+PRAGMAS = [
+    # WAL lets readers keep reading the previous snapshot while a load is written
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-65536',
+    'PRAGMA foreign_keys=ON',
+]
+
+# Append-only record of every row the loads insert, update or delete. version only ever
+# grows (AUTOINCREMENT never reuses a value), so a consumer that remembers the last
+# version it applied can ask for exactly what changed since. key and data are json;
+# data is the full new row, or NULL for deletes.
+CHANGELOG_SQL = '''CREATE TABLE IF NOT EXISTS changelog (
+    version INTEGER PRIMARY KEY AUTOINCREMENT,
+    table_name TEXT NOT NULL,
+    operation TEXT NOT NULL CHECK (operation IN ('insert', 'update', 'delete')),
+    key TEXT NOT NULL,
+    data TEXT,
+    changed_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%SZ', 'now'))
+)'''
+
+# Facts about the database itself. database_id is a random id given to each database
+# when it is created, so a consumer holding a changelog version can tell whether that
+# version belongs to this database or to one it replaced, whose versions started over.
+METADATA_SQL = 'CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT NOT NULL)'
+
+# Station isochrones are not a cleansed table: the batch jobs write them to Supabase and
+# scripts/station_isochrones copies them into a database of their own for the query
+# service and the map tiles. The geometry is stored in the compact encoding of
+# scripts/geometry_store with its bounding box and area alongside, so readers filter on
+# those and decode only the geometries they use. Being a copy of Supabase it has no
+# changelog, and it is kept out of DATABASE so the nightly commit of that file does not
+# carry it. Bump ISOCHRONE_SCHEMA_VERSION when the columns change; the copy is rebuilt.
+ISOCHRONE_DATABASE = 'station_isochrones.db'
+ISOCHRONE_SCHEMA_VERSION = 1
+STATION_ISOCHRONES = 'station_isochrones'
+STATION_ISOCHRONES_KEY = 'isochrone_id'
+STATION_ISOCHRONES_SCHEMA = {
+    'isochrone_id': 'string',
+    'station_id': 'int64',
+    'value': 'float64',
+    'geometry': 'object',
+    'min_x': 'float64',
+    'min_y': 'float64',
+    'max_x': 'float64',
+    'max_y': 'float64',
+    'area': 'float64',
+    'type': 'string',
+}
+
+SQL_TYPES = {'int64': 'INTEGER', 'float64': 'REAL', 'object': 'BLOB'}
+
+
+def create_table_sql(table, schema=None, key=None):
+    schema = schema or storage.SCHEMAS[table]
+    key = key or PRIMARY_KEYS[table]
+    columns = []
+    for column, dtype in schema.items():
+        definition = f'"{column}" {SQL_TYPES.get(dtype, "TEXT")}'
+        if column == key:
+            definition += ' PRIMARY KEY'
+        columns.append(definition)
+    columns += FOREIGN_KEYS.get(table, [])
+    return f'CREATE TABLE IF NOT EXISTS {table} (\n  ' + ',\n  '.join(columns) + '\n)'
+
+
+def connect(database=DATABASE, **kwargs):
     # Doesn't matter if the database does not yet exist
-    conn = sqlite3.connect('transit_database.db')  
-
-    # Add the station data from the combined dataframe to the SQLite table
-    combined_df.to_sql('stations', conn, if_exists='replace')
-
-
-    cleansed_entrances = 'klang_valley_entrances_cleansed.csv'
-    cleansed_station_entrances= 'klang_valley_stations_entrances_relation_cleansed.csv'
-
-    # read cleaned entrances dataframes
-    entrances_data = pd.read_csv(os.path.join(cleansed_data_directory, cleansed_entrances))
-    station_entrances_data = pd.read_csv(os.path.join(cleansed_data_directory, cleansed_station_entrances))
-
-    # Add the entrances data from the combined dataframe to the SQLite table
-    entrances_data.to_sql('entrances', conn, if_exists='replace', index=False)
-    station_entrances_data.to_sql('station_entrances', conn, if_exists='replace', index=False)
-
+    conn = sqlite3.connect(database, **kwargs)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def ensure_schema(conn):
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    with conn:
+        if version < SCHEMA_VERSION:
+            logger.info(f"Migrating sqlite schema from version {version} to {SCHEMA_VERSION}")
+        if version < 1:
+            # Tables written by pandas to_sql without keys are rebuilt
+            conn.execute('DROP INDEX IF EXISTS ix_stations_station_id')
+            for table in reversed(list(PRIMARY_KEYS)):
+                conn.execute(f'DROP TABLE IF EXISTS {table}')
+        if version < 5:
+            conn.execute(f'DROP TABLE IF EXISTS {STATION_ISOCHRONES}')
+        for table in PRIMARY_KEYS:
+            conn.execute(create_table_sql(table))
+        conn.execute(CHANGELOG_SQL)
+        conn.execute(METADATA_SQL)
+        conn.execute("INSERT OR IGNORE INTO metadata (name, value) VALUES ('database_id', ?)", (uuid.uuid4().hex,))
+        for index in INDEXES:
+            conn.execute(index)
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+
+def ensure_isochrone_schema(conn):
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    with conn:
+        if version < ISOCHRONE_SCHEMA_VERSION:
+            conn.execute(f'DROP TABLE IF EXISTS {STATION_ISOCHRONES}')
+        conn.execute(create_table_sql(STATION_ISOCHRONES, STATION_ISOCHRONES_SCHEMA, STATION_ISOCHRONES_KEY))
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_station_isochrones_station_id ON station_isochrones (station_id)')
+        conn.execute(f'PRAGMA user_version = {ISOCHRONE_SCHEMA_VERSION}')
+
+
+def upsert_table(conn, table, data, schema=None, key=None, changelog=True):
+    # Write only the rows that differ from what the table already holds
+    key = key or PRIMARY_KEYS[table]
+    columns = [column for column in (schema or storage.SCHEMAS[table]) if column in data.columns]
+    existing = pd.read_sql(f'SELECT {", ".join(columns)} FROM {table}', conn)
+    diff = diff_tables(data[columns], existing, key, [column for column in columns if column != key])
+
+    # Converted to records once, for both the upsert and the changelog
+    updated, inserted = to_records(diff.updated), to_records(diff.inserted)
+    changed = updated + inserted
+    placeholders = ', '.join('?' for _ in columns)
+    assignments = ', '.join(f'"{column}" = excluded."{column}"' for column in columns if column != key)
+    conn.executemany(
+        f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({placeholders}) '
+        f'ON CONFLICT ({key}) DO UPDATE SET {assignments}',
+        [tuple(record[column] for column in columns) for record in changed],
+    )
+    conn.executemany(f'DELETE FROM {table} WHERE {key} = ?', [(value,) for value in diff.deleted])
+    if changelog:
+        log_changes(conn, table, key, inserted, updated, diff.deleted)
+    metrics.count('rows_inserted', len(diff.inserted), target='sqlite', table=table)
+    metrics.count('rows_updated', len(diff.updated), target='sqlite', table=table)
+    metrics.count('rows_deleted', len(diff.deleted), target='sqlite', table=table)
+    logger.info(f"sqlite {table}: {len(diff.inserted)} inserted, {len(diff.updated)} updated, "
+                f"{len(diff.deleted)} deleted")
+    return diff
+
+
+def log_changes(conn, table, key, inserted, updated, deleted):
+    entries = [
+        (table, operation, json.dumps(record[key], default=str), json.dumps(record, default=str))
+        for operation, records in [('insert', inserted), ('update', updated)]
+        for record in records
+    ]
+    entries += [(table, 'delete', json.dumps(value, default=str), None) for value in deleted]
+    conn.executemany('INSERT INTO changelog (table_name, operation, key, data) VALUES (?, ?, ?, ?)', entries)
+
+
+def run(database=DATABASE, context=None):
+    logger.info("Load csv data into sqlite")
 
-    # Commit the changes and close the connection
-    conn.commit()
\ No newline at end of file
+    with borrowed(context) as context, context.sqlite(database, connect) as conn:
+        ensure_schema(conn)
+        # One transaction for all three tables; foreign keys are checked at commit so
+        # entrances and their relations can change in any order. The deferral ends with
+        # the commit, so it does not outlive this load on the shared connection.
+        with conn:
+            conn.execute('PRAGMA defer_foreign_keys=ON')
+            for table in PRIMARY_KEYS:
+                upsert_table(conn, table, context.table(table))
@@ -0,0 +1,225 @@
+from contextlib import contextmanager
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REPORT = 'run_report.json'
+DEFAULT_TEXTFILE = 'run_report.prom'
+DEFAULT_PROFILE_DIRECTORY = 'profiles'
+PROFILE_MODES = ('cpu', 'memory')
+PREFIX = 'transit_pipeline'
+
+_lock = threading.Lock()
+_spans = {}
+_counters = {}
+_gauges = {}
+_started = time.time()
+_profile = None
+
+
+def _key(name, labels):
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def count(name, value=1, **labels):
+    # Add to a counter such as rows_written or bytes_received, labelled e.g. by table
+    if not value:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def gauge(name, value, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def record(name, seconds, error=False, **labels):
+    key = _key(name, labels)
+    with _lock:
+        span = _spans.setdefault(key, {'count': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+        span['count'] += 1
+        span['errors'] += int(error)
+        span['seconds'] += seconds
+        span['max_seconds'] = max(span['max_seconds'], seconds)
+
+
+@contextmanager
+def span(name, **labels):
+    # Time a block; repeated spans with the same name and labels are aggregated into a
+    # count, total and maximum, and failures are counted separately
+    start = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        record(name, time.perf_counter() - start, error, **labels)
+
+
+def profile_mode():
+    # TRANSIT_PROFILE=cpu keeps a cProfile dump per stage, =memory records each stage's
+    # tracemalloc peak. Both add overhead, so they are off unless asked for.
+    mode = os.environ.get('TRANSIT_PROFILE', '').lower()
+    if mode and mode not in PROFILE_MODES:
+        raise ValueError(f"TRANSIT_PROFILE must be one of {PROFILE_MODES}, not {mode!r}")
+    return mode or None
+
+
+def enable_profiling(mode=None):
+    # Call from the main thread before any stage runs. tracemalloc has to be started
+    # there: starting it from a stage thread while another stage forks its process
+    # pool can deadlock the forked worker.
+    global _profile
+    _profile = profile_mode() if mode is None else mode
+    if _profile == 'memory' and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    return _profile
+
+
+@contextmanager
+def capture(name, directory=DEFAULT_PROFILE_DIRECTORY):
+    if _profile == 'cpu':
+        # cProfile only sees the calling thread, which is the stage's own worker thread
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f'{name}.prof')
+            profiler.dump_stats(path)
+            logger.info(f"Wrote cpu profile of {name} to {path}")
+    elif _profile == 'memory':
+        # The peak is process-wide, so stages running at the same time share it
+        tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            gauge('peak_traced_bytes', tracemalloc.get_traced_memory()[1], stage=name)
+    else:
+        yield
+
+
+def snapshot():
+    with _lock:
+        return {
+            'started': _started,
+            'finished': time.time(),
+            'spans': [dict(name=name, labels=dict(labels), **values) for (name, labels), values in _spans.items()],
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                         for (name, labels), value in _counters.items()],
+            'gauges': [{'name': name, 'labels': dict(labels), 'value': value}
+                       for (name, labels), value in _gauges.items()],
+        }
+
+
+def reset():
+    global _started
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+        _gauges.clear()
+        _started = time.time()
+
+
+def merge(report):
+    # Add the spans and counters of a report taken in another process to this one's;
+    # its gauges replace any of the same name and labels
+    with _lock:
+        for span in report['spans']:
+            totals = _spans.setdefault(_key(span['name'], span['labels']),
+                                       {'count': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            totals['count'] += span['count']
+            totals['errors'] += span['errors']
+            totals['seconds'] += span['seconds']
+            totals['max_seconds'] = max(totals['max_seconds'], span['max_seconds'])
+        for counter in report['counters']:
+            key = _key(counter['name'], counter['labels'])
+            _counters[key] = _counters.get(key, 0) + counter['value']
+        for value in report['gauges']:
+            _gauges[_key(value['name'], value['labels'])] = value['value']
+
+
+class Pooled:
+    # Wraps a function run by process pool workers, whose metrics would otherwise be lost
+    # with the worker. Each call starts from empty metrics, forked workers included, and
+    # returns (result, report); merged() adds the reports to the parent's metrics. Only
+    # for process pools: in process the reset would clear the caller's own metrics.
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, *args):
+        reset()
+        result = self.function(*args)
+        return result, snapshot()
+
+
+def merged(results):
+    # The results of a Pooled function, with each call's metrics merged into this process
+    for result, report in results:
+        merge(report)
+        yield result
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{label}="{value}"' for label, value in zip(labels, escaped)) + '}'
+
+
+def prometheus_text(report):
+    # Prometheus text exposition format, for node_exporter's textfile collector. The
+    # samples of a metric family must be contiguous, so they are grouped by name first.
+    families = {}
+
+    def sample(metric, kind, labels, value):
+        families.setdefault(metric, (kind, []))[1].append(f'{metric}{_labels(labels)} {value}')
+
+    for span in report['spans']:
+        metric = f"{PREFIX}_{span['name']}"
+        sample(f'{metric}_seconds_total', 'counter', span['labels'], round(span['seconds'], 6))
+        sample(f'{metric}_seconds_max', 'gauge', span['labels'], round(span['max_seconds'], 6))
+        sample(f'{metric}_calls_total', 'counter', span['labels'], span['count'])
+        sample(f'{metric}_errors_total', 'counter', span['labels'], span['errors'])
+    for counter in report['counters']:
+        sample(f"{PREFIX}_{counter['name']}_total", 'counter', counter['labels'], counter['value'])
+    for value in report['gauges']:
+        sample(f"{PREFIX}_{value['name']}", 'gauge', value['labels'], value['value'])
+    sample(f'{PREFIX}_last_run_timestamp_seconds', 'gauge', {}, round(report['finished'], 3))
+
+    lines = []
+    for metric, (kind, samples) in families.items():
+        lines.append(f'# TYPE {metric} {kind}')
+        lines += samples
+    return '\n'.join(lines) + '\n'
+
+
+def _replace(path, text):
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as f:
+        f.write(text)
+    os.replace(temporary_path, path)
+
+
+def write_report(path=DEFAULT_REPORT, textfile=DEFAULT_TEXTFILE):
+    report = snapshot()
+    _replace(path, json.dumps(report, indent=2, sort_keys=True))
+    if textfile:
+        _replace(textfile, prometheus_text(report))
+    logger.info(f"Wrote run report to {path}" + (f" and {textfile}" if textfile else ''))
+    return report
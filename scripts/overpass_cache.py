@@ -0,0 +1,158 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+import requests
+
+from scripts import metrics
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIRECTORY = '.overpass_cache'
+DEFAULT_TTL = 7 * 24 * 60 * 60  # one week, OSM entrance data changes slowly
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# Responses recorded for offline runs, used by replay mode unless OVERPASS_CACHE_DIR
+# names another directory. Refresh them by running entrances_query with
+# OVERPASS_CACHE_DIR=fixtures/overpass and OVERPASS_CACHE_TTL=0.
+FIXTURES_DIRECTORY = 'fixtures/overpass'
+
+
+class CacheMiss(Exception):
+    pass
+
+
+def normalize_query(query):
+    # Collapse whitespace so re-indenting a query does not invalidate its cache entry
+    return re.sub(r'\s+', ' ', query).strip()
+
+
+def cache_key(query, area):
+    normalized = f'{area}\n{normalize_query(query)}'
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+class OverpassCache:
+    # On-disk cache of raw Overpass JSON responses, stored gzip-compressed.
+    # Entries older than ttl seconds are refreshed from the network; if the refresh
+    # fails the stale entry is served instead. With replay_only set the network is
+    # never touched, so recorded responses can be replayed fully offline.
+    #
+    # Each response has a sidecar holding the time it was fetched, which the TTL is
+    # measured from. Reads mark an entry as used through its access time only, so
+    # eviction can drop the least recently used responses without making a response
+    # that is read every run look freshly fetched.
+
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY, ttl=DEFAULT_TTL,
+                 max_bytes=DEFAULT_MAX_BYTES, replay_only=False, timeout=180):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.replay_only = replay_only
+        self.timeout = timeout
+
+    @classmethod
+    def from_environment(cls):
+        replay_only = os.environ.get('OVERPASS_REPLAY', '') not in ('', '0', 'false')
+        return cls(
+            directory=os.environ.get('OVERPASS_CACHE_DIR',
+                                     FIXTURES_DIRECTORY if replay_only else DEFAULT_CACHE_DIRECTORY),
+            ttl=float(os.environ.get('OVERPASS_CACHE_TTL', DEFAULT_TTL)),
+            max_bytes=int(os.environ.get('OVERPASS_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES)),
+            replay_only=replay_only,
+        )
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{key}.json.gz')
+
+    def metadata_path(self, key):
+        return os.path.join(self.directory, f'{key}.meta.json')
+
+    def read(self, key):
+        path = self.path(key)
+        with gzip.open(path, 'rb') as f:
+            data = f.read()
+        # Mark the entry as used for eviction; its modification time is left alone
+        os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+        return data
+
+    def write(self, key, data, fetched=None):
+        os.makedirs(self.directory, exist_ok=True)
+        temporary_path = self.path(key) + '.tmp'
+        with gzip.open(temporary_path, 'wb') as f:
+            f.write(data)
+        os.replace(temporary_path, self.path(key))
+        temporary_path = self.metadata_path(key) + '.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump({'fetched': time.time() if fetched is None else fetched}, f)
+        os.replace(temporary_path, self.metadata_path(key))
+        self.evict()
+
+    def age(self, key):
+        if not os.path.exists(self.path(key)):
+            return None
+        try:
+            with open(self.metadata_path(key)) as f:
+                fetched = json.load(f)['fetched']
+        except (FileNotFoundError, ValueError, KeyError):
+            # Entries written before the sidecar existed were fetched when last written
+            fetched = os.path.getmtime(self.path(key))
+        return time.time() - fetched
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json.gz'):
+                key = name[:-len('.json.gz')]
+                stat = os.stat(self.path(key))
+                size = stat.st_size
+                if os.path.exists(self.metadata_path(key)):
+                    size += os.path.getsize(self.metadata_path(key))
+                entries.append((stat.st_atime, size, key))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(self.path(key))
+            if os.path.exists(self.metadata_path(key)):
+                os.remove(self.metadata_path(key))
+            total -= size
+            logger.info(f"Evicted Overpass cache entry {key}")
+
+    def fetch(self, api, query, area):
+        key = cache_key(query, area)
+        age = self.age(key)
+
+        if self.replay_only:
+            if age is None:
+                raise CacheMiss(f"No recorded Overpass response for {area} query {key[:12]}")
+            metrics.count('cache_hits', service='overpass')
+            return self.read(key)
+
+        if age is not None and age < self.ttl:
+            logger.info(f"Overpass cache hit for {area} query {key[:12]}")
+            metrics.count('cache_hits', service='overpass')
+            return self.read(key)
+
+        try:
+            with metrics.span('request', service='overpass'):
+                response = requests.post(api.url, data=query.encode('utf-8'), timeout=self.timeout)
+                response.raise_for_status()
+        except requests.RequestException as e:
+            if age is None:
+                raise
+            logger.warning(f"Overpass refresh failed, serving stale cache entry {key[:12]}: {e}")
+            return self.read(key)
+
+        metrics.count('bytes_received', len(response.content), service='overpass')
+        self.write(key, response.content)
+        logger.info(f"Overpass cache refreshed for {area} query {key[:12]}")
+        return response.content
+
+    def query(self, api, query, area):
+        return api.parse_json(self.fetch(api, query, area))
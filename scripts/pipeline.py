@@ -0,0 +1,140 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from scripts import metrics
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MANIFEST = 'pipeline_manifest.json'
+
+
+class Stage:
+    # A pipeline step with the files it reads and writes. Stages that consume another
+    # stage's outputs run after it; after names extra ordering constraints for stages
+    # that share no files. Stages marked always run even when their inputs are unchanged,
+    # for steps whose real input lives outside the repository such as an API.
+
+    def __init__(self, name, run, inputs=(), outputs=(), after=(), always=False):
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.after = list(after)
+        self.always = always
+
+
+def process_context():
+    # Stages run on threads, and forking while another stage's thread holds a lock (an
+    # import in progress, say) copies the held lock into the child, which then hangs.
+    # Process pools inside stages use this to fork only when no other thread is running.
+    if threading.active_count() == 1:
+        return None
+    return multiprocessing.get_context('forkserver')
+
+
+def file_hash(path):
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, path):
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(temporary_path, path)
+
+
+def dependencies(stages):
+    producers = {output: stage.name for stage in stages for output in stage.outputs}
+    return {
+        stage.name: {producers[path] for path in stage.inputs if path in producers} | set(stage.after)
+        for stage in stages
+    }
+
+
+def is_fresh(stage, manifest):
+    # A stage can be skipped when its inputs hash the same as on its last successful run
+    # and its outputs are still exactly what it wrote then
+    entry = manifest.get(stage.name)
+    if stage.always or entry is None:
+        return False
+    inputs = {path: file_hash(path) for path in stage.inputs}
+    outputs = {path: file_hash(path) for path in stage.outputs}
+    return inputs == entry['inputs'] and outputs == entry['outputs'] and None not in outputs.values()
+
+
+def run_stage(stage, manifest, force):
+    if not force and is_fresh(stage, manifest):
+        logger.info(f"Skipping stage {stage.name}, inputs unchanged")
+        metrics.count('stages_skipped', stage=stage.name)
+        return None
+
+    logger.info(f"Running stage {stage.name}")
+    start = time.perf_counter()
+    with metrics.span('stage', stage=stage.name), metrics.capture(stage.name):
+        stage.run()
+    elapsed = time.perf_counter() - start
+    logger.info(f"Stage {stage.name} finished in {elapsed:.2f}s")
+
+    return {
+        'inputs': {path: file_hash(path) for path in stage.inputs},
+        'outputs': {path: file_hash(path) for path in stage.outputs},
+        'seconds': round(elapsed, 3),
+    }
+
+
+def run(stages, manifest_path=DEFAULT_MANIFEST, max_workers=4, force=False):
+    # Run stages as soon as everything they depend on has finished, up to max_workers
+    # at a time. The manifest is rewritten after every completed stage so a failure
+    # midway keeps the record of the stages that did finish.
+    manifest = load_manifest(manifest_path)
+    by_name = {stage.name: stage for stage in stages}
+    waiting_on = dependencies(stages)
+    done = set()
+    running = {}
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(done) < len(stages):
+            for name, needs in waiting_on.items():
+                if name not in done and name not in running.values() and needs <= done:
+                    running[executor.submit(run_stage, by_name[name], manifest, force)] = name
+            if not running:
+                raise ValueError(f"Stages {sorted(set(by_name) - done)} have unsatisfiable dependencies")
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    entry = future.result()
+                except Exception:
+                    logger.exception(f"Stage {name} failed")
+                    wait(running)
+                    save_manifest(manifest, manifest_path)
+                    raise
+                if entry is not None:
+                    manifest[name] = entry
+                    save_manifest(manifest, manifest_path)
+                done.add(name)
+
+    logger.info(f"Pipeline finished in {time.perf_counter() - start:.2f}s")
+    return manifest
@@ -0,0 +1,286 @@
+import asyncio
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import math
+import os
+import sqlite3
+import time
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import pandas as pd
+
+from scripts.entrance_resolution import StationEntranceIndex
+from scripts.geometry_store import LazyGeometry
+from scripts.load_sql import DATABASE, ISOCHRONE_DATABASE, STATION_ISOCHRONES
+from scripts.spatial_query import SpatialIndex
+from scripts.table_diff import to_records
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 4096
+DEFAULT_CACHE_TTL = 300
+DEFAULT_RELOAD_INTERVAL = 30
+MAX_NEAREST = 50
+
+
+class NotFound(Exception):
+    pass
+
+
+class BadRequest(Exception):
+    pass
+
+
+def database_version(*databases):
+    # Changes whenever one of the files does; a file that does not exist yet counts too
+    versions = []
+    for database in databases:
+        stat = os.stat(database) if os.path.exists(database) else None
+        versions.append(f'{stat.st_mtime_ns:x}-{stat.st_size:x}' if stat else 'none')
+    return '-'.join(versions)
+
+
+class Snapshot:
+    # Everything the service answers from, read once from the database and never
+    # modified afterwards. A reload builds a new Snapshot and swaps the reference.
+
+    def __init__(self, database=DATABASE, isochrone_database=ISOCHRONE_DATABASE):
+        self.version = database_version(database, isochrone_database)
+        conn = sqlite3.connect(f'file:{database}?mode=ro', uri=True)
+        try:
+            stations = pd.read_sql('SELECT * FROM stations', conn)
+            entrances = pd.read_sql('SELECT * FROM entrances', conn)
+            station_entrances = pd.read_sql('SELECT * FROM station_entrances', conn)
+        finally:
+            conn.close()
+        # Written by the isochrones_sql stage; the endpoint answers 404 until it has run
+        isochrones = None
+        if os.path.exists(isochrone_database):
+            conn = sqlite3.connect(f'file:{isochrone_database}?mode=ro', uri=True)
+            try:
+                tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+                if STATION_ISOCHRONES in tables:
+                    isochrones = pd.read_sql(f'SELECT station_id, value, geometry, min_x, min_y, max_x, max_y, area '
+                                             f'FROM {STATION_ISOCHRONES}', conn)
+            finally:
+                conn.close()
+
+        self.stations = tuple(to_records(stations))
+        self.stations_by_id = {station['station_id']: station for station in self.stations}
+        self.stations_by_region = self._group(self.stations, 'region')
+        # Kept apart so a route_id that happens to equal another line's name can not shadow it
+        self.stations_by_line = self._group(self.stations, 'route_name')
+        self.stations_by_route = self._group(self.stations, 'route_id')
+
+        entrances_by_id = {entrance['entrance_id']: entrance for entrance in to_records(entrances)}
+        entrance_index = StationEntranceIndex.from_relations(station_entrances)
+        self.entrances_by_station = {
+            code: tuple(entrances_by_id[entrance_id] for entrance_id in entrance_ids if entrance_id in entrances_by_id)
+            for code, entrance_ids in entrance_index.entrances_by_station.items()
+        }
+
+        self.indexes = {
+            'stations': SpatialIndex(stations['station_id'], stations['latitude'], stations['longitude']),
+            'entrances': SpatialIndex(entrances['entrance_id'], entrances['latitude'], entrances['longitude']),
+        }
+        self.records = {'stations': self.stations_by_id, 'entrances': entrances_by_id}
+
+        self.isochrones = {}
+        if isochrones is not None:
+            # A band with no geometry has nothing to draw; it is left out rather than
+            # failing the whole snapshot
+            missing = isochrones['geometry'].isna()
+            if missing.any():
+                logger.warning(f"Skipping {int(missing.sum())} station isochrones without a geometry")
+            for row in isochrones[~missing].itertuples():
+                # Held encoded, as scripts/station_isochrones stores it; a geometry is only
+                # decoded when its station is first asked for
+                geometry = LazyGeometry(row.geometry, [row.min_x, row.min_y, row.max_x, row.max_y], row.area)
+                self.isochrones.setdefault(int(row.station_id), []).append((row.value, geometry))
+        logger.info(f"Loaded snapshot {self.version}: {len(self.stations)} stations, "
+                    f"{len(entrances_by_id)} entrances, {len(self.isochrones)} station isochrones")
+
+    @staticmethod
+    def _group(records, column):
+        grouped = {}
+        for record in records:
+            if record.get(column) is not None:
+                grouped.setdefault(str(record[column]).lower(), []).append(record)
+        return {key: tuple(items) for key, items in grouped.items()}
+
+    def query(self, path, params):
+        parts = [unquote(part) for part in path.strip('/').split('/')]
+        if parts == ['stations']:
+            stations = self.stations
+            if 'region' in params:
+                stations = self.stations_by_region.get(params['region'].lower(), ())
+            for param, groups in [('line', self.stations_by_line), ('route', self.stations_by_route)]:
+                if param in params:
+                    matches = groups.get(params[param].lower(), ())
+                    if stations is not self.stations:
+                        match_ids = {station['station_id'] for station in matches}
+                        matches = [station for station in stations if station['station_id'] in match_ids]
+                    stations = matches
+            return list(stations)
+        if len(parts) == 3 and parts[0] == 'stations' and parts[2] == 'entrances':
+            return list(self.entrances_by_station.get(parts[1], ()))
+        if parts == ['nearest']:
+            return self._nearest(params)
+        if len(parts) == 2 and parts[0] == 'isochrones':
+            bands = self.isochrones.get(int(parts[1])) if parts[1].isdigit() else None
+            if not bands:
+                raise NotFound(f'No isochrones for station {parts[1]}')
+            return {'type': 'FeatureCollection', 'features': [
+                {'type': 'Feature', 'bbox': geometry.bbox,
+                 'properties': {'station_id': int(parts[1]), 'value': value, 'area': geometry.area},
+                 'geometry': geometry.__geo_interface__}
+                for value, geometry in bands]}
+        raise NotFound(path)
+
+    def _nearest(self, params):
+        try:
+            latitude, longitude = float(params['lat']), float(params['lon'])
+            k = min(int(params.get('k', 1)), MAX_NEAREST)
+        except (KeyError, ValueError):
+            raise BadRequest('nearest needs numeric lat and lon')
+        # nan and inf parse as floats but compare false with every bound, so check finiteness first
+        if not (math.isfinite(latitude) and math.isfinite(longitude)
+                and -90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise BadRequest('nearest needs lat within -90 and 90 and lon within -180 and 180')
+        if k < 1:
+            raise BadRequest('k must be at least 1')
+        table = params.get('table', 'stations')
+        if table not in self.indexes:
+            raise BadRequest(f'Unknown table {table}')
+        ids, distances = self.indexes[table].batch_nearest([latitude], [longitude], k)
+        return [dict(self.records[table][identifier], distance_m=round(float(distance), 1))
+                for identifier, distance in zip(ids[0].tolist(), distances[0])]
+
+
+class ResponseCache:
+    # LRU of encoded response bodies with a time to live, keyed by snapshot version and URL
+
+    def __init__(self, size=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+class QueryService:
+
+    def __init__(self, database=DATABASE, cache_size=DEFAULT_CACHE_SIZE, cache_ttl=DEFAULT_CACHE_TTL,
+                 reload_interval=DEFAULT_RELOAD_INTERVAL, isochrone_database=ISOCHRONE_DATABASE):
+        self.database = database
+        self.isochrone_database = isochrone_database
+        self.snapshot = Snapshot(database, isochrone_database)
+        self.cache = ResponseCache(cache_size, cache_ttl)
+        self.reload_interval = reload_interval
+
+    async def reload_when_changed(self):
+        # Build the new snapshot off the event loop, then swap it in with one assignment
+        # so in-flight requests finish on the snapshot they started with
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                if database_version(self.database, self.isochrone_database) != self.snapshot.version:
+                    self.snapshot = await asyncio.get_running_loop().run_in_executor(
+                        None, Snapshot, self.database, self.isochrone_database)
+            except Exception:
+                logger.exception("Reloading the database failed, still serving the previous snapshot")
+
+    def respond(self, target, if_none_match=None):
+        snapshot = self.snapshot
+        key = (snapshot.version, target)
+        cached = self.cache.get(key)
+        if cached is None:
+            parts = urlsplit(target)
+            params = {name: values[-1] for name, values in parse_qs(parts.query).items()}
+            try:
+                body = json.dumps(snapshot.query(parts.path, params), default=str).encode('utf-8')
+                status = 200
+            except NotFound as e:
+                body, status = json.dumps({'error': f'not found: {e}'}).encode('utf-8'), 404
+            except BadRequest as e:
+                body, status = json.dumps({'error': str(e)}).encode('utf-8'), 400
+            except Exception:
+                logger.exception(f"Query {target} failed")
+                body, status = b'{"error": "internal server error"}', 500
+            cached = (status, body, '"' + hashlib.sha1(body).hexdigest() + '"')
+            if status == 200:
+                self.cache.put(key, cached)
+
+        status, body, etag = cached
+        if status == 200 and if_none_match == etag:
+            return 304, b'', etag
+        return status, body, etag
+
+    async def handle(self, reader, writer):
+        # Minimal HTTP/1.1 with keep-alive; only GET is served
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                except ValueError:
+                    # Not an HTTP request line, so there is no request to answer
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                if method != 'GET':
+                    status, body, etag = 405, b'{"error": "method not allowed"}', None
+                else:
+                    status, body, etag = self.respond(target, headers.get('if-none-match'))
+                close = headers.get('connection', '').lower() == 'close'
+                reason = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found',
+                          405: 'Method Not Allowed', 500: 'Internal Server Error'}[status]
+                head = [f'HTTP/1.1 {status} {reason}', 'Content-Type: application/json',
+                        f'Content-Length: {len(body)}', 'Connection: ' + ('close' if close else 'keep-alive')]
+                if etag:
+                    head.append(f'ETag: {etag}')
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+                await writer.drain()
+                if close:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8000, ready=None):
+        server = await asyncio.start_server(self.handle, host, port)
+        reloader = asyncio.ensure_future(self.reload_when_changed())
+        logger.info(f"Serving {self.database} on {host}:{server.sockets[0].getsockname()[1]}")
+        if ready is not None:
+            ready(server.sockets[0].getsockname()[1])
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            reloader.cancel()
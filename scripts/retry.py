@@ -0,0 +1,22 @@
+import logging
+import random
+import time
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+
+
+def with_retry(request, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+    # Retry a request with exponential backoff and jitter, re-raising the last error
+    for attempt in range(retries + 1):
+        try:
+            return request()
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt * (1 + random.random())
+            logger.warning(f"Request failed ({e}), retrying in {delay:.2f}s")
+            time.sleep(delay)
@@ -0,0 +1,185 @@
+import logging
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from scripts.load_sql import DATABASE, PRIMARY_KEYS
+
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_M = 6_371_008.8
+DEFAULT_CELL_M = 500
+# Beyond this many rings of cells a nearest-neighbour search falls back to a brute force scan
+MAX_RINGS = 6
+# Upper bound on (query, neighbouring cell) pairs expanded at once
+MAX_PAIRS = 2_000_000
+_BIAS = 1 << 20
+
+
+def unit_vectors(latitudes, longitudes):
+    latitudes = np.radians(np.asarray(latitudes, dtype='float64'))
+    longitudes = np.radians(np.asarray(longitudes, dtype='float64'))
+    return np.column_stack([
+        np.cos(latitudes) * np.cos(longitudes),
+        np.cos(latitudes) * np.sin(longitudes),
+        np.sin(latitudes),
+    ])
+
+
+def haversine(latitudes_1, longitudes_1, latitudes_2, longitudes_2):
+    latitudes_1, longitudes_1 = np.radians(latitudes_1), np.radians(longitudes_1)
+    latitudes_2, longitudes_2 = np.radians(latitudes_2), np.radians(longitudes_2)
+    a = (np.sin((latitudes_2 - latitudes_1) / 2) ** 2
+         + np.cos(latitudes_1) * np.cos(latitudes_2) * np.sin((longitudes_2 - longitudes_1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def chord(meters):
+    # Straight-line distance through the unit sphere for a great-circle distance in meters
+    return 2 * np.sin(np.minimum(np.asarray(meters, dtype='float64') / (2 * EARTH_RADIUS_M), np.pi / 2))
+
+
+def _pack(cells):
+    cells = cells + _BIAS
+    return (cells[..., 0] << 42) | (cells[..., 1] << 21) | cells[..., 2]
+
+
+class SpatialIndex:
+    # Points are placed on the unit sphere and bucketed into a uniform 3D grid, so cell
+    # neighbourhoods are exact everywhere on earth with no projection distortion. The
+    # grid is kept as sorted cell keys plus start/end offsets into the point arrays,
+    # which lets whole batches of queries gather their candidate points with
+    # searchsorted and repeat instead of per-query Python loops. rows, when given, are
+    # the full records the single-point queries return, with the ids in column key.
+
+    def __init__(self, ids, latitudes, longitudes, rows=None, cell_m=DEFAULT_CELL_M, key=None):
+        if rows is not None and key is None:
+            raise ValueError("rows need the key column that holds their ids")
+        self.ids = np.asarray(ids)
+        self.latitudes = np.asarray(latitudes, dtype='float64')
+        self.longitudes = np.asarray(longitudes, dtype='float64')
+        self.rows = rows
+        self.key = key
+        self.cell_m = cell_m
+        self.cell = float(chord(cell_m))
+
+        keys = _pack(np.floor(unit_vectors(self.latitudes, self.longitudes) / self.cell).astype('int64'))
+        self.order = np.argsort(keys, kind='stable')
+        self.cell_keys, self.cell_starts, counts = np.unique(keys[self.order], return_index=True, return_counts=True)
+        self.cell_ends = self.cell_starts + counts
+
+    @classmethod
+    def from_database(cls, table='stations', database=DATABASE, cell_m=DEFAULT_CELL_M):
+        conn = sqlite3.connect(database)
+        try:
+            rows = pd.read_sql(f'SELECT * FROM {table} WHERE latitude IS NOT NULL AND longitude IS NOT NULL', conn)
+        finally:
+            conn.close()
+        logger.info(f"Built spatial index over {len(rows)} {table}")
+        key = PRIMARY_KEYS[table]
+        return cls(rows[key], rows['latitude'], rows['longitude'], rows, cell_m, key)
+
+    def _rings(self, radius_m):
+        return int(np.ceil(chord(radius_m) / self.cell - 1e-9))
+
+    def _candidates(self, latitudes, longitudes, rings):
+        # (query position, point position) pairs for every point in the cells within
+        # rings cells of each query's cell
+        span = np.arange(-rings, rings + 1)
+        offsets = np.stack(np.meshgrid(span, span, span, indexing='ij'), axis=-1).reshape(-1, 3)
+        cells = np.floor(unit_vectors(latitudes, longitudes) / self.cell).astype('int64')
+        keys = _pack(cells[:, None, :] + offsets[None, :, :]).ravel()
+
+        positions = np.searchsorted(self.cell_keys, keys)
+        positions[positions == len(self.cell_keys)] = 0
+        hit = self.cell_keys[positions] == keys
+        queries = np.repeat(np.arange(len(cells)), len(offsets))[hit]
+        starts = self.cell_starts[positions[hit]]
+        counts = self.cell_ends[positions[hit]] - starts
+
+        within_cell = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return np.repeat(queries, counts), self.order[np.repeat(starts, counts) + within_cell]
+
+    def _chunks(self, n, rings):
+        size = max(1, MAX_PAIRS // (2 * rings + 1) ** 3)
+        for start in range(0, n, size):
+            yield slice(start, min(start + size, n))
+
+    def batch_within(self, latitudes, longitudes, radius_m):
+        # Returns (query position, point id, distance in meters) for every point within
+        # radius_m of each query
+        latitudes = np.atleast_1d(np.asarray(latitudes, dtype='float64'))
+        longitudes = np.atleast_1d(np.asarray(longitudes, dtype='float64'))
+        rings = self._rings(radius_m)
+        results = []
+        for chunk in self._chunks(len(latitudes), rings):
+            queries, points = self._candidates(latitudes[chunk], longitudes[chunk], rings)
+            queries += chunk.start
+            distances = haversine(latitudes[queries], longitudes[queries],
+                                  self.latitudes[points], self.longitudes[points])
+            keep = distances <= radius_m
+            results.append((queries[keep], points[keep], distances[keep]))
+        if not results:
+            return np.empty(0, dtype='int64'), self.ids[:0], np.empty(0)
+        queries, points, distances = (np.concatenate(parts) for parts in zip(*results))
+        order = np.lexsort((distances, queries))
+        return queries[order], self.ids[points[order]], distances[order]
+
+    def _brute_force_nearest(self, latitudes, longitudes, k):
+        size = max(1, MAX_PAIRS // max(len(self.ids), 1))
+        ids, distances = [], []
+        for start in range(0, len(latitudes), size):
+            d = haversine(latitudes[start:start + size, None], longitudes[start:start + size, None],
+                          self.latitudes[None, :], self.longitudes[None, :])
+            if k < len(self.ids):
+                nearest = np.argpartition(d, k - 1, axis=1)[:, :k]
+            else:
+                nearest = np.tile(np.arange(len(self.ids)), (len(d), 1))
+            nearest_distances = np.take_along_axis(d, nearest, axis=1)
+            order = np.argsort(nearest_distances, axis=1)
+            ids.append(self.ids[np.take_along_axis(nearest, order, axis=1)])
+            distances.append(np.take_along_axis(nearest_distances, order, axis=1))
+        return np.concatenate(ids), np.concatenate(distances)
+
+    def batch_nearest(self, latitudes, longitudes, k=1):
+        # Returns (ids, distances) arrays of shape (queries, k), nearest first. Each query
+        # searches a growing radius until it holds k points, which makes its k nearest exact.
+        latitudes = np.atleast_1d(np.asarray(latitudes, dtype='float64'))
+        longitudes = np.atleast_1d(np.asarray(longitudes, dtype='float64'))
+        k = min(k, len(self.ids))
+        ids = np.empty((len(latitudes), k), dtype=self.ids.dtype)
+        distances = np.empty((len(latitudes), k))
+
+        pending = np.arange(len(latitudes))
+        radius_m = self.cell_m
+        while len(pending) and self._rings(radius_m) <= MAX_RINGS:
+            queries, found_ids, found_distances = self.batch_within(latitudes[pending], longitudes[pending], radius_m)
+            counts = np.bincount(queries, minlength=len(pending))
+            rank = np.arange(len(queries)) - np.repeat(np.cumsum(counts) - counts, counts)
+            take = (rank < k) & (counts[queries] >= k)
+            rows = pending[queries[take]]
+            ids[rows, rank[take]] = found_ids[take]
+            distances[rows, rank[take]] = found_distances[take]
+            pending = pending[counts < k]
+            radius_m *= 2
+
+        if len(pending):
+            ids[pending], distances[pending] = self._brute_force_nearest(latitudes[pending], longitudes[pending], k)
+        return ids, distances
+
+    def _result_rows(self, ids, distances):
+        if self.rows is None:
+            return pd.DataFrame({'id': ids, 'distance_m': distances})
+        rows = self.rows.set_index(self.key).loc[ids].reset_index()
+        rows['distance_m'] = distances
+        return rows
+
+    def nearest(self, latitude, longitude, k=1):
+        ids, distances = self.batch_nearest([latitude], [longitude], k)
+        return self._result_rows(ids[0], distances[0])
+
+    def within(self, latitude, longitude, radius_m):
+        _, ids, distances = self.batch_within([latitude], [longitude], radius_m)
+        return self._result_rows(ids, distances)
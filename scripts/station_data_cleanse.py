@@ -1,90 +1,71 @@
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import os
 import logging
+import time
 
+from scripts.city_sources import CITY_SOURCES
+from scripts import metrics
+from scripts import storage
+from scripts.pipeline import process_context
 
 
-logger = logging.getLogger(__name__)
 
+logger = logging.getLogger(__name__)
 
-def run():
-    data_directory = 'data'
-    kl_file = 'klang_valley_stations.csv'
-    montreal_file = 'montreal_metro.csv'
-    singapore_file = 'mrtsg.csv'
+data_directory = 'data'
+cleansed_data_directory = 'data_cleansed'
 
-    logger.info("Running station data cleansing process")
-    kl_data = pd.read_csv(os.path.join(data_directory, kl_file))
-    montreal_data = pd.read_csv(os.path.join(data_directory, montreal_file))
-    singapore_data = pd.read_csv(os.path.join(data_directory, singapore_file))
 
+def normalize_columns(data):
     # We would now normalize/standardize the column names of the dataframe to ensure consistency
-    kl_data.columns = kl_data.columns.str.lower().str.replace(' ', '_')
-    montreal_data.columns = montreal_data.columns.str.lower().str.replace(' ', '_')
-    singapore_data.columns = singapore_data.columns.str.lower().str.replace(' ', '_')
+    data.columns = data.columns.str.lower().str.replace(' ', '_')
+    return data
 
 
+def cleanse_city(source):
+    start = time.perf_counter()
+    data = normalize_columns(pd.read_csv(os.path.join(data_directory, source.file)))
 
     #ensure only first letter of a column is capitalized
-    kl_data['name'] = kl_data['name'].str.title()
-    montreal_data['name'] = montreal_data['name'].str.title()
-    singapore_data['line_colour'] = singapore_data['line_colour'].str.title()
-
-
-
+    for column in source.title_case:
+        data[column] = data[column].str.title()
 
     #drop irrelevant columns
-    montreal_data=montreal_data.drop(columns=['index'])
-    singapore_data=singapore_data.drop(columns=['objectid','x','y'])
+    data = data.drop(columns=source.drop)
 
-
-    # Rename columns
-    kl_data = kl_data.rename(columns={
-        'city': 'region',
-        'stop_id':'station_code'
-    })
-    montreal_data = montreal_data.rename(columns={
-        '_stop_id': 'station_code',
-        'city':'region'
-    })
     # Rename columns
-    singapore_data = singapore_data.rename(columns={
-        'stn_no': 'station_code',
-        'route_code':'route_id',
-        'city':'region'
-    })
-
+    data = data.rename(columns=source.rename)
+    data['region'] = source.region
 
     # Rename rows
+    if source.name_overrides:
+        data['name'] = data['name'].replace(source.name_overrides)
 
-    kl_data['name'] = kl_data['name'].replace({
-        "Kl Sentral": "KL Sentral",
-        "Ukm": "UKM",
-        "Pwtc": "PWTC",
-        "Taman Perindustrian Puchong (Tpp)":"Taman Perindustrian Puchong (TPP)",
-        "Klcc":"KLCC",
-        "Ss15":"SS15",
-        "Ss18": "SS18", 
-        "Usj7" : "USJ7",
-        "Usj21" : "USJ21",
-        "Klia2" : "KLIA2",
-        "Ttdi" : "TTDI",
-        "Sunu Monash" : "SunU Monash",
-        "South Quay-Usj1" : "South Quay-USJ1",
-        "Persiaran Klcc" : "Persiaran KLCC",
-        "Upm" : "UPM",
-        "Bu11" : "BU11",
-        "Ss7" : "SS7",
-        "Uitm" : "UiTM"
-                })
-
-    # Define the directory where you want to save the cleaned data
-    cleansed_data_directory = 'data_cleansed'
-    cleansed_kl_file = 'klang_valley_stations_cleansed.csv'
-    cleansed_montreal_file = 'montreal_stations_cleansed.csv'
-    cleansed_singapore_file = 'singapore_stations_cleansed.csv'
-
-    # Save the cleaned dataframes
-    kl_data.to_csv(os.path.join(cleansed_data_directory, cleansed_kl_file), index=False)
-    montreal_data.to_csv(os.path.join(cleansed_data_directory, cleansed_montreal_file), index=False)
-    singapore_data.to_csv(os.path.join(cleansed_data_directory, cleansed_singapore_file), index=False)
+    data.to_csv(os.path.join(cleansed_data_directory, source.cleansed_file), index=False)
+    return data, time.perf_counter() - start
+
+
+def run(sources=CITY_SOURCES, max_workers=None):
+    # Cleanse every city in its own process, then write all of them as one combined
+    # table whose station_id follows the order of sources. max_workers=1 runs in process.
+    logger.info("Running station data cleansing process")
+    start = time.perf_counter()
+
+    if max_workers == 1:
+        results = [cleanse_city(source) for source in sources]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=process_context()) as executor:
+            results = list(metrics.merged(executor.map(metrics.Pooled(cleanse_city), sources)))
+        # Whatever the slowest city does not account for is process startup and transfer
+        overhead = time.perf_counter() - start - max((elapsed for _, elapsed in results), default=0)
+        logger.info(f"Cleanse worker pool overhead {overhead:.2f}s")
+
+    for source, (data, elapsed) in zip(sources, results):
+        logger.info(f"Cleansed {len(data)} {source.name} stations in {elapsed:.3f}s")
+
+    combined = pd.concat([data for data, _ in results], axis=0, ignore_index=True)
+    combined.index.name = 'station_id'
+    combined = storage.write_table(combined.reset_index(), 'stations')
+    logger.info(f"Station data cleansing complete in {time.perf_counter() - start:.2f}s")
+    return combined
@@ -0,0 +1,156 @@
+import logging
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from scripts import metrics
+from scripts import storage
+from scripts.data_context import borrowed
+from scripts.spatial_query import SpatialIndex
+from scripts.transit_graph import normalized_names
+
+
+logger = logging.getLogger(__name__)
+
+# Stations are compared only with the others inside the spatial index's grid cells
+# around them, so cities never meet and the work grows with the stations rather than
+# their pairs. Two rows are the same physical station when they lie within
+# MAX_DISTANCE_M of each other and their names' estimated 3-gram Jaccard similarity is
+# at least NAME_THRESHOLD. The distance covers one interchange filed once per line with
+# the platforms' own coordinates; the threshold accepts 'Dhoby Ghaut MRT Station'
+# against 'Dhoby Ghaut' and 'Berri–Uqam' against 'Berri-UQAM', but not 'Taman Jaya'
+# against 'Taman Bahagia'.
+MAX_DISTANCE_M = 500
+NAME_THRESHOLD = 0.6
+NGRAM = 3
+NUM_PERMUTATIONS = 64
+# Mersenne prime modulus of the MinHash permutations (a * x + b) % PRIME
+PRIME = (1 << 31) - 1
+SEED = 0
+# Permutations hashed at once, bounding the (shingles, permutations) array
+PERMUTATION_CHUNK = 16
+PAIR_CHUNK = 1_000_000
+
+
+def shingles(names):
+    # (row, shingle hash) for every character NGRAM of each name, padded with a space at
+    # both ends so short names still have a few. Rows with no name get no shingles.
+    rows, hashes = [], []
+    cache = {}
+    for row, name in enumerate(names):
+        if name is pd.NA or name is None or not name:
+            continue
+        padded = f' {name} '
+        grams = {padded[i:i + NGRAM] for i in range(max(1, len(padded) - NGRAM + 1))}
+        for gram in grams:
+            value = cache.get(gram)
+            if value is None:
+                value = cache[gram] = zlib.crc32(gram.encode('utf-8'))
+            rows.append(row)
+            hashes.append(value)
+    return np.array(rows, dtype='int64'), np.array(hashes, dtype='int64')
+
+
+def minhash_signatures(names, num_permutations=NUM_PERMUTATIONS, seed=SEED):
+    # One row of num_permutations minimum hashes per name; two names agree on a share of
+    # positions that estimates the Jaccard similarity of their shingle sets. Rows without
+    # a name are all PRIME, which no permuted hash reaches; name_similarity gives them 0.
+    rows, hashes = shingles(names)
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, PRIME, num_permutations, dtype='int64')
+    b = rng.integers(0, PRIME, num_permutations, dtype='int64')
+    signatures = np.full((len(names), num_permutations), PRIME, dtype='int64')
+    if not len(rows):
+        return signatures
+    # shingles() emits each row's shingles together, so every row is one segment
+    starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+    for start in range(0, num_permutations, PERMUTATION_CHUNK):
+        chunk = slice(start, start + PERMUTATION_CHUNK)
+        permuted = (hashes[:, None] * a[chunk] + b[chunk]) % PRIME
+        signatures[rows[starts], chunk] = np.minimum.reduceat(permuted, starts, axis=0)
+    return signatures
+
+
+def candidate_pairs(latitudes, longitudes, max_distance_m=MAX_DISTANCE_M):
+    # Every pair within max_distance_m, each once, from the grid index rather than all
+    # pairs: near linear as long as stations are not piled into a few cells
+    index = SpatialIndex(np.arange(len(latitudes)), latitudes, longitudes)
+    queries, points, distances = index.batch_within(latitudes, longitudes, max_distance_m)
+    keep = queries < points
+    return queries[keep], points[keep], distances[keep]
+
+
+def name_similarity(signatures, first, second):
+    # Pairs where either row has no name are 0: two all-PRIME signatures agree
+    # everywhere, yet say nothing about whether the stations are the same
+    named = signatures[:, 0] != PRIME
+    similarity = np.empty(len(first))
+    for start in range(0, len(first), PAIR_CHUNK):
+        chunk = slice(start, start + PAIR_CHUNK)
+        similarity[chunk] = (signatures[first[chunk]] == signatures[second[chunk]]).mean(axis=1)
+    similarity[~(named[first] & named[second])] = 0.0
+    return similarity
+
+
+def components(n, first, second):
+    # Connected components by union-find with path halving; returns each row's root
+    parent = np.arange(n)
+
+    def root(row):
+        while parent[row] != row:
+            parent[row] = parent[parent[row]]
+            row = parent[row]
+        return row
+
+    for a, b in zip(first.tolist(), second.tolist()):
+        root_a, root_b = root(a), root(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+    return np.array([root(row) for row in range(n)])
+
+
+def canonical_ids(stations, max_distance_m=MAX_DISTANCE_M, threshold=NAME_THRESHOLD):
+    # Maps every station_id to the smallest station_id of its duplicate cluster, so the
+    # mapping is stable as long as that station stays. Returns the mapping and the
+    # matched pairs with their distance and name similarity.
+    stations = stations.reset_index(drop=True)
+    names = normalized_names(stations['name'])
+    signatures = minhash_signatures(names.tolist())
+    first, second, distances = candidate_pairs(stations['latitude'].to_numpy(), stations['longitude'].to_numpy(),
+                                               max_distance_m)
+    similarity = name_similarity(signatures, first, second)
+    matched = similarity >= threshold
+    first, second = first[matched], second[matched]
+
+    # Order rows by station_id so each component's root is its smallest id
+    station_ids = stations['station_id'].to_numpy()
+    order = np.argsort(station_ids, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    roots = components(len(stations), rank[first], rank[second])
+    canonical = station_ids[order][roots[rank]]
+
+    mapping = pd.DataFrame({'station_id': station_ids, 'canonical_id': canonical})
+    mapping['duplicates'] = mapping.groupby('canonical_id')['station_id'].transform('size') - 1
+    pairs = pd.DataFrame({
+        'station_id': station_ids[first],
+        'duplicate_id': station_ids[second],
+        'distance_m': distances[matched],
+        'name_similarity': similarity[matched],
+    })
+    return mapping, pairs
+
+
+def run(context=None):
+    logger.info("Find duplicate stations")
+    start = time.perf_counter()
+    with borrowed(context) as context:
+        stations = context.table('stations')
+    mapping, pairs = canonical_ids(stations)
+    storage.write_table(mapping, 'station_canonical_ids')
+    metrics.gauge('duplicate_stations', int((mapping['canonical_id'] != mapping['station_id']).sum()))
+    logger.info(f"{len(stations)} stations map to {mapping['canonical_id'].nunique()} canonical stations "
+                f"through {len(pairs)} matched pairs in {time.perf_counter() - start:.3f}s")
+    return mapping
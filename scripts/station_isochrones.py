@@ -0,0 +1,246 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import logging
+import os
+
+import pandas as pd
+import shapely
+from shapely.geometry import mapping, shape
+from shapely.ops import unary_union
+
+from scripts import metrics
+from scripts import storage
+from scripts.data_context import borrowed
+from scripts.entrance_resolution import StationEntranceIndex
+from scripts.geometry_store import LazyGeometry, compact_geometry
+from scripts.isochrones import DEFAULT_REQUESTS_PER_MINUTE, WALKING_PARAMETERS, fetch_isochrones
+from scripts.load_sql import (ISOCHRONE_DATABASE, STATION_ISOCHRONES, STATION_ISOCHRONES_KEY,
+                              STATION_ISOCHRONES_SCHEMA, connect, ensure_isochrone_schema, upsert_table)
+from scripts.load_supabase import fetch_pages
+from scripts.supabase_writer import write_changes
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = 'station_isochrones_index.json'
+ENTRANCE_ISOCHRONE_COLUMNS = ['entrance_id', 'value', 'center', 'reachfactor', 'total_pop', 'geometry']
+
+
+def _digest(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def load_index(path=INDEX_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_index(index, path=INDEX_FILE):
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(temporary_path, path)
+
+
+def entrance_isochrone_hashes(entrance_isochrones):
+    # One hash per entrance over all of its isochrone bands
+    hashes = {}
+    for entrance_id, bands in entrance_isochrones.groupby('entrance_id'):
+        bands = bands.sort_values('value')
+        hashes[int(entrance_id)] = _digest(bands[['value', 'reachfactor', 'total_pop', 'geometry']].values.tolist())
+    return hashes
+
+
+def station_dependencies(stations, entrance_index, entrance_hashes):
+    # Maps station_id to the sorted (entrance_id, isochrone hash) pairs its isochrone is
+    # built from. Stations with no entrance isochrones get an empty list and are
+    # generated from their own coordinate instead.
+    return {
+        int(station.station_id): [[entrance_id, entrance_hashes[entrance_id]]
+                                  for entrance_id in entrance_index.entrances_for(station.station_code)
+                                  if entrance_id in entrance_hashes]
+        for station in stations.itertuples()
+    }
+
+
+def station_fingerprint(station, entrances):
+    if entrances:
+        return _digest(entrances)
+    return _digest(['generated', round(float(station.longitude), 5), round(float(station.latitude), 5)])
+
+
+def union_station(payload):
+    # Runs in a worker process: union every entrance isochrone of one station per band
+    station_id, bands = payload
+    records = []
+    for value, band in sorted(bands.items()):
+        geometry = compact_geometry(unary_union([shape(geometry) for geometry in band['geometries']]))
+        records.append({
+            'value': value,
+            'center': band['center'],
+            'reachfactor': sum(band['reachfactor']) / len(band['reachfactor']),
+            'total_pop': sum(band['total_pop']) / len(band['total_pop']),
+            'geometry': geometry.wkt,
+            'station_id': station_id,
+            'isochrone_id': f'{station_id}{int(value)}',
+            #area calculation likely wrong. just trying to standardize method
+            'area': geometry.area,
+            'type': geometry.geom_type,
+        })
+    return records
+
+
+def union_payloads(station_ids, entrance_index, entrance_isochrones, station_codes):
+    # Each station only reads the isochrone rows of its own entrances, found through the index
+    by_entrance = {}
+    for row in entrance_isochrones.itertuples():
+        by_entrance.setdefault(int(row.entrance_id), []).append(row)
+    payloads = []
+    for station_id in station_ids:
+        bands = {}
+        for entrance_id in entrance_index.entrances_for(station_codes[station_id]):
+            for row in by_entrance.get(entrance_id, []):
+                band = bands.setdefault(float(row.value), {'center': row.center, 'geometries': [],
+                                                          'reachfactor': [], 'total_pop': []})
+                band['geometries'].append(row.geometry if isinstance(row.geometry, dict) else mapping(row.geometry))
+                band['reachfactor'].append(row.reachfactor)
+                band['total_pop'].append(row.total_pop)
+        payloads.append((station_id, bands))
+    return payloads
+
+
+def generated_records(station_id, isochrone):
+    records = []
+    for feature in isochrone['features']:
+        geometry = compact_geometry(shape(feature['geometry']))
+        properties = feature['properties']
+        records.append({
+            'value': properties['value'],
+            'center': properties.get('center'),
+            'reachfactor': float(properties.get('reachfactor', 0)),
+            'total_pop': float(properties.get('total_pop', 0)),
+            'geometry': geometry.wkt,
+            'station_id': station_id,
+            'isochrone_id': f'{station_id}{int(properties["value"])}',
+            'area': geometry.area,
+            'type': geometry.geom_type,
+        })
+    return records
+
+
+def build(stations, station_entrances, entrance_isochrones, ors_client, index, max_workers=None, force=False,
+          cache=None, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE):
+    # Returns the isochrone records of every station whose entrances or entrance
+    # isochrones changed since index was written, and the updated index. cache and
+    # requests_per_minute apply to the stations generated from ORS.
+    entrance_hashes = entrance_isochrone_hashes(entrance_isochrones)
+    entrance_index = StationEntranceIndex.from_relations(station_entrances)
+    dependencies = station_dependencies(stations, entrance_index, entrance_hashes)
+    stations = stations.set_index('station_id')
+    fingerprints = {station_id: station_fingerprint(stations.loc[station_id], entrances)
+                    for station_id, entrances in dependencies.items()}
+    changed = [station_id for station_id, fingerprint in fingerprints.items()
+               if force or index.get(str(station_id)) != fingerprint]
+    logger.info(f"{len(changed)} of {len(fingerprints)} station isochrones need rebuilding")
+
+    combined = [station_id for station_id in changed if dependencies[station_id]]
+    generated = [station_id for station_id in changed if not dependencies[station_id]]
+
+    payloads = union_payloads(combined, entrance_index, entrance_isochrones, stations['station_code'])
+    if max_workers == 1:
+        unions = [union_station(payload) for payload in payloads]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            unions = list(metrics.merged(executor.map(metrics.Pooled(union_station), payloads, chunksize=16)))
+    records = [record for station_records in unions for record in station_records]
+    built = list(combined)
+
+    if generated:
+        locations = [[float(stations.loc[station_id, 'longitude']), float(stations.loc[station_id, 'latitude'])]
+                     for station_id in generated]
+        isochrones = fetch_isochrones(ors_client, locations, WALKING_PARAMETERS, cache=cache,
+                                      requests_per_minute=requests_per_minute)
+        for station_id, isochrone in zip(generated, isochrones):
+            if isochrone is not None:
+                records += generated_records(station_id, isochrone)
+                built.append(station_id)
+
+    updated_index = dict(index)
+    updated_index.update({str(station_id): fingerprints[station_id] for station_id in built})
+    return records, updated_index
+
+
+def run(supabase, ors_client, region='Klang Valley', index_path=INDEX_FILE, max_workers=None, force=False):
+    logger.info("Building station isochrones")
+    stations = storage.read_table('stations')
+    stations = stations[stations['region'] == region]
+    station_entrances = storage.read_table('station_entrances')
+
+    entrance_isochrones = pd.concat(
+        list(fetch_pages(supabase, 'entrances_isochrones', 'isochrone_id', ENTRANCE_ISOCHRONE_COLUMNS)),
+        ignore_index=True,
+    )
+    #correcting the column data type to prep for merging
+    entrance_isochrones['entrance_id'] = entrance_isochrones['entrance_id'].astype(int)
+
+    index = load_index(index_path)
+    records, updated_index = build(stations, station_entrances, entrance_isochrones, ors_client, index,
+                                   max_workers=max_workers, force=force)
+
+    # One chunked upsert for every rebuilt station instead of a request per station
+    stats = write_changes(supabase, 'station_isochrones', 'isochrone_id', records, [])
+    save_index(updated_index, index_path)
+    return stats
+
+
+def parse_geometry(geometry):
+    # Supabase returns the geometry as uploaded (WKT), as GeoJSON or, from a PostGIS
+    # column, as hex WKB. A missing geometry stays missing.
+    if geometry is None or (isinstance(geometry, float) and pd.isna(geometry)):
+        return None
+    if isinstance(geometry, dict):
+        return shape(geometry)
+    try:
+        return shapely.from_wkb(bytes.fromhex(geometry))
+    except ValueError:
+        return shapely.from_wkt(geometry)
+
+
+def local_rows(isochrones):
+    # The sqlite rows of isochrones: every geometry compacted and encoded, with the
+    # bounding box and area of the encoded geometry
+    rows = isochrones[['isochrone_id', 'station_id', 'value', 'type']].copy()
+    rows['isochrone_id'] = rows['isochrone_id'].astype(str)
+    lazy = [None if geometry is None else LazyGeometry.from_geometry(geometry)
+            for geometry in map(parse_geometry, isochrones['geometry'])]
+    rows['geometry'] = [None if geometry is None else geometry.encoded for geometry in lazy]
+    for position, column in enumerate(['min_x', 'min_y', 'max_x', 'max_y']):
+        rows[column] = [None if geometry is None else geometry.bbox[position] for geometry in lazy]
+    rows['area'] = [None if geometry is None else geometry.area for geometry in lazy]
+    return rows[list(STATION_ISOCHRONES_SCHEMA)].astype(STATION_ISOCHRONES_SCHEMA)
+
+
+def run_sql(url, key, database=ISOCHRONE_DATABASE, source=None, context=None):
+    # Copy the station isochrones into sqlite, for the query service and the map tiles.
+    # They are read from Supabase, or from source, a jsonl file written by the batch jobs.
+    logger.info("Load station isochrones into sqlite")
+    columns = ['station_id', 'value', 'geometry', 'type']
+    with borrowed(context) as context:
+        if source is not None:
+            isochrones = pd.read_json(source, lines=True, dtype=False)
+            isochrones = isochrones.drop_duplicates(STATION_ISOCHRONES_KEY, keep='last')
+        else:
+            supabase = context.supabase(url, key)
+            pages = list(fetch_pages(supabase, STATION_ISOCHRONES, STATION_ISOCHRONES_KEY, columns))
+            isochrones = (pd.concat(pages, ignore_index=True) if pages
+                          else pd.DataFrame(columns=[STATION_ISOCHRONES_KEY] + columns))
+        rows = local_rows(isochrones.reset_index(drop=True))
+
+        with context.sqlite(database, connect) as conn:
+            ensure_isochrone_schema(conn)
+            with conn:
+                return upsert_table(conn, STATION_ISOCHRONES, rows, STATION_ISOCHRONES_SCHEMA,
+                                    STATION_ISOCHRONES_KEY, changelog=False)
@@ -0,0 +1,120 @@
+import logging
+import os
+
+import pandas as pd
+
+from scripts import metrics
+
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+
+logger = logging.getLogger(__name__)
+
+cleansed_data_directory = 'data_cleansed'
+
+# Explicit column types of the cleansed tables, so a reader never has to re-infer them
+# (entrance_id coming back as float, coordinates as text). Low-cardinality labels are
+# stored as categoricals.
+SCHEMAS = {
+    'stations': {
+        'station_id': 'int64',
+        'name': 'string',
+        'station_code': 'string',
+        'service_provider_name': 'category',
+        'latitude': 'float64',
+        'longitude': 'float64',
+        'route_id': 'string',
+        'route_name': 'string',
+        'line_number': 'string',
+        'line_colour': 'category',
+        'colour_hex_code': 'string',
+        'region': 'category',
+        'odonym': 'string',
+        'namesake': 'string',
+        'opened': 'string',
+    },
+    'entrances': {
+        'entrance_id': 'int64',
+        'longitude': 'float64',
+        'latitude': 'float64',
+        'entrance_destination': 'string',
+        'entrance_name': 'string',
+    },
+    'station_entrances': {
+        'relationship_id': 'int64',
+        'entrance_id': 'int64',
+        'station_name': 'string',
+        'station_code': 'string',
+    },
+    'station_canonical_ids': {
+        'station_id': 'int64',
+        'canonical_id': 'int64',
+        'duplicates': 'int64',
+    },
+}
+
+TABLE_FILES = {
+    'stations': 'combined_stations_cleansed',
+    'entrances': 'klang_valley_entrances_cleansed',
+    'station_entrances': 'klang_valley_stations_entrances_relation_cleansed',
+    'station_canonical_ids': 'station_canonical_ids',
+}
+
+
+def storage_format():
+    # Parquet is used for the intermediate copy whenever pyarrow is available, unless
+    # TRANSIT_STORAGE_FORMAT=csv asks for the csv files only
+    requested = os.environ.get('TRANSIT_STORAGE_FORMAT', 'parquet' if HAS_PYARROW else 'csv')
+    if requested == 'parquet' and not HAS_PYARROW:
+        logger.warning("pyarrow is not installed, falling back to csv intermediates")
+        return 'csv'
+    return requested
+
+
+def table_path(table, extension, directory=cleansed_data_directory):
+    return os.path.join(directory, f'{TABLE_FILES[table]}.{extension}')
+
+
+def apply_schema(df, table):
+    schema = {column: dtype for column, dtype in SCHEMAS[table].items() if column in df.columns}
+    return df.astype(schema)
+
+
+def write_table(df, table, directory=cleansed_data_directory):
+    # The csv is always written as the exported copy; the typed parquet copy sits next
+    # to it for the loaders
+    df = apply_schema(df, table)
+    paths = [table_path(table, 'csv', directory)]
+    df.to_csv(paths[0], index=False)
+    if storage_format() == 'parquet':
+        paths.append(table_path(table, 'parquet', directory))
+        df.to_parquet(paths[1], index=False)
+    metrics.count('rows_written', len(df), target='storage', table=table)
+    metrics.count('bytes_written', sum(map(os.path.getsize, paths)), target='storage', table=table)
+    return df
+
+
+def source_path(table, directory=cleansed_data_directory):
+    # The file read_table reads: the parquet copy only if it was written alongside the
+    # current csv
+    csv_path = table_path(table, 'csv', directory)
+    parquet_path = table_path(table, 'parquet', directory)
+    if (storage_format() == 'parquet' and os.path.exists(parquet_path)
+            and os.path.getmtime(parquet_path) >= os.path.getmtime(csv_path)):
+        return parquet_path
+    return csv_path
+
+
+def read_table(table, directory=cleansed_data_directory):
+    path = source_path(table, directory)
+    if path.endswith('.parquet'):
+        df = pd.read_parquet(path)
+    else:
+        df = pd.read_csv(path, dtype=SCHEMAS[table])
+    metrics.count('rows_read', len(df), source='storage', table=table)
+    metrics.count('bytes_read', os.path.getsize(path), source='storage', table=table)
+    return df
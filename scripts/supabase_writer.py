@@ -0,0 +1,57 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+
+from scripts import metrics
+from scripts.retry import DEFAULT_BACKOFF, DEFAULT_RETRIES, with_retry
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_MAX_WORKERS = 4
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def write_changes(supabase, table, key, upserts, deletes, chunk_size=DEFAULT_CHUNK_SIZE,
+                  max_workers=DEFAULT_MAX_WORKERS, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+    # Send upsert records and deleted keys as chunked requests over a bounded thread
+    # pool: one upsert per chunk of records and one in_() delete per chunk of keys.
+    # Returns the table's write throughput.
+    def upsert(records):
+        with metrics.span('request', service='supabase', table=table, operation='upsert'):
+            response = with_retry(lambda: supabase.table(table).upsert(records, on_conflict=key).execute(),
+                                  retries, backoff)
+        metrics.count('rows_written', len(records), target='supabase', table=table)
+        return response
+
+    def delete(keys):
+        with metrics.span('request', service='supabase', table=table, operation='delete'):
+            response = with_retry(lambda: supabase.table(table).delete().in_(key, keys).execute(),
+                                  retries, backoff)
+        metrics.count('rows_deleted', len(keys), target='supabase', table=table)
+        return response
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(upsert, chunk) for chunk in chunks(upserts, chunk_size)]
+        futures += [executor.submit(delete, chunk) for chunk in chunks(deletes, chunk_size)]
+        for future in futures:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    rows = len(upserts) + len(deletes)
+    stats = {
+        'table': table,
+        'rows': rows,
+        'requests': len(futures),
+        'seconds': elapsed,
+        'rows_per_second': rows / elapsed if elapsed > 0 else 0.0,
+    }
+    logger.info(f"Wrote {rows} rows to {table} in {len(futures)} requests, "
+                f"{elapsed:.2f}s ({stats['rows_per_second']:.0f} rows/s)")
+    return stats
@@ -0,0 +1,95 @@
+from collections import namedtuple
+import logging
+
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+# inserted and updated hold full local rows, deleted holds only the remote keys
+TableDiff = namedtuple('TableDiff', ['inserted', 'updated', 'deleted', 'unchanged'])
+
+
+def to_records(df):
+    #ensure NAs are in a posgres readable format
+    df = df.astype(object)
+    return df.where(pd.notna(df), None).to_dict('records')
+
+
+def _is_numeric(series):
+    numeric = pd.to_numeric(series, errors='coerce')
+    return numeric.notna().sum() == series.notna().sum()
+
+
+def _canonical(series, numeric):
+    # CSV and PostgREST disagree on types (1 vs 1.0, NaN vs None), so both sides are
+    # coerced to the same representation before hashing
+    if numeric:
+        return pd.to_numeric(series, errors='coerce').astype('float64')
+    if pd.api.types.infer_dtype(series, skipna=True) == 'bytes':
+        # Blobs compare by their bytes; str() would try to decode them as text
+        return series.map(lambda value: value.hex(), na_action='ignore')
+    return series.astype(str).where(series.notna(), None)
+
+
+def _uncoercible(df, numeric_columns):
+    # Remote values that are not numbers where the local column is numeric can not
+    # be compared through the float representation, so those rows count as changed
+    mask = np.zeros(len(df), dtype=bool)
+    for column in numeric_columns:
+        series = df[column]
+        mask |= (series.notna() & pd.to_numeric(series, errors='coerce').isna()).to_numpy()
+    return mask
+
+
+def row_hashes(df, columns, numeric_columns):
+    canonical = pd.DataFrame(
+        {column: _canonical(df[column], column in numeric_columns) for column in columns},
+        index=df.index,
+    )
+    return pd.util.hash_pandas_object(canonical, index=False).to_numpy()
+
+
+def diff_table_pages(local, remote_pages, key, columns=None):
+    # Classify rows of local against a remote table that arrives as an iterable of
+    # pages. Local rows are hashed once and indexed by key; each remote page is
+    # hashed and matched against that index in one vectorized lookup, then dropped,
+    # so memory does not grow with the size of the remote table. Rows are compared
+    # on the local columns only, so extra remote columns such as timestamps do not
+    # count as changes.
+    if columns is None:
+        columns = [column for column in local.columns if column != key]
+    numeric_columns = {column for column in [key] + columns if _is_numeric(local[column])}
+
+    local_keys = pd.Index(_canonical(local[key], key in numeric_columns))
+    local_hashes = row_hashes(local, columns, numeric_columns)
+    seen = np.zeros(len(local), dtype=bool)
+    changed = np.zeros(len(local), dtype=bool)
+    deleted = []
+
+    for page in remote_pages:
+        page = page.reindex(columns=[key] + columns)
+        page_keys = _canonical(page[key], key in numeric_columns)
+        page_hashes = row_hashes(page, columns, numeric_columns)
+        different = _uncoercible(page, numeric_columns)
+
+        positions = local_keys.get_indexer(page_keys)
+        found = positions >= 0
+        seen[positions[found]] = True
+        changed[positions[found]] = (page_hashes[found] != local_hashes[positions[found]]) | different[found]
+        deleted.extend(page[key].to_numpy()[~found].tolist())
+
+    diff = TableDiff(
+        inserted=local[~seen].reset_index(drop=True),
+        updated=local[changed].reset_index(drop=True),
+        deleted=deleted,
+        unchanged=int((seen & ~changed).sum()),
+    )
+    logger.info(f"Diff on {key}: {len(diff.inserted)} inserted, {len(diff.updated)} updated, "
+                f"{len(diff.deleted)} deleted, {diff.unchanged} unchanged")
+    return diff
+
+
+def diff_tables(local, remote, key, columns=None):
+    return diff_table_pages(local, [remote], key, columns)
@@ -0,0 +1,397 @@
+import argparse
+from collections import deque
+import heapq
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from scripts import metrics
+from scripts.data_context import borrowed
+from scripts.load_sql import DATABASE
+from scripts.spatial_query import SpatialIndex, haversine
+
+
+logger = logging.getLogger(__name__)
+
+# Persisted next to the database it is derived alongside
+GRAPH = os.path.join(os.path.dirname(DATABASE), 'transit_graph.npz')
+RIDE = 0
+TRANSFER = 1
+# Edge weights in minutes: rides at an average speed including acceleration plus a
+# dwell at each stop, transfers as a fixed penalty plus the walk between entrances
+RIDE_SPEED_KMH = 40
+DWELL_MINUTES = 0.5
+TRANSFER_MINUTES = 5
+WALK_SPEED_KMH = 4.5
+# Stations whose entrances lie this close are treated as one interchange
+INTERCHANGE_RADIUS_M = 150
+# The all-pairs transfer matrix is one byte per pair, so it is only kept for networks
+# up to this many nodes; larger ones compute transfer counts per query
+MAX_PRECOMPUTED_NODES = 5000
+UNREACHABLE = 255
+NODE_COLUMNS = ['station_id', 'name', 'station_code', 'route_name', 'region', 'latitude', 'longitude']
+
+
+def normalized_names(names):
+    # 'Dhoby Ghaut MRT Station' and 'Dhoby Ghaut' name the same interchange, as do
+    # 'Berri–Uqam' and 'Berri-UQAM': lower case without the station-type suffix,
+    # punctuation or repeated spaces that differ between sources. Shared with
+    # scripts/station_dedup, so both agree on which names are the same.
+    return (names.astype('string').str.lower()
+            .str.replace(r'[^\w]+', ' ', regex=True)
+            .str.replace(r'\s+((mrt|lrt|brt|monorail)\s+)?station$', '', regex=True)
+            .str.replace(r'\s+', ' ', regex=True).str.strip())
+
+
+def _line_keys(nodes):
+    return nodes.groupby(['region', 'route_name'], observed=True, dropna=False, sort=False).ngroup().to_numpy()
+
+
+def line_edges(nodes):
+    # Consecutive station codes within a line and code prefix are adjacent: AG1-AG2,
+    # KG18-KG18A-KG20. Lines with several prefixes (the Seremban Line's KA/KB/KC, the
+    # Sengkang LRT's SE/SW around STC) join each other prefix's first station to the
+    # nearest station of the line outside it, which is where real branches split off.
+    parts = nodes['station_code'].str.extract(r'^([A-Za-z]+)(\d+)([A-Za-z]*)$')
+    frame = pd.DataFrame({
+        'node': np.arange(len(nodes)),
+        'line': _line_keys(nodes),
+        # Codes without a number, like STC, form a segment of their own
+        'prefix': parts[0].fillna(nodes['station_code']).fillna(''),
+        'number': pd.to_numeric(parts[1]).fillna(0).to_numpy(),
+        'suffix': parts[2].fillna(''),
+    }).sort_values(['line', 'prefix', 'number', 'suffix'], kind='stable')
+    same = ((frame['line'] == frame['line'].shift()) & (frame['prefix'] == frame['prefix'].shift())).to_numpy()
+    order = frame['node'].to_numpy()
+    sources, targets = [order[:-1][same[1:]]], [order[1:][same[1:]]]
+
+    latitudes, longitudes = nodes['latitude'].to_numpy(), nodes['longitude'].to_numpy()
+    branched = frame.groupby('line')['prefix'].transform('nunique') > 1
+    for _, members in frame[branched].groupby('line', sort=False):
+        main = members.groupby('prefix', sort=False).size().idxmax()
+        firsts = members.drop_duplicates('prefix')
+        for prefix, first in zip(firsts['prefix'], firsts['node']):
+            if prefix == main:
+                continue
+            others = members.loc[members['prefix'] != prefix, 'node'].to_numpy()
+            distances = haversine(latitudes[first], longitudes[first], latitudes[others], longitudes[others])
+            sources.append([first])
+            targets.append([others[np.argmin(distances)]])
+    return np.concatenate(sources).astype('int64'), np.concatenate(targets).astype('int64')
+
+
+def name_interchanges(nodes):
+    # Every pair of nodes with the same region and normalized name
+    frame = pd.DataFrame({'node': np.arange(len(nodes)), 'region': nodes['region'].astype('string').to_numpy(),
+                          'key': normalized_names(nodes['name']).to_numpy()}).dropna(subset=['key'])
+    pairs = frame.merge(frame, on=['region', 'key'])
+    pairs = pairs[pairs['node_x'] < pairs['node_y']]
+    return pairs['node_x'].to_numpy(), pairs['node_y'].to_numpy()
+
+
+def entrance_interchanges(nodes, entrances, station_entrances, radius_m=INTERCHANGE_RADIUS_M):
+    # Nodes whose stations share an entrance, or have entrances within radius_m of each
+    # other, with the walk between those entrances in meters
+    located = station_entrances[['entrance_id', 'station_code']].merge(
+        entrances[['entrance_id', 'latitude', 'longitude']], on='entrance_id').dropna()
+    empty = np.empty(0, dtype='int64')
+    if located.empty:
+        return empty, empty, np.empty(0)
+    index = SpatialIndex(np.arange(len(located)), located['latitude'], located['longitude'])
+    queries, points, distances = index.batch_within(located['latitude'], located['longitude'], radius_m)
+    codes = located['station_code'].to_numpy()
+    pairs = pd.DataFrame({'code_x': codes[queries], 'code_y': codes[points], 'meters': distances})
+    pairs = pairs[pairs['code_x'] < pairs['code_y']].groupby(['code_x', 'code_y'], as_index=False)['meters'].min()
+
+    # A code can name nodes on several lines (KA01 is KL Sentral on two of them)
+    by_code = pd.DataFrame({'node': np.arange(len(nodes)), 'code': nodes['station_code'].to_numpy()})
+    pairs = (pairs.merge(by_code.rename(columns={'node': 'node_x', 'code': 'code_x'}), on='code_x')
+             .merge(by_code.rename(columns={'node': 'node_y', 'code': 'code_y'}), on='code_y'))
+    return pairs['node_x'].to_numpy(), pairs['node_y'].to_numpy(), pairs['meters'].to_numpy()
+
+
+def build_edges(nodes, entrances, station_entrances):
+    latitudes, longitudes = nodes['latitude'].to_numpy(), nodes['longitude'].to_numpy()
+    ride_x, ride_y = line_edges(nodes)
+    ride_minutes = (haversine(latitudes[ride_x], longitudes[ride_x], latitudes[ride_y], longitudes[ride_y])
+                    / 1000 / RIDE_SPEED_KMH * 60 + DWELL_MINUTES)
+    name_x, name_y = name_interchanges(nodes)
+    walk_x, walk_y, meters = entrance_interchanges(nodes, entrances, station_entrances)
+    edges = pd.DataFrame({
+        'source': np.concatenate([ride_x, name_x, walk_x]),
+        'target': np.concatenate([ride_y, name_y, walk_y]),
+        'minutes': np.concatenate([ride_minutes, np.full(len(name_x), TRANSFER_MINUTES),
+                                   TRANSFER_MINUTES + meters / 1000 / WALK_SPEED_KMH * 60]),
+        'kind': np.repeat([RIDE, TRANSFER, TRANSFER], [len(ride_x), len(name_x), len(walk_x)]),
+    })
+    # Both directions of every edge, keeping the cheapest of any duplicates
+    edges = pd.concat([edges, edges.rename(columns={'source': 'target', 'target': 'source'})])
+    edges = edges[edges['source'] != edges['target']]
+    return (edges.sort_values(['source', 'target', 'minutes', 'kind'])
+            .drop_duplicates(['source', 'target']).reset_index(drop=True))
+
+
+class TransitGraph:
+    # Stations on each line as nodes, in compressed sparse row form: the edges leaving
+    # node i are indices[indptr[i]:indptr[i + 1]] with their minutes and kinds alongside.
+    # An interchange station is one node per line joined by transfer edges, so a path's
+    # transfers are the transfer edges it takes.
+
+    def __init__(self, nodes, indptr, indices, minutes, kinds, transfers=None):
+        self.nodes = nodes.reset_index(drop=True)
+        self.indptr = indptr
+        self.indices = indices
+        self.minutes = minutes
+        self.kinds = kinds
+        self.transfers = transfers
+        self.keys = normalized_names(self.nodes['name']).fillna('').to_numpy()
+        self.codes = self.nodes['station_code'].astype('string').str.lower().fillna('').to_numpy()
+        # Searches walk plain lists, which python indexes much faster than numpy arrays
+        self._adjacency = (indptr.tolist(), indices.tolist(), minutes.tolist(), kinds.tolist())
+
+    @classmethod
+    def build(cls, stations, entrances, station_entrances, precompute=None):
+        nodes = stations[NODE_COLUMNS].reset_index(drop=True)
+        edges = build_edges(nodes, entrances, station_entrances)
+        indptr = np.zeros(len(nodes) + 1, dtype='int64')
+        indptr[1:] = np.cumsum(np.bincount(edges['source'], minlength=len(nodes)))
+        graph = cls(nodes, indptr, edges['target'].to_numpy('int32'),
+                    edges['minutes'].to_numpy('float32'), edges['kind'].to_numpy('uint8'))
+        if precompute if precompute is not None else len(nodes) <= MAX_PRECOMPUTED_NODES:
+            graph.transfers = graph.transfer_counts()
+        return graph
+
+    @property
+    def size(self):
+        return len(self.nodes)
+
+    def save(self, path=GRAPH):
+        arrays = {f'node_{column}': self.nodes[column].to_numpy() for column in ['station_id', 'latitude', 'longitude']}
+        for column in ['name', 'station_code', 'route_name', 'region']:
+            arrays[f'node_{column}'] = self.nodes[column].astype('string').fillna('').to_numpy(dtype='U')
+        arrays.update(indptr=self.indptr, indices=self.indices, minutes=self.minutes, kinds=self.kinds)
+        if self.transfers is not None:
+            arrays['transfers'] = self.transfers
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path=GRAPH):
+        with np.load(path) as arrays:
+            nodes = pd.DataFrame({column: arrays[f'node_{column}'] for column in NODE_COLUMNS})
+            for column in ['name', 'station_code', 'route_name', 'region']:
+                nodes[column] = nodes[column].astype('string').replace('', pd.NA)
+            return cls(nodes, arrays['indptr'], arrays['indices'], arrays['minutes'], arrays['kinds'],
+                       arrays['transfers'] if 'transfers' in arrays else None)
+
+    def find(self, station, region=None):
+        # Node positions of a station by id, code or name; a name or shared code finds
+        # the station on every line it serves
+        if isinstance(station, (int, np.integer)):
+            found = self.nodes['station_id'].to_numpy() == station
+        else:
+            text = str(station).lower()
+            found = (self.codes == text) | (self.keys == normalized_names(pd.Series([text]))[0])
+        if region is not None:
+            found &= (self.nodes['region'] == region).to_numpy()
+        positions = np.flatnonzero(found)
+        if not len(positions):
+            raise KeyError(f"No station matches {station!r}")
+        return positions
+
+    def _search(self, sources, fewest_transfers=False, targets=(), max_minutes=None, max_transfers=None):
+        # Dijkstra from every source at once over (minutes, transfers), or over
+        # (transfers, minutes) for the fewest transfers. States are (node, transfers)
+        # pairs when max_transfers bounds the search, so a slower path with fewer
+        # transfers is not pruned by a faster one that used up the allowance.
+        indptr, indices, minutes, kinds = self._adjacency
+        targets = set(targets)
+        bounded = max_transfers is not None
+        best = {}
+        parents = {}
+        heap = []
+        for node in sources:
+            state = (node, 0)
+            best[state] = (0, 0.0) if fewest_transfers else (0.0, 0)
+            parents[state] = None
+            heap.append((best[state], state))
+        heapq.heapify(heap)
+        done = set()
+        while heap:
+            cost, state = heapq.heappop(heap)
+            if state in done:
+                continue
+            done.add(state)
+            node, _ = state
+            if node in targets:
+                return state, best, parents
+            elapsed, changes = (cost[1], cost[0]) if fewest_transfers else cost
+            for edge in range(indptr[node], indptr[node + 1]):
+                next_elapsed = elapsed + minutes[edge]
+                next_changes = changes + kinds[edge]
+                if max_minutes is not None and next_elapsed > max_minutes:
+                    continue
+                if bounded and next_changes > max_transfers:
+                    continue
+                next_state = (indices[edge], next_changes if bounded else 0)
+                next_cost = (next_changes, next_elapsed) if fewest_transfers else (next_elapsed, next_changes)
+                if next_state not in best or next_cost < best[next_state]:
+                    best[next_state] = next_cost
+                    parents[next_state] = state
+                    heapq.heappush(heap, (next_cost, next_state))
+        return None, best, parents
+
+    def shortest_path(self, source, target, fewest_transfers=False, region=None):
+        # The fastest path, or the one with fewest transfers and then fastest, as the
+        # stations along it with the cumulative minutes and transfers; None if the
+        # stations are not connected
+        end, best, parents = self._search(self.find(source, region), fewest_transfers,
+                                          targets=self.find(target, region).tolist())
+        if end is None:
+            return None
+        states = []
+        while end is not None:
+            states.append(end)
+            end = parents[end]
+        states.reverse()
+        costs = [best[state] for state in states]
+        path = self.nodes.iloc[[node for node, _ in states]].reset_index(drop=True)
+        path['minutes'] = [cost[1] if fewest_transfers else cost[0] for cost in costs]
+        path['transfers'] = [cost[0] if fewest_transfers else cost[1] for cost in costs]
+        return path
+
+    def _transfers_from(self, sources):
+        # 0-1 breadth first search from any of sources: rides cost no transfers, so they
+        # go to the front of the queue
+        indptr, indices, _, kinds = self._adjacency
+        counts = [UNREACHABLE] * self.size
+        for source in sources:
+            counts[source] = 0
+        queue = deque(sources)
+        while queue:
+            node = queue.popleft()
+            count = counts[node]
+            for edge in range(indptr[node], indptr[node + 1]):
+                neighbour = indices[edge]
+                next_count = count + kinds[edge]
+                if next_count < counts[neighbour]:
+                    counts[neighbour] = min(next_count, UNREACHABLE - 1)
+                    if kinds[edge]:
+                        queue.append(neighbour)
+                    else:
+                        queue.appendleft(neighbour)
+        return np.array(counts, dtype='uint8')
+
+    def transfer_counts(self, sources=None):
+        # Fewest transfers from each source node (all of them by default) to every node,
+        # UNREACHABLE where there is no path
+        if sources is None:
+            if self.transfers is not None:
+                return self.transfers
+            sources = range(self.size)
+        elif self.transfers is not None:
+            return self.transfers[np.asarray(sources)]
+        return np.vstack([self._transfers_from([source]) for source in sources]) if len(sources) \
+            else np.empty((0, self.size), dtype='uint8')
+
+    def transfers_between(self, source, target, region=None):
+        # Fewest transfers between two stations over all the lines each one serves
+        sources, targets = self.find(source, region), self.find(target, region)
+        if self.transfers is not None:
+            counts = self.transfers[np.ix_(sources, targets)]
+        else:
+            counts = self._transfers_from(sources.tolist())[targets]
+        fewest = int(counts.min())
+        return None if fewest == UNREACHABLE else fewest
+
+    def reachable(self, source, max_minutes=None, max_transfers=None, region=None):
+        # Every station reachable from source within the limits, with the fastest time
+        # there and the transfers that path takes
+        _, best, _ = self._search(self.find(source, region), max_minutes=max_minutes,
+                                  max_transfers=max_transfers)
+        fastest = {}
+        for (node, _), cost in best.items():
+            if node not in fastest or cost < fastest[node]:
+                fastest[node] = cost
+        nodes = list(fastest)
+        reached = self.nodes.iloc[nodes].reset_index(drop=True)
+        reached['minutes'] = [fastest[node][0] for node in nodes]
+        reached['transfers'] = [fastest[node][1] for node in nodes]
+        return reached.sort_values(['minutes', 'transfers'], ignore_index=True)
+
+    def interchanges(self):
+        # Stations joined by transfer edges, one row per interchange with the lines it
+        # serves, found as the connected components of the transfer edges alone
+        sources = np.repeat(np.arange(self.size), np.diff(self.indptr))
+        transfer = self.kinds == TRANSFER
+        parent = list(range(self.size))
+
+        def root(node):
+            while parent[node] != node:
+                parent[node] = parent[parent[node]]
+                node = parent[node]
+            return node
+
+        for a, b in zip(sources[transfer].tolist(), self.indices[transfer].tolist()):
+            parent[root(a)] = root(b)
+        members = self.nodes.assign(interchange=[root(node) for node in range(self.size)])
+        groups = members.groupby('interchange')
+        summary = pd.DataFrame({
+            'region': groups['region'].first(),
+            'names': groups['name'].agg(lambda names: ' / '.join(sorted(set(names.dropna())))),
+            'station_codes': groups['station_code'].agg(lambda codes: ' '.join(sorted(set(codes.dropna())))),
+            'lines': groups['route_name'].agg(lambda lines: sorted(set(lines.dropna()))),
+        })
+        summary = summary[summary['lines'].map(len) > 1]
+        summary['line_count'] = summary['lines'].map(len)
+        return summary.sort_values(['line_count', 'region', 'names'], ascending=[False, True, True],
+                                   ignore_index=True)
+
+
+def run(path=GRAPH, context=None):
+    logger.info("Build transit graph")
+    start = time.perf_counter()
+    with borrowed(context) as context:
+        graph = TransitGraph.build(context.table('stations'), context.table('entrances'),
+                                   context.table('station_entrances'))
+    graph.save(path)
+    transfers = int((graph.kinds == TRANSFER).sum()) // 2
+    metrics.gauge('graph_nodes', graph.size)
+    metrics.gauge('graph_edges', len(graph.indices) // 2, kind='ride')
+    metrics.gauge('graph_edges', transfers, kind='transfer')
+    logger.info(f"Built a graph of {graph.size} nodes, {len(graph.indices) // 2 - transfers} ride and "
+                f"{transfers} transfer edges in {time.perf_counter() - start:.3f}s, saved to {path}")
+    return graph
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query the transit graph')
+    parser.add_argument('--graph', default=GRAPH)
+    parser.add_argument('--region', help='limit station lookups to one region')
+    commands = parser.add_subparsers(dest='command', required=True)
+    path_parser = commands.add_parser('path', help='shortest path between two stations')
+    path_parser.add_argument('source')
+    path_parser.add_argument('target')
+    path_parser.add_argument('--fewest-transfers', action='store_true')
+    reachable_parser = commands.add_parser('reachable', help='stations reachable from a station')
+    reachable_parser.add_argument('source')
+    reachable_parser.add_argument('--max-minutes', type=float)
+    reachable_parser.add_argument('--max-transfers', type=int)
+    commands.add_parser('interchanges', help='stations shared across lines')
+    args = parser.parse_args()
+
+    graph = TransitGraph.load(args.graph)
+    columns = ['name', 'station_code', 'route_name', 'minutes', 'transfers']
+    if args.command == 'path':
+        path = graph.shortest_path(args.source, args.target, args.fewest_transfers, args.region)
+        print('Not connected' if path is None else path[columns].round(1).to_string(index=False))
+    elif args.command == 'reachable':
+        reached = graph.reachable(args.source, args.max_minutes, args.max_transfers, args.region)
+        print(reached[columns].round(1).to_string(index=False))
+    else:
+        print(graph.interchanges().to_string(index=False))
@@ -0,0 +1,188 @@
+from collections import namedtuple
+import json
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+
+from scripts import metrics
+from scripts.data_context import borrowed
+
+
+logger = logging.getLogger(__name__)
+
+VALIDATION_REPORT = 'validation_report.json'
+CRITICAL = 'critical'
+WARNING = 'warning'
+MAX_EXAMPLES = 5
+
+# (min longitude, min latitude, max longitude, max latitude) around each region's network
+REGION_BOUNDS = {
+    'Klang Valley': (101.2, 2.3, 102.4, 3.9),
+    'Montreal': (-74.0, 45.3, -73.3, 45.8),
+    'Singapore': (103.55, 1.15, 104.1, 1.5),
+}
+# Entrances come from the Overpass query over all of Malaysia
+ENTRANCE_BOUNDS = (99.6, 0.85, 119.3, 7.4)
+
+# A station is an outlier when it lies further from its line's median position than
+# OUTLIER_FACTOR times the line's median distance, and at least OUTLIER_MIN_KM. Both are
+# loose on purpose: commuter line termini sit 60 km out and the KLIA Ekspres has three
+# of its four stations at the airport, while the errors worth catching (swapped or
+# negated coordinates, a station filed under the wrong city) are hundreds of km off.
+OUTLIER_FACTOR = 8
+OUTLIER_MIN_KM = 50
+EARTH_RADIUS_KM = 6371.0088
+
+
+Rule = namedtuple('Rule', [
+    'name',
+    'severity',  # critical violations block the load, warnings are only reported
+    'check',     # check(df, tables) -> boolean array marking the violating rows of df
+])
+
+
+class RuleSet:
+    # The rules of one table with the key used to name violating rows. Built once at
+    # import and reused for every run.
+
+    def __init__(self, table, key, rules):
+        self.table = table
+        self.key = key
+        self.rules = list(rules)
+
+    def evaluate(self, tables):
+        df = tables[self.table]
+        keys = df[self.key].to_numpy()
+        violations = []
+        for rule in self.rules:
+            mask = np.asarray(rule.check(df, tables), dtype=bool)
+            count = int(mask.sum())
+            if count:
+                violations.append({
+                    'table': self.table,
+                    'rule': rule.name,
+                    'severity': rule.severity,
+                    'count': count,
+                    'examples': keys[mask][:MAX_EXAMPLES].tolist(),
+                })
+        return violations
+
+
+class ValidationError(Exception):
+    pass
+
+
+def missing(*columns):
+    return lambda df, tables: df[list(columns)].isna().any(axis=1).to_numpy()
+
+
+def duplicated(*columns):
+    return lambda df, tables: df.duplicated(list(columns), keep=False).to_numpy()
+
+
+def outside(bounds, longitude='longitude', latitude='latitude'):
+    min_lon, min_lat, max_lon, max_lat = bounds
+    return lambda df, tables: ~(df[longitude].between(min_lon, max_lon)
+                                & df[latitude].between(min_lat, max_lat)).to_numpy()
+
+
+def outside_region(df, tables):
+    # Look up each row's region bounds through the region categories, so the bounds are
+    # matched once per region rather than once per row
+    regions = df['region'].astype('category')
+    bounds = np.array([REGION_BOUNDS.get(region, (np.nan,) * 4) for region in regions.cat.categories] +
+                      [(np.nan,) * 4]).reshape(-1, 4)
+    row_bounds = bounds[regions.cat.codes.to_numpy()]  # code -1 (missing) picks the last, empty row
+    longitudes, latitudes = df['longitude'].to_numpy(), df['latitude'].to_numpy()
+    inside = ((longitudes >= row_bounds[:, 0]) & (longitudes <= row_bounds[:, 2])
+              & (latitudes >= row_bounds[:, 1]) & (latitudes <= row_bounds[:, 3]))
+    known = ~np.isnan(row_bounds[:, 0])
+    return known & ~inside
+
+
+def unknown_region(df, tables):
+    return ~df['region'].isin(list(REGION_BOUNDS)).to_numpy()
+
+
+def invalid_coordinates(df, tables):
+    return ~(df['latitude'].between(-90, 90) & df['longitude'].between(-180, 180)).to_numpy()
+
+
+def line_outlier(df, tables):
+    groups = df.groupby(['region', 'route_name'], observed=True, dropna=False)
+    median_lat = groups['latitude'].transform('median')
+    median_lon = groups['longitude'].transform('median')
+    # Equirectangular distance is plenty at the scale of one line
+    dx = np.radians(df['longitude'] - median_lon) * np.cos(np.radians(median_lat))
+    dy = np.radians(df['latitude'] - median_lat)
+    distance = pd.Series(EARTH_RADIUS_KM * np.hypot(dx, dy), index=df.index)
+    typical = distance.groupby([df['region'], df['route_name']], observed=True, dropna=False).transform('median')
+    size = groups['latitude'].transform('size')
+    return ((size >= 3) & (distance > np.maximum(OUTLIER_FACTOR * typical, OUTLIER_MIN_KM))).to_numpy()
+
+
+def not_in(column, table, other_column):
+    return lambda df, tables: ~df[column].isin(tables[table][other_column]).to_numpy()
+
+
+RULE_SETS = [
+    RuleSet('stations', 'station_id', [
+        Rule('required_values', CRITICAL, missing('name', 'station_code', 'latitude', 'longitude', 'region')),
+        Rule('unique_station_id', CRITICAL, duplicated('station_id')),
+        Rule('unique_station_code_per_line', CRITICAL, duplicated('region', 'route_name', 'station_code')),
+        Rule('coordinates_in_region', CRITICAL, outside_region),
+        Rule('known_region', WARNING, unknown_region),
+        Rule('line_outlier', WARNING, line_outlier),
+    ]),
+    RuleSet('entrances', 'entrance_id', [
+        Rule('required_values', CRITICAL, missing('entrance_id', 'latitude', 'longitude')),
+        Rule('unique_entrance_id', CRITICAL, duplicated('entrance_id')),
+        Rule('valid_coordinates', CRITICAL, invalid_coordinates),
+        Rule('coordinates_in_area', WARNING, outside(ENTRANCE_BOUNDS)),
+    ]),
+    RuleSet('station_entrances', 'relationship_id', [
+        Rule('unique_relationship_id', CRITICAL, duplicated('relationship_id')),
+        Rule('unique_entrance_station_pair', CRITICAL, duplicated('entrance_id', 'station_code')),
+        Rule('entrance_exists', CRITICAL, not_in('entrance_id', 'entrances', 'entrance_id')),
+        Rule('station_exists', WARNING, not_in('station_code', 'stations', 'station_code')),
+    ]),
+]
+
+
+def validate(tables, rule_sets=RULE_SETS):
+    return [violation for rule_set in rule_sets for violation in rule_set.evaluate(tables)]
+
+
+def run(report_path=VALIDATION_REPORT, rule_sets=RULE_SETS, context=None):
+    # Check the cleansed tables before they are loaded anywhere. The report is written
+    # either way; critical violations then fail the stage so the loads never start.
+    logger.info("Validate cleansed data")
+    start = time.perf_counter()
+    with borrowed(context) as context:
+        tables = {rule_set.table: context.table(rule_set.table) for rule_set in rule_sets}
+    violations = validate(tables, rule_sets)
+    elapsed = time.perf_counter() - start
+
+    critical = [violation for violation in violations if violation['severity'] == CRITICAL]
+    report = {
+        'rows': {table: len(df) for table, df in tables.items()},
+        'violations': violations,
+        'critical': sum(violation['count'] for violation in critical),
+        'seconds': round(elapsed, 3),
+    }
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+
+    for violation in violations:
+        metrics.count('validation_violations', violation['count'], table=violation['table'],
+                      rule=violation['rule'], severity=violation['severity'])
+        log = logger.error if violation['severity'] == CRITICAL else logger.warning
+        log(f"{violation['table']}.{violation['rule']}: {violation['count']} rows, "
+            f"e.g. {violation['examples']}")
+    logger.info(f"Validated {sum(report['rows'].values())} rows in {elapsed:.3f}s: "
+                f"{len(violations)} rules violated, {len(critical)} critical")
+    if critical:
+        raise ValidationError(f"{len(critical)} critical validation rules failed, see {report_path}")
+    return report
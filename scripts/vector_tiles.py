@@ -0,0 +1,388 @@
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+import hashlib
+import json
+import logging
+import math
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry.polygon import orient
+
+from scripts import metrics
+from scripts.geometry_store import LazyGeometry
+from scripts.load_sql import DATABASE, ISOCHRONE_DATABASE, STATION_ISOCHRONES
+from scripts.pipeline import process_context
+
+
+logger = logging.getLogger(__name__)
+
+MBTILES = 'transit_tiles.mbtiles'
+EXTENT = 4096
+BUFFER = 64
+# Tiles are grouped into square blocks of this many tiles a side; each block is one unit of
+# parallel work, so a feature is projected and simplified once per block instead of per tile
+BLOCK = 8
+# Douglas-Peucker tolerance in tile pixels, applied after projecting to each zoom
+SIMPLIFY_PIXELS = 1.0
+
+# name: (sql, id column, property columns, min zoom, max zoom)
+LAYERS = {
+    'stations': ('SELECT * FROM stations', 'station_id',
+                 ['station_id', 'name', 'station_code', 'route_name', 'colour_hex_code', 'region'], 8, 15),
+    'entrances': ('SELECT * FROM entrances', 'entrance_id',
+                  ['entrance_id', 'entrance_name', 'entrance_destination'], 13, 15),
+    'isochrones': ('SELECT rowid AS isochrone_row, station_id, value, geometry, min_x, min_y, max_x, max_y, area '
+                   'FROM station_isochrones WHERE geometry IS NOT NULL', 'isochrone_row', ['station_id', 'value'],
+                   10, 15),
+}
+
+_MOVE_TO = 1
+_LINE_TO = 2
+_CLOSE_PATH = 7
+_GEOMETRY_TYPES = {'Point': 1, 'MultiPoint': 1, 'Polygon': 3, 'MultiPolygon': 3}
+
+
+def mercator(longitudes, latitudes):
+    # Web mercator scaled to the unit square, y growing southwards as in tile coordinates
+    latitudes = np.clip(latitudes, -85.0511, 85.0511)
+    x = (np.asarray(longitudes) + 180.0) / 360.0
+    y = (1.0 - np.log(np.tan(np.radians(latitudes)) + 1.0 / np.cos(np.radians(latitudes))) / math.pi) / 2.0
+    return x, y
+
+
+def read_layer(database, table, sql):
+    # The rows of one layer, or None while database or its table does not exist yet
+    if not os.path.exists(database):
+        return None
+    conn = sqlite3.connect(f'file:{database}?mode=ro', uri=True)
+    try:
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone():
+            return None
+        return pd.read_sql(sql, conn)
+    finally:
+        conn.close()
+
+
+def load_features(database=DATABASE, isochrone_database=ISOCHRONE_DATABASE):
+    # Features of every layer as a dataframe of layer, id, properties (json), geometry,
+    # bounding box in unit mercator coordinates and a content hash. Points are built in
+    # mercator; isochrones stay encoded as stored, their box and hash taken from the
+    # stored bbox and bytes, so only those in tiles being rendered are decoded. The
+    # isochrone layer is read from isochrone_database, written by the isochrones_sql
+    # stage, once that exists.
+    sources = {'isochrones': (isochrone_database, STATION_ISOCHRONES)}
+    frames = []
+    for layer, (sql, id_column, properties, _, _) in LAYERS.items():
+        df = read_layer(*sources.get(layer, (database, layer)), sql)
+        if df is None:
+            continue
+        if 'geometry' in df.columns:
+            geometries = [LazyGeometry(encoded, list(bbox), area) for encoded, bbox, area
+                          in zip(df['geometry'], df[['min_x', 'min_y', 'max_x', 'max_y']].to_numpy(), df['area'])]
+            encoded = df['geometry'].tolist()
+            # Mercator y grows southwards, so the northern edge gives the smaller y
+            min_x, max_y = mercator(df['min_x'].to_numpy(float), df['min_y'].to_numpy(float))
+            max_x, min_y = mercator(df['max_x'].to_numpy(float), df['max_y'].to_numpy(float))
+        else:
+            x, y = mercator(df['longitude'].to_numpy(float), df['latitude'].to_numpy(float))
+            geometries = shapely.points(x, y)
+            encoded = shapely.to_wkb(geometries).tolist()
+            min_x, min_y, max_x, max_y = x, y, x, y
+        props = df[properties].astype(object).where(df[properties].notna(), None)
+        frame = pd.DataFrame({
+            'layer': layer,
+            'id': df[id_column].astype('int64'),
+            'properties': [json.dumps(record, sort_keys=True, default=str)
+                           for record in props.to_dict('records')],
+            'geometry': pd.Series(geometries, index=df.index, dtype=object),
+            'min_x': min_x, 'min_y': min_y, 'max_x': max_x, 'max_y': max_y,
+        })
+        frame['hash'] = [hashlib.sha1(f'{layer}|{id}|{properties}|'.encode('utf-8') + data).hexdigest()
+                         for id, properties, data in zip(frame['id'], frame['properties'], encoded)]
+        frames.append(frame)
+
+    if not frames:
+        return pd.DataFrame(columns=['layer', 'id', 'properties', 'geometry', 'min_x', 'min_y', 'max_x', 'max_y',
+                                     'hash'])
+    return pd.concat(frames, ignore_index=True)
+
+
+def projected(geometry):
+    # A feature's geometry in unit mercator coordinates, decoding a stored isochrone
+    if isinstance(geometry, LazyGeometry):
+        return shapely.transform(geometry.geometry, lambda coords: np.column_stack(
+            mercator(coords[:, 0], coords[:, 1])))
+    return geometry
+
+
+def tile_assignments(features):
+    # (zoom, x, y, feature position) for every tile whose buffered extent a feature's
+    # bounding box touches, at every zoom of the feature's layer
+    bounds = features[['min_x', 'min_y', 'max_x', 'max_y']].to_numpy(float)
+    pad = BUFFER / EXTENT
+    rows = []
+    for layer, (_, _, _, min_zoom, max_zoom) in LAYERS.items():
+        positions = np.flatnonzero(features['layer'].to_numpy() == layer)
+        for zoom in range(min_zoom, max_zoom + 1):
+            n = 2 ** zoom
+            low = np.clip(np.floor(bounds[positions, :2] * n - pad), 0, n - 1).astype(np.int64)
+            high = np.clip(np.floor(bounds[positions, 2:] * n + pad), 0, n - 1).astype(np.int64)
+            spans_x = high[:, 0] - low[:, 0] + 1
+            spans_y = high[:, 1] - low[:, 1] + 1
+            counts = spans_x * spans_y
+            owner = np.repeat(np.arange(len(positions)), counts)
+            offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            rows.append(pd.DataFrame({
+                'zoom': zoom,
+                'x': low[owner, 0] + offset % spans_x[owner],
+                'y': low[owner, 1] + offset // spans_x[owner],
+                'feature': positions[owner],
+            }))
+    return pd.concat(rows, ignore_index=True)
+
+
+def tile_hashes(features, assignments):
+    # A tile's hash covers the hashes of all features touching it, so it changes only
+    # when one of those features is added, removed or edited
+    keyed = assignments.assign(hash=features['hash'].to_numpy()[assignments['feature'].to_numpy()])
+    keyed = keyed.sort_values(['zoom', 'x', 'y', 'hash'])
+    return {(int(zoom), int(x), int(y)): hashlib.sha1(''.join(group['hash']).encode('ascii')).hexdigest()
+            for (zoom, x, y), group in keyed.groupby(['zoom', 'x', 'y'], sort=False)}
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 31)
+
+
+def _varint(value):
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _field(number, wire_type, payload):
+    if wire_type == 0:
+        return _varint(number << 3) + _varint(payload)
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def _packed(number, values):
+    return _field(number, 2, b''.join(_varint(value) for value in values))
+
+
+def _value(value):
+    if isinstance(value, bool):
+        return _field(7, 0, int(value))
+    if isinstance(value, int):
+        return _field(5, 0, value) if value >= 0 else _field(6, 0, (value << 1) ^ (value >> 63))
+    if isinstance(value, float):
+        return _varint(3 << 3 | 1) + np.float64(value).tobytes()
+    return _field(1, 2, str(value).encode('utf-8'))
+
+
+def _ring_commands(coords, cursor):
+    commands = [_MOVE_TO | 1 << 3]
+    for i, (x, y) in enumerate(coords):
+        if i == 1:
+            commands.append(_LINE_TO | (len(coords) - 1) << 3)
+        commands += [_zigzag(x - cursor[0]), _zigzag(y - cursor[1])]
+        cursor = (x, y)
+    return commands, cursor
+
+
+def _ring(ring):
+    # Integer ring without the closing point, or None once rounding collapses it
+    coords = np.round(np.asarray(ring.coords)).astype(np.int64)[:-1]
+    keep = np.any(coords != np.roll(coords, 1, axis=0), axis=1)
+    coords = coords[keep]
+    if len(coords) < 3:
+        return None
+    area = np.sum(coords[:, 0] * np.roll(coords[:, 1], -1) - np.roll(coords[:, 0], -1) * coords[:, 1])
+    return coords if area != 0 else None
+
+
+def encode_geometry(geometry):
+    # MVT geometry commands for a geometry already in tile pixel coordinates
+    cursor = (0, 0)
+    commands = []
+    if geometry.geom_type in ('Point', 'MultiPoint'):
+        points = np.round(shapely.get_coordinates(geometry)).astype(np.int64)
+        commands.append(_MOVE_TO | len(points) << 3)
+        for x, y in points:
+            commands += [_zigzag(x - cursor[0]), _zigzag(y - cursor[1])]
+            cursor = (x, y)
+        return commands
+
+    for polygon in getattr(geometry, 'geoms', [geometry]):
+        # Exterior rings have positive area in tile coordinates (clockwise on screen)
+        polygon = orient(polygon, 1.0)
+        exterior = _ring(polygon.exterior)
+        if exterior is None:
+            continue
+        for ring in [exterior] + [_ring(interior) for interior in polygon.interiors]:
+            if ring is None:
+                continue
+            ring_commands, cursor = _ring_commands(ring.tolist(), cursor)
+            commands += ring_commands + [_CLOSE_PATH | 1 << 3]
+    return commands
+
+
+def encode_layer(name, features):
+    # features: (id, properties dict, geometry in tile pixels)
+    keys, values, encoded = {}, {}, []
+    for feature_id, properties, geometry in features:
+        commands = encode_geometry(geometry)
+        if not commands:
+            continue
+        tags = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            tags += [keys.setdefault(key, len(keys)), values.setdefault(_value(value), len(values))]
+        encoded.append(_field(2, 2, _field(1, 0, feature_id) + _packed(2, tags)
+                              + _field(3, 0, _GEOMETRY_TYPES[geometry.geom_type]) + _packed(4, commands)))
+    if not encoded:
+        return b''
+    return _field(3, 2, _field(15, 0, 2) + _field(1, 2, name.encode('utf-8')) + b''.join(encoded)
+                  + b''.join(_field(3, 2, key.encode('utf-8')) for key in keys)
+                  + b''.join(_field(4, 2, value) for value in values)
+                  + _field(5, 0, EXTENT))
+
+
+def render_block(payload):
+    # Runs in worker processes: project and simplify the block's features once for the
+    # zoom, then clip them into each requested tile
+    zoom, tiles, layers = payload
+    scale = 2 ** zoom * EXTENT
+    clipped = {tile: [] for tile in tiles}
+    for layer, features in layers.items():
+        ids, properties, geometries = features
+        geometries = shapely.transform(np.asarray(geometries), lambda coords: coords * scale)
+        polygonal = shapely.get_type_id(geometries) >= 3
+        geometries[polygonal] = shapely.make_valid(shapely.simplify(geometries[polygonal], SIMPLIFY_PIXELS))
+        for x, y in tiles:
+            left, top = x * EXTENT, y * EXTENT
+            parts = shapely.clip_by_rect(geometries, left - BUFFER, top - BUFFER,
+                                         left + EXTENT + BUFFER, top + EXTENT + BUFFER)
+            parts = shapely.transform(parts, lambda coords: coords - (left, top))
+            kept = [(feature_id, json.loads(props), shapely.get_parts(part, return_index=False))
+                    for feature_id, props, part in zip(ids, properties, parts) if not part.is_empty]
+            rows = []
+            for feature_id, props, pieces in kept:
+                pieces = [piece for piece in pieces if piece.geom_type in _GEOMETRY_TYPES]
+                if pieces:
+                    rows.append((feature_id, props, pieces[0] if len(pieces) == 1 else shapely.union_all(pieces)))
+            clipped[(x, y)].append(encode_layer(layer, rows))
+    return zoom, {tile: gzip.compress(b''.join(layers), mtime=0) if any(layers) else None
+                  for tile, layers in clipped.items()}
+
+
+def block_payloads(features, assignments, dirty):
+    # One payload per (zoom, block) holding the dirty tiles of the block and every feature
+    # touching any of them
+    dirty = assignments.merge(pd.DataFrame(list(dirty), columns=['zoom', 'x', 'y']), on=['zoom', 'x', 'y'])
+    dirty = dirty.assign(block_x=dirty['x'] // BLOCK, block_y=dirty['y'] // BLOCK)
+    # Projected once per feature, however many blocks and zooms it appears in
+    geometries = {}
+    for (zoom, _, _), group in dirty.groupby(['zoom', 'block_x', 'block_y']):
+        tiles = list(group[['x', 'y']].drop_duplicates().itertuples(index=False, name=None))
+        positions = np.unique(group['feature'].to_numpy())
+        for position in positions:
+            if position not in geometries:
+                geometries[position] = projected(features['geometry'].iat[position])
+        block = features.iloc[positions].assign(geometry=[geometries[position] for position in positions])
+        layers = {layer: (part['id'].tolist(), part['properties'].tolist(), part['geometry'].tolist())
+                  for layer, part in block.groupby('layer')}
+        yield int(zoom), [(int(x), int(y)) for x, y in tiles], layers
+
+
+def connect(path=MBTILES):
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)')
+        conn.execute('CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, '
+                     'tile_row INTEGER, tile_data BLOB, PRIMARY KEY (zoom_level, tile_column, tile_row))')
+        # Content hash of every tile written, in xyz coordinates; drives incremental rebuilds
+        conn.execute('CREATE TABLE IF NOT EXISTS tile_hashes (zoom_level INTEGER, x INTEGER, y INTEGER, '
+                     'hash TEXT, PRIMARY KEY (zoom_level, x, y))')
+    return conn
+
+
+def write_metadata(conn, features):
+    if features.empty:
+        # With no features there is no extent or zoom range to describe; earlier values are dropped
+        conn.execute("DELETE FROM metadata WHERE name IN ('minzoom', 'maxzoom', 'bounds', 'center')")
+        metadata = {'name': 'transit', 'format': 'pbf', 'json': json.dumps({'vector_layers': []})}
+        conn.executemany('INSERT INTO metadata (name, value) VALUES (?, ?) '
+                         'ON CONFLICT (name) DO UPDATE SET value = excluded.value', list(metadata.items()))
+        return
+    zooms = [LAYERS[layer][3:] for layer in features['layer'].unique()]
+    bounds = np.array([features['min_x'].min(), features['min_y'].min(), features['max_x'].max(),
+                       features['max_y'].max()])
+    longitudes = bounds[[0, 2]] * 360.0 - 180.0
+    latitudes = np.degrees(np.arctan(np.sinh(math.pi * (1 - 2 * bounds[[3, 1]]))))
+    vector_layers = [{'id': layer, 'fields': {column: 'String' for column in LAYERS[layer][2]},
+                      'minzoom': LAYERS[layer][3], 'maxzoom': LAYERS[layer][4]}
+                     for layer in features['layer'].unique()]
+    metadata = {
+        'name': 'transit',
+        'format': 'pbf',
+        'minzoom': str(min(zoom for zoom, _ in zooms)),
+        'maxzoom': str(max(zoom for _, zoom in zooms)),
+        'bounds': ','.join(f'{value:.6f}' for value in [longitudes[0], latitudes[0], longitudes[1], latitudes[1]]),
+        'center': f'{longitudes.mean():.6f},{latitudes.mean():.6f},{min(zoom for zoom, _ in zooms) + 2}',
+        'json': json.dumps({'vector_layers': vector_layers}),
+    }
+    conn.executemany('INSERT INTO metadata (name, value) VALUES (?, ?) '
+                     'ON CONFLICT (name) DO UPDATE SET value = excluded.value', list(metadata.items()))
+
+
+def run(database=DATABASE, path=MBTILES, max_workers=None, force=False, isochrone_database=ISOCHRONE_DATABASE):
+    logger.info("Build vector tiles")
+    start = time.perf_counter()
+    features = load_features(database, isochrone_database)
+    assignments = tile_assignments(features)
+    hashes = tile_hashes(features, assignments)
+
+    conn = connect(path)
+    try:
+        previous = {} if force else {(zoom, x, y): value for zoom, x, y, value
+                                     in conn.execute('SELECT zoom_level, x, y, hash FROM tile_hashes')}
+        dirty = {tile for tile, value in hashes.items() if previous.get(tile) != value}
+        removed = set(previous) - set(hashes)
+        logger.info(f"{len(hashes)} tiles from {len(features)} features: {len(dirty)} to render, "
+                    f"{len(removed)} to remove, {len(hashes) - len(dirty)} unchanged")
+
+        written = empty = 0
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=process_context()) as executor, conn:
+            blocks = executor.map(metrics.Pooled(render_block), block_payloads(features, assignments, dirty))
+            for zoom, tiles in metrics.merged(blocks):
+                for (x, y), data in tiles.items():
+                    # MBTiles rows are in TMS order, counted from the bottom
+                    row = 2 ** zoom - 1 - y
+                    if data is None:
+                        conn.execute('DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                                     (zoom, x, row))
+                        empty += 1
+                    else:
+                        conn.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)', (zoom, x, row, data))
+                        written += 1
+            conn.executemany('INSERT OR REPLACE INTO tile_hashes VALUES (?, ?, ?, ?)',
+                             [(*tile, hashes[tile]) for tile in dirty])
+            for zoom, x, y in removed:
+                conn.execute('DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                             (zoom, x, 2 ** zoom - 1 - y))
+                conn.execute('DELETE FROM tile_hashes WHERE zoom_level = ? AND x = ? AND y = ?', (zoom, x, y))
+            write_metadata(conn, features)
+    finally:
+        conn.close()
+    logger.info(f"Wrote {written} tiles ({empty} empty after clipping) to {path} "
+                f"in {time.perf_counter() - start:.2f}s")
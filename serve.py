@@ -0,0 +1,28 @@
+import argparse
+import asyncio
+import logging
+
+from scripts.load_sql import DATABASE, ISOCHRONE_DATABASE
+from scripts.query_service import DEFAULT_CACHE_SIZE, DEFAULT_CACHE_TTL, DEFAULT_RELOAD_INTERVAL, QueryService
+
+
+# Read-only HTTP API over transit_database.db and station_isochrones.db:
+#   GET /stations?region=<region>&line=<route name>&route=<route id>
+#   GET /stations/<station_code>/entrances
+#   GET /nearest?lat=<lat>&lon=<lon>&k=<k>&table=<stations|entrances>
+#   GET /isochrones/<station_id>
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--database', default=DATABASE)
+    parser.add_argument('--isochrone-database', default=ISOCHRONE_DATABASE)
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE)
+    parser.add_argument('--cache-ttl', type=float, default=DEFAULT_CACHE_TTL)
+    parser.add_argument('--reload-interval', type=float, default=DEFAULT_RELOAD_INTERVAL)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    service = QueryService(args.database, args.cache_size, args.cache_ttl, args.reload_interval,
+                           args.isochrone_database)
+    asyncio.run(service.serve(args.host, args.port))